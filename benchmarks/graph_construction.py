@@ -0,0 +1,129 @@
+"""
+Benchmark of the construction of the workflow graph for synthetic datasets.
+
+Writes BIDS datasets with an increasing number of PET runs (tiny NIfTI files with
+consistent sidecars and empty FreeSurfer subject directories) and times
+:func:`petprep_extract_tacs.extract_tacs.init_petprep_extract_tacs_wf` with all
+region extraction options, and optionally the expansion of the PET run
+iterables by nipype. The time per run should stay about constant as the number
+of runs grows.
+
+Usage::
+
+    python benchmarks/graph_construction.py --runs 1000 2500 5000 10000
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import tempfile
+import time
+
+import nibabel as nib
+import numpy as np
+from nipype.pipeline.engine.utils import generate_expanded_graph
+
+from petprep_extract_tacs.extract_tacs import init_petprep_extract_tacs_wf
+from petprep_extract_tacs.utils.scan import PETDataset
+
+
+def make_dataset(bids_dir, n_subjects, runs_per_subject):
+    """
+    Write a synthetic BIDS dataset with PET runs and FreeSurfer subject dirs.
+    """
+    with open(os.path.join(bids_dir, "dataset_description.json"), "w") as f:
+        json.dump({"Name": "benchmark", "BIDSVersion": "1.7.0"}, f)
+
+    img = nib.Nifti1Image(np.zeros((2, 2, 2, 3), dtype=np.float32), np.eye(4))
+    sidecar = {"FrameTimesStart": [0, 60, 120], "FrameDuration": [60, 60, 60]}
+    for subject in range(n_subjects):
+        label = f"sub-{subject:05d}"
+        pet_dir = os.path.join(bids_dir, label, "pet")
+        os.makedirs(pet_dir)
+        os.makedirs(os.path.join(bids_dir, "derivatives", "freesurfer", label, "mri"))
+        for run in range(1, runs_per_subject + 1):
+            name = os.path.join(pet_dir, f"{label}_run-{run}_pet")
+            nib.save(img, f"{name}.nii.gz")
+            with open(f"{name}.json", "w") as f:
+                json.dump(sidecar, f)
+
+
+def benchmark(n_runs, runs_per_subject, expand):
+    """
+    Time the graph construction for a dataset of ``n_runs`` PET runs.
+
+    :return: Seconds to build the workflow, and to expand it or ``None``.
+    :rtype: tuple
+    """
+    with tempfile.TemporaryDirectory() as bids_dir:
+        make_dataset(bids_dir, n_runs // runs_per_subject, runs_per_subject)
+        args = argparse.Namespace(
+            bids_dir=bids_dir,
+            output_dir=os.path.join(bids_dir, "derivatives", "petprep_extract_tacs"),
+            gtm=True,
+            agtm=True,
+            psf=4.0,
+            brainstem=True,
+            thalamicNuclei=True,
+            hippocampusAmygdala=True,
+            wm=True,
+            raphe=True,
+            limbic=True,
+            surface=True,
+            surface_smooth=5,
+            volume=True,
+            volume_smooth=5,
+            petprep_hmc=False,
+            n_procs=8,
+        )
+
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            layout = PETDataset(bids_dir)
+            wf = init_petprep_extract_tacs_wf(
+                args, layout.get_subjects(), include_anat=True, layout=layout
+            )
+        build = time.perf_counter() - start
+
+        expansion = None
+        if expand:
+            start = time.perf_counter()
+            generate_expanded_graph(wf._create_flat_graph())
+            expansion = time.perf_counter() - start
+    return build, expansion
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--runs",
+        nargs="+",
+        type=int,
+        default=[1000, 2500, 5000, 10000],
+        help="Numbers of PET runs of the synthetic datasets",
+    )
+    parser.add_argument(
+        "--runs_per_subject", type=int, default=4, help="PET runs of every subject"
+    )
+    parser.add_argument(
+        "--expand",
+        action="store_true",
+        help="Also time the expansion of the PET run iterables by nipype",
+    )
+    args = parser.parse_args()
+
+    print(
+        f"{'runs':>8} {'build [s]':>10} {'ms/run':>8} {'expand [s]':>11} {'ms/run':>8}"
+    )
+    for n_runs in args.runs:
+        build, expansion = benchmark(n_runs, args.runs_per_subject, args.expand)
+        row = f"{n_runs:>8} {build:>10.2f} {1000 * build / n_runs:>8.2f}"
+        if expansion is not None:
+            row += f" {expansion:>11.2f} {1000 * expansion / n_runs:>8.2f}"
+        print(row, flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -10,35 +10,41 @@ import subprocess
 import pathlib
 import json
 import warnings
+from functools import lru_cache
 from platform import system
 import pkg_resources
-from bids import BIDSLayout
-from nipype.interfaces.utility import IdentityInterface, Merge
+from nipype.interfaces.utility import IdentityInterface, Merge, Select
 from nipype.pipeline import Workflow
 from nipype import Node, Function, DataSink
+from nipype.interfaces.base import traits
 from nipype.interfaces.io import SelectFiles
 from niworkflows.utils.misc import check_valid_fs_license
 from petprep_extract_tacs.utils.pet import create_weighted_average_pet
-from nipype.interfaces.freesurfer import (
-    MRICoreg,
-    ApplyVolTransform,
-    MRIConvert,
-    Concatenate,
-    SampleToSurface,
-    SurfaceSmooth,
+from petprep_extract_tacs.utils.anat import anat_step_is_current
+from petprep_extract_tacs.utils.layout import get_layout
+from petprep_extract_tacs.utils.scan import PETDataset
+from petprep_extract_tacs.utils.validate import (
+    validate_frame_timing,
+    write_frame_timing_report,
 )
-from petprep_extract_tacs.interfaces.petsurfer import GTMSeg, GTMPVC
+from petprep_extract_tacs.interfaces.petsurfer import GTMSeg
 from petprep_extract_tacs.interfaces.segment import (
     SegmentBS,
     SegmentHA_T1,
     SegmentThalamicNuclei,
     MRISclimbicSeg,
 )
-from petprep_extract_tacs.interfaces.fs_model import SegStats
 from petprep_extract_tacs.utils.utils import (
-    ctab_to_dsegtsv,
-    avgwf_to_tacs,
-    summary_to_stats,
+    multi_segstats_to_tacs,
+    resample_pet_to_anat,
+    register_pet_to_t1w,
+    convert_anat_volume,
+    resample_pet_to_mni305,
+    vol2surf_fsaverage,
+    prepare_gtm,
+    gtm_nopvc,
+    gtm_pvc,
+    agtm_psf,
     gtm_to_tacs,
     gtm_stats_to_stats,
     gtm_to_dsegtsv,
@@ -50,10 +56,25 @@ from petprep_extract_tacs.utils.utils import (
 )
 from petprep_extract_tacs.utils.merge_tacs import collect_and_merge_tsvs
 from niworkflows.utils.bids import collect_participants, collect_data
-from petutils.petutils import PETFrameTimingError, check_nifti_json_frame_consistency
+from petutils.petutils import PETFrameTimingError
 from importlib.metadata import version
 from petprep_extract_tacs.utils.datasink import copy_datasink_to_derivatives
 
+# Number of subjects segmented by a single mri_sclimbic_seg call
+SCLIMBIC_BATCH_SIZE = 8
+
+# Names of the nodes of the anatomical segmentations, and their outputs that are
+# set once a segmentation has finished
+ANAT_NODES = {
+    "gtm": ("gtmseg", "out_file"),
+    "brainstem": ("segment_bs", "bs_labels_voxel"),
+    "thalamicNuclei": ("segment_th", "thalamic_labels_voxel"),
+    "hippocampusAmygdala": ("segment_ha", "lh_hippoAmygLabels"),
+}
+
+# Subject label of the template workflow cloned for every subject
+TEMPLATE_SUBJECT = "@subject@"
+
 project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 if project_root not in sys.path:
     sys.path.insert(0, project_root)
@@ -102,17 +123,147 @@ def determine_in_docker():
     return in_docker
 
 
+@lru_cache(maxsize=None)
+def resource_filename(resource):
+    """
+    Return the path of a file shipped with the package, looked up only once.
+
+    :param resource: Path relative to the package, e.g. ``utils/sclimbic.ctab``.
+    :type resource: str
+    :return: Path to the file.
+    :rtype: str
+    """
+    return pkg_resources.resource_filename("petprep_extract_tacs", resource)
+
+
+def get_cache_dir(args, subject_id=None):
+    """
+    Return the directory used to cache artefacts that are reused between runs.
+
+    :param args: Parsed command line arguments.
+    :type args: argparse.Namespace
+    :param subject_id: Optional subject label; when given the per-subject cache
+        directory is returned.
+    :type subject_id: str
+    :return: Path to the cache directory.
+    :rtype: str
+    """
+    cache_dir = getattr(args, "cache_dir", None) or os.path.join(
+        args.bids_dir, "derivatives", "petprep_extract_tacs_cache"
+    )
+    if subject_id is not None:
+        cache_dir = os.path.join(cache_dir, f"sub-{subject_id}")
+    return cache_dir
+
+
+def get_layout_dir(args):
+    """
+    Return the directory of the persistent pybids index of the BIDS dataset.
+
+    :param args: Parsed command line arguments.
+    :type args: argparse.Namespace
+    :return: Path to the database directory, see
+        :func:`petprep_extract_tacs.utils.layout.get_layout`.
+    :rtype: str
+    """
+    return os.path.join(get_cache_dir(args), "bids_db")
+
+
+def get_bids_layout(args):
+    """
+    Return the layout of the BIDS dataset, validated unless it is skipped.
+
+    :param args: Parsed command line arguments.
+    :type args: argparse.Namespace
+    :return: Layout of the dataset, see
+        :func:`petprep_extract_tacs.utils.layout.get_layout`.
+    :rtype: bids.BIDSLayout
+    """
+    return get_layout(
+        args.bids_dir,
+        validate=not getattr(args, "skip_bids_validator", False),
+        database_dir=get_layout_dir(args),
+    )
+
+
+def get_pet_files(layout, subject_id):
+    """
+    Return the PET files of a subject.
+
+    :param layout: Layout of the dataset, or the runs found by the fast discovery.
+    :type layout: bids.BIDSLayout or petprep_extract_tacs.utils.scan.PETDataset
+    :param subject_id: Subject label without ``sub-``.
+    :type subject_id: str
+    :return: Paths to the PET files.
+    :rtype: list
+    """
+    if isinstance(layout, PETDataset):
+        return [run["pet_file"] for run in layout.get_runs(subject_id)]
+    return collect_data(layout, participant_label=subject_id)[0]["pet"]
+
+
+def get_pet_runs(layout, subject_id):
+    """
+    Return the PET files of a subject together with their JSON sidecars.
+
+    :param layout: Layout of the dataset, or the runs found by the fast discovery.
+    :type layout: bids.BIDSLayout or petprep_extract_tacs.utils.scan.PETDataset
+    :param subject_id: Subject label without ``sub-``.
+    :type subject_id: str
+    :return: List of dicts with the ``pet_file`` and ``json_file`` of every run.
+    :rtype: list
+    """
+    if isinstance(layout, PETDataset):
+        return layout.get_runs(subject_id)
+    return [
+        {"pet_file": pet_file, "json_file": re.sub(r"\.nii(\.gz)?$", ".json", pet_file)}
+        for pet_file in get_pet_files(layout, subject_id)
+    ]
+
+
+def get_output_dir(args):
+    """
+    Return the derivatives directory the outputs are written to.
+
+    :param args: Parsed command line arguments.
+    :type args: argparse.Namespace
+    :return: ``--output_dir`` if given, otherwise
+        ``<bids_dir>/derivatives/petprep_extract_tacs``.
+    :rtype: str
+    """
+    return getattr(args, "output_dir", None) or os.path.join(
+        args.bids_dir, "derivatives", "petprep_extract_tacs"
+    )
+
+
+def get_n_threads(args):
+    """
+    Return the number of threads a single node may use.
+
+    :param args: Parsed command line arguments.
+    :type args: argparse.Namespace
+    :return: ``--n_threads`` if given, otherwise ``--n_procs``.
+    :rtype: int
+    """
+    return int(getattr(args, "n_threads", None) or getattr(args, "n_procs", 1) or 1)
+
+
 def main(args):
     """
     Runs the PETPrep extract tacs workflow when provided with arguments collected from
     the cli function.
     """
-    # Check whether BIDS directory exists and instantiate BIDSLayout
+    # Check whether BIDS directory exists and instantiate BIDSLayout once; the
+    # index is stored in the cache and reused while the dataset is unchanged
     if os.path.exists(args.bids_dir):
-        if not args.skip_bids_validator:
-            layout = BIDSLayout(args.bids_dir, validate=True)
+        if getattr(args, "fast_discovery", False):
+            # only list the PET runs, without pybids or BIDS validation
+            layout = PETDataset(
+                args.bids_dir,
+                index_file=os.path.join(get_cache_dir(args), "pet_index.json"),
+            )
         else:
-            layout = BIDSLayout(args.bids_dir, validate=False)
+            layout = get_bids_layout(args)
     else:
         raise Exception("BIDS directory does not exist")
 
@@ -129,7 +280,7 @@ def main(args):
             print("One or more subjects contains the sub- string")
         subjects = [subject.replace("sub-", "") for subject in subjects]
         # raise error if supplied subject is not present in dataset
-        partipants = layout.get(return_type="id", target="subject")
+        partipants = layout.get_subjects()
         for subject in subjects:
             if subject not in partipants:
                 raise FileNotFoundError(
@@ -137,7 +288,7 @@ def main(args):
                 )
 
     else:
-        subjects = layout.get(return_type="id", target="subject")
+        subjects = layout.get_subjects()
 
     if args.participant_label_exclude:
         print(f"Removing the following subjects: {args.participant_label_exclude}")
@@ -157,30 +308,25 @@ def main(args):
                 session.replace("ses-", "") for session in args.session_label
             ]
             print("One or more sessions contains the ses- string")
-        sessions_to_exclude = set(layout.get(return_type="id", target="session")) - (
-            set(layout.get(return_type="id", target="session"))
-            & set(args.session_label)
+        sessions_to_exclude = set(layout.get_sessions()) - (
+            set(layout.get_sessions()) & set(args.session_label)
         ) | set(args.session_label_exclude)
     else:
         sessions_to_exclude = args.session_label_exclude
 
     # Create derivatives directories
-    if args.output_dir is None:
-        output_dir = os.path.join(args.bids_dir, "derivatives", "petprep_extract_tacs")
-    else:
-        output_dir = args.output_dir
+    output_dir = get_output_dir(args)
 
     os.makedirs(output_dir, exist_ok=True)
 
-    # Run ANAT workflow
-    anat_main = init_anat_wf(args, subjects)
-    if anat_main._get_all_nodes():
-        # set logging
-        anat_main.run(plugin="MultiProc", plugin_args={"n_procs": int(args.n_procs)})
-
-    # Run PET workflow
+    # Run the anatomical segmentations and the PET workflow as a single graph, so
+    # PET processing that needs no segmentation overlaps with the segmentations
     main = init_petprep_extract_tacs_wf(
-        args, subjects, sessions_to_exclude=sessions_to_exclude
+        args,
+        subjects,
+        sessions_to_exclude=sessions_to_exclude,
+        include_anat=True,
+        layout=layout,
     )
     # determine if this nipype.pipeline.engine.workflows.Workflow is empty
     # if so exit early.
@@ -195,8 +341,6 @@ def main(args):
 
     # Remove temp outputs
     shutil.rmtree(os.path.join(args.bids_dir, "petprep_extract_tacs_wf"))
-    if os.path.exists(os.path.join(args.bids_dir, "anat_wf")):
-        shutil.rmtree(os.path.join(args.bids_dir, "anat_wf"))
 
     # combine multiple runs of tacs if asked
     if args.merge_runs:
@@ -223,115 +367,158 @@ def main(args):
         outfile.write(json_object)
 
 
-def init_anat_wf(args: Union[argparse.Namespace, dict], subject_list: list = []):
+def anat_step_needed(args, subject_id, step):
     """
-    Starts the anatomical workflow for the PETPrep extract tacs workflow by
-    creating nodes with init_single_subject_anat_wf.
+    Whether an anatomical step has to run for a subject.
+
+    :param args: Parsed command line arguments.
+    :type args: argparse.Namespace
+    :param subject_id: Subject label without ``sub-``.
+    :type subject_id: str
+    :param step: Step in :data:`petprep_extract_tacs.utils.anat.ANAT_STEPS`.
+    :type step: str
+    :return: ``False`` when the outputs are up to date and ``--force_anat`` is not
+        given.
+    :rtype: bool
     """
-    from bids import BIDSLayout
-
-    if isinstance(args, dict):
-        args = argparse.Namespace(**args)
-
-    layout = BIDSLayout(args.bids_dir, validate=False)
-
-    anat_wf = Workflow(name="anat_wf", base_dir=args.bids_dir)
-    anat_wf.config["execution"]["remove_unnecessary_outputs"] = "false"
-
-    # Define the subjects to iterate over
-    if not subject_list:
-        subject_list = layout.get(return_type="id", target="subject", suffix="pet")
-
-    # Set up the main workflow to iterate over subjects
-    for subject_id in subject_list:
-        # For each subject, create a subject-specific workflow
-        subject_wf = init_single_subject_anat_wf(args, subject_id)
-        anat_wf.add_nodes([subject_wf])
-
-    return anat_wf
+    if getattr(args, "force_anat", False):
+        return True
+    subject_dir = os.path.join(
+        args.bids_dir, "derivatives", "freesurfer", f"sub-{subject_id}"
+    )
+    if anat_step_is_current(subject_dir, step):
+        print(f"Skipping {step} for sub-{subject_id}, outputs are up to date")
+        return False
+    return True
 
 
-def init_single_subject_anat_wf(args, subject_id):
+def init_anat_nodes(args, subject_id, only_needed=True):
     """
-    Creates an anatomical node for a single subject in the PETPrep extract tacs workflow.
+    Create the anatomical segmentation nodes of a subject that have to run.
+
+    :param args: Parsed command line arguments.
+    :type args: argparse.Namespace
+    :param subject_id: Subject label without ``sub-``.
+    :type subject_id: str
+    :param only_needed: Leave out the steps whose outputs are up to date, see
+        :func:`anat_step_needed`.
+    :type only_needed: bool
+    :return: Dict mapping steps in
+        :data:`petprep_extract_tacs.utils.anat.ANAT_STEPS` onto ``(node, field)``
+        tuples, with an output ``field`` that is set once the step has finished.
+    :rtype: dict
     """
-    from bids import BIDSLayout
-
-    layout = BIDSLayout(args.bids_dir, validate=False)
-
-    # Create a new workflow for this specific subject
-    subject_wf = Workflow(name=f"subject_{subject_id}_wf", base_dir=args.bids_dir)
-    subject_wf.config["execution"]["remove_unnecessary_outputs"] = "false"
-
-    templates = {"fs_subject_dir": "derivatives/freesurfer"}
-
-    selectfiles = Node(
-        SelectFiles(templates, base_directory=args.bids_dir), name="select_files"
-    )
-
-    datasink = Node(
-        DataSink(
-            base_directory=args.bids_dir,
-            container=os.path.join(args.bids_dir, "anat_wf"),
-        ),
-        name="datasink",
-    )
+    subjects_dir = os.path.join(args.bids_dir, "derivatives", "freesurfer")
 
+    interfaces = {}
     if args.gtm is True or args.agtm is True:
-        gtmseg = Node(
-            GTMSeg(subject_id=f"sub-{subject_id}", xcerseg=True), name="gtmseg"
-        )
-
-        subject_wf.connect(
-            [(selectfiles, gtmseg, [("fs_subject_dir", "subjects_dir")])]
-        )
-
+        interfaces["gtm"] = GTMSeg(subject_id=f"sub-{subject_id}", xcerseg=True)
     if args.brainstem is True:
-        segment_bs = Node(SegmentBS(subject_id=f"sub-{subject_id}"), name="segment_bs")
-
-        subject_wf.connect(
-            [(selectfiles, segment_bs, [("fs_subject_dir", "subjects_dir")])]
-        )
-
+        interfaces["brainstem"] = SegmentBS(subject_id=f"sub-{subject_id}")
     if args.thalamicNuclei is True:
-        segment_th = Node(
-            SegmentThalamicNuclei(subject_id=f"sub-{subject_id}"), name="segment_th"
+        interfaces["thalamicNuclei"] = SegmentThalamicNuclei(
+            subject_id=f"sub-{subject_id}"
         )
+    if args.hippocampusAmygdala is True:
+        interfaces["hippocampusAmygdala"] = SegmentHA_T1(subject_id=f"sub-{subject_id}")
 
-        subject_wf.connect(
-            [(selectfiles, segment_th, [("fs_subject_dir", "subjects_dir")])]
-        )
+    nodes = {}
+    for step, interface in interfaces.items():
+        if only_needed and not anat_step_needed(args, subject_id, step):
+            continue
+        name, field = ANAT_NODES[step]
+        interface.inputs.subjects_dir = subjects_dir
+        nodes[step] = (Node(interface, name=name), field)
+    return nodes
 
-    if args.hippocampusAmygdala is True:
-        segment_ha = Node(
-            SegmentHA_T1(subject_id=f"sub-{subject_id}"), name="segment_ha"
-        )
 
-        subject_wf.connect(
-            [(selectfiles, segment_ha, [("fs_subject_dir", "subjects_dir")])]
-        )
+def init_sclimbic_nodes(args, subject_list):
+    """
+    Create the ``mri_sclimbic_seg`` nodes of the raphe and limbic segmentations.
+
+    The segmentations only depend on the anatomy, so they run once per subject
+    rather than once per PET run. Subjects are processed in batches of
+    ``SCLIMBIC_BATCH_SIZE`` by a single call, which loads the model only once.
+
+    :param args: Parsed command line arguments.
+    :type args: argparse.Namespace
+    :param subject_list: Subject labels without ``sub-``.
+    :type subject_list: list
+    :return: List of nodes.
+    :rtype: list
+    """
+    subjects_dir = os.path.join(args.bids_dir, "derivatives", "freesurfer")
+    n_threads = get_n_threads(args)
 
-    #   if args.cvs is True:
-    #       cvs = Node(CVSReg(subject_id = f'sub-{subject_id}'),
-    #                   name = 'cvs')
-    #
-    #       subject_wf.connect([(selectfiles, cvs, [('fs_subject_dir', 'subjects_dir')])
-    #                           ])
+    models = []
+    if getattr(args, "raphe", False) is True:
+        models.append(
+            (
+                "raphe",
+                "raphe+pons",
+                dict(
+                    keep_ac=True,
+                    percentile=99.9,
+                    vmp=True,
+                    model=resource_filename("utils/raphe+pons.n21.d114.h5"),
+                    ctab=resource_filename("utils/raphe+pons.ctab"),
+                ),
+            )
+        )
+    if getattr(args, "limbic", False) is True:
+        models.append(
+            (
+                "limbic",
+                "sclimbic",
+                dict(ctab=resource_filename("utils/sclimbic.ctab")),
+            )
+        )
 
-    return subject_wf
+    nodes = []
+    for step, output_base, params in models:
+        subjects = [
+            f"sub-{subject_id}"
+            for subject_id in subject_list
+            if anat_step_needed(args, subject_id, step)
+        ]
+        for batch, start in enumerate(range(0, len(subjects), SCLIMBIC_BATCH_SIZE)):
+            nodes.append(
+                Node(
+                    MRISclimbicSeg(
+                        subjects=subjects[start : start + SCLIMBIC_BATCH_SIZE],
+                        sd=subjects_dir,
+                        output_base=output_base,
+                        write_volumes=True,
+                        threads=n_threads,
+                        **params,
+                    ),
+                    name=f"segment_{step}_batch{batch}",
+                    n_procs=n_threads,
+                )
+            )
+    return nodes
 
 
 def init_petprep_extract_tacs_wf(
     args: Union[argparse.Namespace, dict],
     subject_list: list = [],
     sessions_to_exclude: list = [],
+    include_anat: bool = False,
+    layout=None,
 ):
-    from bids import BIDSLayout
+    """
+    Creates the PET workflow of all subjects.
 
+    With ``include_anat``, the anatomical segmentations that have to run are part
+    of the same graph and the atlas branches that need them wait for them, so the
+    rest of the PET processing of all subjects overlaps with the segmentations.
+    A single ``layout`` is shared by all subjects, it is built when not given.
+    """
     if isinstance(args, dict):
         args = argparse.Namespace(**args)
 
-    layout = BIDSLayout(args.bids_dir, validate=False)
+    if layout is None:
+        layout = get_bids_layout(args)
 
     petprep_extract_tacs_wf = Workflow(
         name="petprep_extract_tacs_wf", base_dir=args.bids_dir
@@ -340,43 +527,101 @@ def init_petprep_extract_tacs_wf(
 
     # Define the subjects to iterate over
     if not subject_list:
-        subject_list = layout.get(return_type="id", target="subject", suffix="pet")
+        subject_list = layout.get_subjects(suffix="pet")
 
     # sometimes the number of entries for FrameTimesStart and FrameDuration in the json file
     # are not equal to the number of frames in the nifti file or each other. This will
     # cause this pipeline to fail. Here we try to catch this error and notify the user of that
-    # issue while still running the pipeline on valid files.
-
-    # Set up the main workflow to iterate over subjects
+    # issue while still running the pipeline on valid files. Only the headers are
+    # read, for all runs at once, and the outcomes are cached between invocations.
+    runs = [
+        dict(subject=subject_id, **run)
+        for subject_id in subject_list
+        for run in get_pet_runs(layout, subject_id)
+    ]
+    validation = validate_frame_timing(
+        runs, cache_file=os.path.join(get_cache_dir(args), "frame_timing.json")
+    )
+    write_frame_timing_report(
+        validation, os.path.join(get_output_dir(args), "frame_timing.tsv")
+    )
+    timing_errors = {}
+    for row in validation:
+        if row["errors"]:
+            timing_errors.setdefault(row["subject"], []).extend(row["errors"])
+
+    # Set up the main workflow to iterate over subjects, cloning the subject
+    # workflows from templates that are only built once
+    subject_wfs = {}
+    subject_templates = {}
     for subject_id in subject_list:
         try:
-            check_nifti_json_frame_consistency(layout, [subject_id])
+            if subject_id in timing_errors:
+                raise PETFrameTimingError("\n".join(timing_errors[subject_id]))
             # For each subject, create a subject-specific workflow
-            subject_wf = init_single_subject_wf(args, subject_id, sessions_to_exclude)
-            petprep_extract_tacs_wf.add_nodes([subject_wf])
+            subject_wf = init_single_subject_wf(
+                args,
+                subject_id,
+                sessions_to_exclude,
+                include_anat=include_anat,
+                layout=layout,
+                subject_templates=subject_templates,
+            )
+            subject_wfs[f"sub-{subject_id}"] = subject_wf
         except (PETFrameTimingError, KeyError) as err:
             # use warnings to display an error message in red text to the user
             print(f"\033[91m{err}\033[0m")
             print(f"\033[91mSkipping extract tacs on subject: {subject_id}\033[0m")
 
+    # nipype checks the names of all nodes of the workflow whenever nodes are
+    # added, so the subject workflows are added at once
+    petprep_extract_tacs_wf.add_nodes(list(subject_wfs.values()))
+
+    if include_anat:
+        # the sclimbic batches span subjects, so they are connected from the top
+        # level to the raphe/limbic file selection of every subject in the batch
+        sclimbic_nodes = init_sclimbic_nodes(args, list(subject_list))
+        petprep_extract_tacs_wf.add_nodes(sclimbic_nodes)
+        connections = []
+        for node in sclimbic_nodes:
+            step = node.name.split("_")[1]
+            connections.extend(
+                (
+                    node,
+                    subject_wfs[subject],
+                    [("subject_files", f"select_{step}_files.wait")],
+                )
+                for subject in node.inputs.subjects
+                if subject in subject_wfs
+            )
+        petprep_extract_tacs_wf.connect(connections)
+
     return petprep_extract_tacs_wf
 
 
 def init_single_subject_wf(
-    args: Union[argparse.Namespace, dict], subject_id, sessions_to_exclude=[]
+    args: Union[argparse.Namespace, dict],
+    subject_id,
+    sessions_to_exclude=[],
+    include_anat=False,
+    layout=None,
+    subject_templates=None,
 ):
-    from bids import BIDSLayout
+    """
+    Creates the workflow of a single subject.
 
+    The workflow is cloned from a template built for a placeholder subject, see
+    :func:`init_subject_template_wf`, and then set up for the subject. Pass the
+    same ``subject_templates`` dict for all subjects, so the templates are only
+    built once.
+    """
     if isinstance(args, dict):
         args = argparse.Namespace(**args)
 
-    layout = BIDSLayout(args.bids_dir, validate=False)
-
-    # Create a new workflow for this specific subject
-    subject_wf = Workflow(name=f"subject_{subject_id}_wf", base_dir=args.bids_dir)
-    subject_wf.config["execution"]["remove_unnecessary_outputs"] = "false"
+    if layout is None:
+        layout = get_bids_layout(args)
 
-    subject_data = collect_data(layout, participant_label=subject_id)[0]["pet"]
+    subject_data = get_pet_files(layout, subject_id)
 
     # remove any sessions that are to be excluded
     subject_data = [
@@ -395,10 +640,46 @@ def init_single_subject_wf(
     ]
     cleaned_subject_data = [s.replace("_pet", "") for s in cleaned_subject_data]
 
-    inputs = Node(IdentityInterface(fields=["pet_file"]), name="inputs")
-    inputs.iterables = ("pet_file", cleaned_subject_data)
+    # subjects with and without sessions differ in the PET file templates
+    has_sessions = bool(layout.get_sessions(subject=subject_id))
+    if subject_templates is None:
+        subject_templates = {}
+    if has_sessions not in subject_templates:
+        subject_templates[has_sessions] = init_subject_template_wf(
+            args, has_sessions, include_anat=include_anat
+        )
 
-    sessions = layout.get_sessions(subject=subject_id)
+    subject_wf = subject_templates[has_sessions].clone(f"subject_{subject_id}_wf")
+    for node in subject_wf._get_all_nodes():
+        for name, value in node.inputs.get().items():
+            if isinstance(value, str) and TEMPLATE_SUBJECT in value:
+                setattr(node.inputs, name, value.replace(TEMPLATE_SUBJECT, subject_id))
+    subject_wf.get_node("inputs").iterables = ("pet_file", cleaned_subject_data)
+
+    # leave out segmentations whose outputs are already present and up to date
+    for step, (name, _) in ANAT_NODES.items():
+        node = subject_wf.get_node(name)
+        if node is not None and not anat_step_needed(args, subject_id, step):
+            subject_wf.remove_nodes([node])
+
+    return subject_wf
+
+
+def init_subject_template_wf(args, sessions, include_anat=False):
+    """
+    Creates the workflow of a placeholder subject, cloned for every subject.
+
+    Subject specific paths and values are built from ``TEMPLATE_SUBJECT``, which
+    :func:`init_single_subject_wf` replaces in the clones. All segmentation nodes
+    are included, the clones leave out the ones that are up to date.
+    """
+    subject_id = TEMPLATE_SUBJECT
+
+    # Create a new workflow for this specific subject
+    subject_wf = Workflow(name="subject_template_wf", base_dir=args.bids_dir)
+    subject_wf.config["execution"]["remove_unnecessary_outputs"] = "false"
+
+    inputs = Node(IdentityInterface(fields=["pet_file"]), name="inputs")
 
     templates = {
         "pet_file": (
@@ -411,9 +692,9 @@ def init_single_subject_wf(
             if not sessions
             else "s*/s*/pet/*{pet_file}_pet.json"
         ),
-        "brainmask_file": f"derivatives/freesurfer/sub-{subject_id}/mri/T1.mgz",
-        "wm_file": f"derivatives/freesurfer/sub-{subject_id}/mri/wmparc.mgz",
-        "orig_file": f"derivatives/freesurfer/sub-{subject_id}/mri/orig.mgz",
+        "brainmask_file": "derivatives/freesurfer/sub-{subject_id}/mri/T1.mgz",
+        "wm_file": "derivatives/freesurfer/sub-{subject_id}/mri/wmparc.mgz",
+        "orig_file": "derivatives/freesurfer/sub-{subject_id}/mri/orig.mgz",
         "fs_subject_dir": "derivatives/freesurfer",
     }
 
@@ -431,38 +712,113 @@ def init_single_subject_wf(
     selectfiles = Node(
         SelectFiles(templates, base_directory=args.bids_dir), name="select_files"
     )
+    selectfiles.inputs.subject_id = subject_id
+
+    # subject level FreeSurfer volumes are also selected outside of the PET run
+    # iterables, so they are converted to NIfTI once per subject
+    anat_templates = {
+        key: value for key, value in templates.items() if "{pet_file}" not in value
+    }
+    select_anat_files = Node(
+        SelectFiles(anat_templates, base_directory=args.bids_dir),
+        name="select_anat_files",
+    )
+    select_anat_files.inputs.subject_id = subject_id
+
+    def update_templates(entries):
+        templates.update(entries)
+        anat_templates.update(
+            {key: value for key, value in entries.items() if "{pet_file}" not in value}
+        )
+
+    # segmentations computed in this workflow, see init_anat_nodes
+    anat_nodes = (
+        init_anat_nodes(args, subject_id, only_needed=False) if include_anat else {}
+    )
+
+    def select_step_files(step, entries):
+        # outputs of an anatomical step are selected once per subject, after the
+        # step ran when it is part of this workflow
+        node = Node(
+            SelectFiles(entries, base_directory=args.bids_dir),
+            name=f"select_{step}_files",
+        )
+        node.inputs.subject_id = subject_id
+        node.inputs.add_trait("wait", traits.Any)
+        if step in anat_nodes:
+            anat_node, field = anat_nodes[step]
+            subject_wf.connect(anat_node, field, node, "wait")
+        return node
+
+    def convert_node(out_name, name):
+        node = Node(
+            Function(
+                input_names=["in_file", "out_name", "cache_dir"],
+                output_names=["out_file"],
+                function=convert_anat_volume,
+            ),
+            name=name,
+        )
+        node.inputs.out_name = out_name
+        node.inputs.cache_dir = get_cache_dir(args, subject_id)
+        return node
 
     # Define nodes for extraction of tacs
 
+    # registrations are cached by the content of the TWA and the brainmask, so
+    # reprocessing a run does not run mri_coreg again
     coreg_pet_to_t1w = Node(
-        MRICoreg(
-            out_lta_file="from-pet_to-t1w_reg.lta", subject_id=f"sub-{subject_id}"
+        Function(
+            input_names=[
+                "source_file",
+                "reference_file",
+                "subjects_dir",
+                "subject_id",
+                "cache_dir",
+            ],
+            output_names=["out_lta_file"],
+            function=register_pet_to_t1w,
         ),
         name="coreg_pet_to_t1w",
     )
+    coreg_pet_to_t1w.inputs.subject_id = f"sub-{subject_id}"
+    coreg_pet_to_t1w.inputs.cache_dir = get_cache_dir(args, subject_id)
 
     create_time_weighted_average = Node(
         Function(
-            input_names=["pet_file", "json_file"],
-            output_names=["out_file"],
+            input_names=["pet_file", "json_file", "mem_mb", "windows"],
+            output_names=["out_file", "window_files"],
             function=create_weighted_average_pet,
         ),
         name="create_weighted_average_pet",
     )
+    create_time_weighted_average.inputs.mem_mb = getattr(args, "chunk_mem_mb", None)
+    create_time_weighted_average.inputs.windows = getattr(args, "twa_window", None)
 
-    move_pet_to_anat = Node(
-        ApplyVolTransform(transformed_file="space-T1w_pet.nii.gz"),
-        name="move_pet_to_anat",
-    )
+    n_threads = get_n_threads(args)
 
     move_twa_to_anat = Node(
-        ApplyVolTransform(transformed_file="space-T1w_desc-twa_pet.nii.gz"),
+        Function(
+            input_names=[
+                "source_file",
+                "target_file",
+                "lta_file",
+                "out_file",
+                "n_threads",
+                "mem_mb",
+            ],
+            output_names=["transformed_file"],
+            function=resample_pet_to_anat,
+        ),
         name="move_twa_to_anat",
+        n_procs=n_threads,
     )
+    move_twa_to_anat.inputs.out_file = "space-T1w_desc-twa_pet.nii.gz"
+    move_twa_to_anat.inputs.n_threads = n_threads
+    move_twa_to_anat.inputs.mem_mb = getattr(args, "chunk_mem_mb", None)
 
-    convert_brainmask = Node(
-        MRIConvert(out_file="space-T1w_desc-brain_mask.nii.gz"),
-        name="convert_brainmask",
+    convert_brainmask = convert_node(
+        "space-T1w_desc-brain_mask.nii.gz", "convert_brainmask"
     )
 
     plot_registration = Node(
@@ -494,10 +850,6 @@ def init_single_subject_wf(
                 coreg_pet_to_t1w,
                 [("out_file", "source_file")],
             ),
-            (coreg_pet_to_t1w, move_pet_to_anat, [("out_lta_file", "lta_file")]),
-            (selectfiles, move_pet_to_anat, [("brainmask_file", "target_file")]),
-            (selectfiles, move_pet_to_anat, [("pet_file", "source_file")]),
-            # (move_pet_to_anat, datasink, [('transformed_file', 'datasink.@transformed_file')]),
             (coreg_pet_to_t1w, datasink, [("out_lta_file", "datasink.@out_lta_file")]),
             (
                 create_time_weighted_average,
@@ -507,7 +859,7 @@ def init_single_subject_wf(
             (selectfiles, move_twa_to_anat, [("brainmask_file", "target_file")]),
             (coreg_pet_to_t1w, move_twa_to_anat, [("out_lta_file", "lta_file")]),
             # (move_twa_to_anat, datasink, [('transformed_file', 'datasink.@transformed_twa_file')]),
-            (selectfiles, convert_brainmask, [("brainmask_file", "in_file")]),
+            (select_anat_files, convert_brainmask, [("brainmask_file", "in_file")]),
             (convert_brainmask, datasink, [("out_file", "datasink.@brainmask_file")]),
             (convert_brainmask, plot_registration, [("out_file", "fixed_image")]),
             (
@@ -519,119 +871,166 @@ def init_single_subject_wf(
         ]
     )
 
-    if args.surface is True:
-        vol2surf_lh = Node(
-            SampleToSurface(
-                hemi="lh",
-                sampling_method="point",
-                sampling_range=0.5,
-                sampling_units="frac",
-                cortex_mask=True,
-                target_subject="fsaverage",
-                out_file="space-fsaverage_hemi-L_pet.nii.gz",
-            ),
-            name="vol2surf_lh",
+    if getattr(args, "twa_window", None):
+        subject_wf.connect(
+            [
+                (
+                    create_time_weighted_average,
+                    datasink,
+                    [("window_files", "datasink.@twa_windows")],
+                )
+            ]
         )
 
-        vol2surf_rh = Node(
-            SampleToSurface(
-                hemi="rh",
-                sampling_method="point",
-                sampling_range=0.5,
-                sampling_units="frac",
-                cortex_mask=True,
-                target_subject="fsaverage",
-                out_file="space-fsaverage_hemi-R_pet.nii.gz",
+    if args.surface is True:
+        # sample both hemispheres on fsaverage from a single read of the PET
+        vol2surf = Node(
+            Function(
+                input_names=[
+                    "pet_file",
+                    "lta_file",
+                    "subjects_dir",
+                    "subject_id",
+                    "anat_file",
+                    "cache_dir",
+                    "mem_mb",
+                    "smooth_fwhm",
+                    "smooth_cache_dir",
+                ],
+                output_names=["lh_file", "rh_file"],
+                function=vol2surf_fsaverage,
             ),
-            name="vol2surf_rh",
+            name="vol2surf",
         )
-
+        vol2surf.inputs.subject_id = f"sub-{subject_id}"
+        vol2surf.inputs.cache_dir = get_cache_dir(args, subject_id)
+        vol2surf.inputs.mem_mb = getattr(args, "chunk_mem_mb", None)
         if args.surface_smooth is not None:
-            vol2surf_lh.inputs.smooth_surf = args.surface_smooth
-            vol2surf_lh.inputs.out_file = (
-                f"space-fsaverage_hemi-L_desc-sm{args.surface_smooth}_pet.nii.gz"
-            )
-            vol2surf_rh.inputs.smooth_surf = args.surface_smooth
-            vol2surf_rh.inputs.out_file = (
-                f"space-fsaverage_hemi-R_desc-sm{args.surface_smooth}_pet.nii.gz"
-            )
+            # the fsaverage smoothing operator is shared by all subjects
+            vol2surf.inputs.smooth_fwhm = args.surface_smooth
+            vol2surf.inputs.smooth_cache_dir = get_cache_dir(args)
 
         subject_wf.connect(
             [
-                (selectfiles, vol2surf_lh, [("pet_file", "source_file")]),
-                (selectfiles, vol2surf_lh, [("fs_subject_dir", "subjects_dir")]),
-                (coreg_pet_to_t1w, vol2surf_lh, [("out_lta_file", "reg_file")]),
-                (vol2surf_lh, datasink, [("out_file", "datasink.@lh_pet")]),
-                (selectfiles, vol2surf_rh, [("pet_file", "source_file")]),
-                (selectfiles, vol2surf_rh, [("fs_subject_dir", "subjects_dir")]),
-                (coreg_pet_to_t1w, vol2surf_rh, [("out_lta_file", "reg_file")]),
-                (vol2surf_rh, datasink, [("out_file", "datasink.@rh_pet")]),
+                (selectfiles, vol2surf, [("pet_file", "pet_file")]),
+                (selectfiles, vol2surf, [("fs_subject_dir", "subjects_dir")]),
+                (selectfiles, vol2surf, [("brainmask_file", "anat_file")]),
+                (coreg_pet_to_t1w, vol2surf, [("out_lta_file", "lta_file")]),
+                (vol2surf, datasink, [("lh_file", "datasink.@lh_pet")]),
+                (vol2surf, datasink, [("rh_file", "datasink.@rh_pet")]),
             ]
         )
 
     if args.volume is True:
+        update_templates(
+            {
+                "xfm_file": (
+                    "derivatives/freesurfer/sub-{subject_id}/mri/transforms/"
+                    "talairach.xfm"
+                )
+            }
+        )
+
+        # compose the registration with talairach.xfm and interpolate once; the
+        # smoothed volume is written from the same resampled frames
         vol2vol = Node(
-            ApplyVolTransform(
-                transformed_file="space-mni305_pet.nii.gz", tal=True, tal_resolution=2
+            Function(
+                input_names=[
+                    "source_file",
+                    "lta_file",
+                    "xfm_file",
+                    "smooth_fwhm",
+                    "cache_dir",
+                    "n_threads",
+                    "mem_mb",
+                    "anat_file",
+                    "mask_files",
+                ],
+                output_names=["transformed_file", "smoothed_file", "masked_file"],
+                function=resample_pet_to_mni305,
             ),
             name="vol2vol",
+            n_procs=n_threads,
         )
+        vol2vol.inputs.smooth_fwhm = args.volume_smooth
+        vol2vol.inputs.cache_dir = get_cache_dir(args, subject_id)
+        vol2vol.inputs.n_threads = n_threads
+        vol2vol.inputs.mem_mb = getattr(args, "chunk_mem_mb", None)
 
         subject_wf.connect(
             [
                 (selectfiles, vol2vol, [("pet_file", "source_file")]),
-                (selectfiles, vol2vol, [("fs_subject_dir", "subjects_dir")]),
-                (coreg_pet_to_t1w, vol2vol, [("out_lta_file", "reg_file")]),
+                (selectfiles, vol2vol, [("xfm_file", "xfm_file")]),
+                (coreg_pet_to_t1w, vol2vol, [("out_lta_file", "lta_file")]),
                 (vol2vol, datasink, [("transformed_file", "datasink.@mni305_pet")]),
             ]
         )
 
         if args.volume_smooth is not None:
-            smooth_vol = Node(
-                MRIConvert(
-                    out_file=f"space-mni305_desc-sm{args.volume_smooth}_pet.nii.gz",
-                    fwhm=args.volume_smooth,
-                ),
-                name="smooth_vol",
-            )
-
             subject_wf.connect(
-                [
-                    (vol2vol, smooth_vol, [("transformed_file", "in_file")]),
-                    (smooth_vol, datasink, [("out_file", "datasink.@mni305_sm_pet")]),
-                ]
+                [(vol2vol, datasink, [("smoothed_file", "datasink.@mni305_sm_pet")])]
             )
 
     if args.gtm is True or args.agtm is True:
 
-        templates.update(
-            {"gtm_file": f"derivatives/freesurfer/sub-{subject_id}/mri/gtmseg.mgz"}
+        select_gtm_files = select_step_files(
+            "gtm",
+            {
+                "gtm_file": "derivatives/freesurfer/sub-{subject_id}/mri/gtmseg.mgz",
+                "gtm_stats": "derivatives/freesurfer/sub-{subject_id}/stats/gtmseg.stats",
+            },
         )
-        templates.update(
-            {"gtm_stats": f"derivatives/freesurfer/sub-{subject_id}/stats/gtmseg.stats"}
+
+        # the segment fractions in PET space and the mask are computed once per
+        # run and shared by every GTM variant, which each stream the frames
+        gtm_prep = Node(
+            Function(
+                input_names=[
+                    "in_file",
+                    "segmentation",
+                    "reg_file",
+                    "cache_dir",
+                    "mem_mb",
+                ],
+                output_names=["prep_file"],
+                function=prepare_gtm,
+            ),
+            name="gtm_prep",
         )
+        gtm_prep.inputs.cache_dir = get_cache_dir(args, subject_id)
+        gtm_prep.inputs.mem_mb = getattr(args, "chunk_mem_mb", None)
 
+        # regional means without PVC only need the segment fractions in PET
+        # space, so mri_gtmpvc is not run for them
         gtmpvc = Node(
-            GTMPVC(
-                default_seg_merge=True,
-                auto_mask=(1, 0.1),
-                no_pvc=True,
-                pvc_dir="nopvc",
-                no_rescale=True,
+            Function(
+                input_names=[
+                    "in_file",
+                    "segmentation",
+                    "reg_file",
+                    "cache_dir",
+                    "prep_file",
+                    "mem_mb",
+                ],
+                output_names=["nopvc_file", "gtm_stats"],
+                function=gtm_nopvc,
             ),
             name="gtmpvc",
         )
+        gtmpvc.inputs.cache_dir = get_cache_dir(args, subject_id)
+        gtmpvc.inputs.mem_mb = getattr(args, "chunk_mem_mb", None)
 
         create_gtmseg_tacs = Node(
             Function(
-                input_names=["in_file", "json_file", "gtm_stats", "pvc_dir"],
+                input_names=["in_file", "json_file", "gtm_stats", "pvc_dir", "mem_mb"],
                 output_names=["out_file"],
                 function=gtm_to_tacs,
             ),
             name="create_gtmseg_tacs",
         )
+        create_gtmseg_tacs.inputs.mem_mb = getattr(args, "chunk_mem_mb", None)
 
-        create_gtmseg_tacs.inputs.pvc_dir = gtmpvc.inputs.pvc_dir
+        create_gtmseg_tacs.inputs.pvc_dir = "nopvc"
 
         create_gtmseg_stats = Node(
             Function(
@@ -651,26 +1050,30 @@ def init_single_subject_wf(
             name="create_gtmseg_dsegtsv",
         )
 
-        convert_gtmseg_file = Node(
-            MRIConvert(out_file="seg-gtmseg_dseg.nii.gz"), name="convert_gtmseg_file"
+        convert_gtmseg_file = convert_node(
+            "seg-gtmseg_dseg.nii.gz", "convert_gtmseg_file"
         )
 
         subject_wf.connect(
             [
+                (selectfiles, gtm_prep, [("pet_file", "in_file")]),
+                (select_gtm_files, gtm_prep, [("gtm_file", "segmentation")]),
+                (coreg_pet_to_t1w, gtm_prep, [("out_lta_file", "reg_file")]),
+                (gtm_prep, gtmpvc, [("prep_file", "prep_file")]),
                 (selectfiles, gtmpvc, [("pet_file", "in_file")]),
-                (selectfiles, gtmpvc, [("gtm_file", "segmentation")]),
+                (select_gtm_files, gtmpvc, [("gtm_file", "segmentation")]),
                 (coreg_pet_to_t1w, gtmpvc, [("out_lta_file", "reg_file")]),
                 (gtmpvc, create_gtmseg_tacs, [("nopvc_file", "in_file")]),
                 (gtmpvc, create_gtmseg_tacs, [("gtm_stats", "gtm_stats")]),
                 (selectfiles, create_gtmseg_tacs, [("json_file", "json_file")]),
                 (create_gtmseg_tacs, datasink, [("out_file", "datasink.@gtmseg_tacs")]),
-                (selectfiles, create_gtmseg_stats, [("gtm_stats", "gtm_stats")]),
+                (select_gtm_files, create_gtmseg_stats, [("gtm_stats", "gtm_stats")]),
                 (
                     create_gtmseg_stats,
                     datasink,
                     [("out_file", "datasink.@gtmseg_stats")],
                 ),
-                (selectfiles, convert_gtmseg_file, [("gtm_file", "in_file")]),
+                (select_gtm_files, convert_gtmseg_file, [("gtm_file", "in_file")]),
                 (
                     convert_gtmseg_file,
                     datasink,
@@ -687,34 +1090,57 @@ def init_single_subject_wf(
 
     if args.agtm is True and args.psf is not None:
 
-        templates.update(
-            {"gtm_file": f"derivatives/freesurfer/sub-{subject_id}/mri/gtmseg.mgz"}
-        )
-
+        # search the PSF on the time-weighted average, evaluating candidate FWHMs
+        # in parallel, then solve the GTM of all frames with the best one
         agtmpvc_init = Node(
-            GTMPVC(
-                auto_mask=(1, 0.1),
-                num_threads=1,
-                opt_seg_merge=True,
-                optimization_schema="1D",
-                psf=args.psf,
-                opt_tol=(4, 10e-6, 0.02),
-                opt_brain=True,
-                pvc_dir="agtm",
-                no_rescale=True,
+            Function(
+                input_names=[
+                    "in_file",
+                    "segmentation",
+                    "reg_file",
+                    "psf",
+                    "n_threads",
+                    "cache_dir",
+                    "json_file",
+                    "store_file",
+                    "prep_file",
+                    "mem_mb",
+                ],
+                output_names=["opt_params"],
+                function=agtm_psf,
             ),
             name="agtmpvc_init",
-        )
+            n_procs=n_threads,
+        )
+        agtmpvc_init.inputs.psf = args.psf
+        agtmpvc_init.inputs.n_threads = n_threads
+        agtmpvc_init.inputs.cache_dir = get_cache_dir(args, subject_id)
+        agtmpvc_init.inputs.mem_mb = getattr(args, "chunk_mem_mb", None)
+        if not getattr(args, "no_psf_warm_start", False):
+            agtmpvc_init.inputs.store_file = os.path.join(
+                get_cache_dir(args), "agtm_psf_store.json"
+            )
 
         agtmpvc = Node(
-            GTMPVC(
-                default_seg_merge=True,
-                auto_mask=(1, 0.1),
-                pvc_dir="agtm",
-                no_rescale=True,
+            Function(
+                input_names=[
+                    "in_file",
+                    "segmentation",
+                    "reg_file",
+                    "psf_col",
+                    "psf_row",
+                    "psf_slice",
+                    "cache_dir",
+                    "mem_mb",
+                    "prep_file",
+                ],
+                output_names=["gtm_file", "gtm_stats"],
+                function=gtm_pvc,
             ),
             name="agtmpvc",
         )
+        agtmpvc.inputs.cache_dir = get_cache_dir(args, subject_id)
+        agtmpvc.inputs.mem_mb = getattr(args, "chunk_mem_mb", None)
 
         opt_fwhm = Node(
             Function(
@@ -727,20 +1153,24 @@ def init_single_subject_wf(
 
         create_agtmseg_tacs = Node(
             Function(
-                input_names=["in_file", "json_file", "gtm_stats", "pvc_dir"],
+                input_names=["in_file", "json_file", "gtm_stats", "pvc_dir", "mem_mb"],
                 output_names=["out_file"],
                 function=gtm_to_tacs,
             ),
             name="create_agtmseg_tacs",
         )
+        create_agtmseg_tacs.inputs.mem_mb = getattr(args, "chunk_mem_mb", None)
 
-        create_agtmseg_tacs.inputs.pvc_dir = agtmpvc.inputs.pvc_dir
+        create_agtmseg_tacs.inputs.pvc_dir = "agtm"
 
         subject_wf.connect(
             [
                 (create_time_weighted_average, agtmpvc_init, [("out_file", "in_file")]),
-                (selectfiles, agtmpvc_init, [("gtm_file", "segmentation")]),
+                (select_gtm_files, agtmpvc_init, [("gtm_file", "segmentation")]),
                 (coreg_pet_to_t1w, agtmpvc_init, [("out_lta_file", "reg_file")]),
+                (selectfiles, agtmpvc_init, [("json_file", "json_file")]),
+                (gtm_prep, agtmpvc_init, [("prep_file", "prep_file")]),
+                (gtm_prep, agtmpvc, [("prep_file", "prep_file")]),
                 (agtmpvc_init, opt_fwhm, [("opt_params", "opt_params")]),
                 (
                     opt_fwhm,
@@ -752,7 +1182,7 @@ def init_single_subject_wf(
                     ],
                 ),
                 (selectfiles, agtmpvc, [("pet_file", "in_file")]),
-                (selectfiles, agtmpvc, [("gtm_file", "segmentation")]),
+                (select_gtm_files, agtmpvc, [("gtm_file", "segmentation")]),
                 (coreg_pet_to_t1w, agtmpvc, [("out_lta_file", "reg_file")]),
                 (agtmpvc, create_agtmseg_tacs, [("gtm_file", "in_file")]),
                 (agtmpvc, create_agtmseg_tacs, [("gtm_stats", "gtm_stats")]),
@@ -766,75 +1196,34 @@ def init_single_subject_wf(
             ]
         )
 
+    # Segmentations whose TACs are extracted together by a single extract_tacs node,
+    # as (seg_prefix, ctab_file, source node, source field, write morph/dseg tables)
+    segmentations = []
+
     if args.brainstem is True:
 
-        templates.update(
+        select_bs_files = select_step_files(
+            "brainstem",
             {
-                "bs_labels_voxel": f"derivatives/freesurfer/sub-{subject_id}/mri/brainstemSsLabels.v13.FSvoxelSpace.mgz"
-            }
-        )
-
-        segment_bs = Node(SegmentBS(subject_id=f"sub-{subject_id}"), name="segment_bs")
-
-        segstats_bs = Node(
-            SegStats(
-                exclude_id=0,
-                default_color_table=True,
-                avgwf_txt_file="seg-brainstem_tacs.txt",
-                ctab_out_file="seg-brainstem_dseg.ctab",
-                summary_file="seg-brainstem_morph.txt",
-            ),
-            name="segstats_bs",
-        )
-
-        create_bs_tacs = Node(
-            Function(
-                input_names=["avgwf_file", "ctab_file", "json_file"],
-                output_names=["out_file"],
-                function=avgwf_to_tacs,
-            ),
-            name="create_bs_tacs",
-        )
-
-        create_bs_stats = Node(
-            Function(
-                input_names=["summary_file"],
-                output_names=["out_file"],
-                function=summary_to_stats,
-            ),
-            name="create_bs_stats",
+                "bs_labels_voxel": "derivatives/freesurfer/sub-{subject_id}/mri/brainstemSsLabels.v13.FSvoxelSpace.mgz"
+            },
         )
 
-        create_bs_dsegtsv = Node(
-            Function(
-                input_names=["ctab_file"],
-                output_names=["out_file"],
-                function=ctab_to_dsegtsv,
-            ),
-            name="create_bs_dsegtsv",
+        segmentations.append(
+            ("seg-brainstem", None, select_bs_files, "bs_labels_voxel", True)
         )
 
-        convert_bs_seg_file = Node(
-            MRIConvert(out_file="seg-brainstem_dseg.nii.gz"),
-            name="convert_bs_seg_file",
+        convert_bs_seg_file = convert_node(
+            "seg-brainstem_dseg.nii.gz", "convert_bs_seg_file"
         )
 
         subject_wf.connect(
             [
-                (selectfiles, segstats_bs, [("bs_labels_voxel", "segmentation_file")]),
-                (move_pet_to_anat, segstats_bs, [("transformed_file", "in_file")]),
                 (
-                    segstats_bs,
-                    create_bs_tacs,
-                    [("avgwf_txt_file", "avgwf_file"), ("ctab_out_file", "ctab_file")],
+                    select_bs_files,
+                    convert_bs_seg_file,
+                    [("bs_labels_voxel", "in_file")],
                 ),
-                (selectfiles, create_bs_tacs, [("json_file", "json_file")]),
-                (segstats_bs, create_bs_stats, [("summary_file", "summary_file")]),
-                (segstats_bs, create_bs_dsegtsv, [("ctab_out_file", "ctab_file")]),
-                (selectfiles, convert_bs_seg_file, [("bs_labels_voxel", "in_file")]),
-                (create_bs_tacs, datasink, [("out_file", "datasink")]),
-                (create_bs_stats, datasink, [("out_file", "datasink.@bs_stats")]),
-                (create_bs_dsegtsv, datasink, [("out_file", "datasink.@bs_dseg")]),
                 (
                     convert_bs_seg_file,
                     datasink,
@@ -845,78 +1234,28 @@ def init_single_subject_wf(
 
     if args.thalamicNuclei is True:
 
-        templates.update(
+        select_th_files = select_step_files(
+            "thalamicNuclei",
             {
-                "thalamic_labels_voxel": f"derivatives/freesurfer/sub-{subject_id}/mri/ThalamicNuclei.v13.T1.FSvoxelSpace.mgz"
-            }
+                "thalamic_labels_voxel": "derivatives/freesurfer/sub-{subject_id}/mri/ThalamicNuclei.v13.T1.FSvoxelSpace.mgz"
+            },
         )
 
-        segstats_th = Node(
-            SegStats(
-                exclude_id=0,
-                default_color_table=True,
-                avgwf_txt_file="seg-thalamus_tacs.txt",
-                ctab_out_file="seg-thalamus_dseg.ctab",
-                summary_file="seg-thalamus_morph.txt",
-            ),
-            name="segstats_th",
+        segmentations.append(
+            ("seg-thalamus", None, select_th_files, "thalamic_labels_voxel", True)
         )
 
-        create_th_tacs = Node(
-            Function(
-                input_names=["avgwf_file", "ctab_file", "json_file"],
-                output_names=["out_file"],
-                function=avgwf_to_tacs,
-            ),
-            name="create_th_tacs",
-        )
-
-        create_th_stats = Node(
-            Function(
-                input_names=["summary_file"],
-                output_names=["out_file"],
-                function=summary_to_stats,
-            ),
-            name="create_th_stats",
-        )
-
-        create_th_dsegtsv = Node(
-            Function(
-                input_names=["ctab_file"],
-                output_names=["out_file"],
-                function=ctab_to_dsegtsv,
-            ),
-            name="create_th_dsegtsv",
-        )
-
-        convert_th_seg_file = Node(
-            MRIConvert(out_file="seg-thalamus_dseg.nii.gz"), name="convert_th_seg_file"
+        convert_th_seg_file = convert_node(
+            "seg-thalamus_dseg.nii.gz", "convert_th_seg_file"
         )
 
         subject_wf.connect(
             [
                 (
-                    selectfiles,
-                    segstats_th,
-                    [("thalamic_labels_voxel", "segmentation_file")],
-                ),
-                (move_pet_to_anat, segstats_th, [("transformed_file", "in_file")]),
-                (
-                    segstats_th,
-                    create_th_tacs,
-                    [("avgwf_txt_file", "avgwf_file"), ("ctab_out_file", "ctab_file")],
-                ),
-                (selectfiles, create_th_tacs, [("json_file", "json_file")]),
-                (segstats_th, create_th_stats, [("summary_file", "summary_file")]),
-                (segstats_th, create_th_dsegtsv, [("ctab_out_file", "ctab_file")]),
-                (
-                    selectfiles,
+                    select_th_files,
                     convert_th_seg_file,
                     [("thalamic_labels_voxel", "in_file")],
                 ),
-                (create_th_tacs, datasink, [("out_file", "datasink.@th_tacs")]),
-                (create_th_stats, datasink, [("out_file", "datasink.@th_stats")]),
-                (create_th_dsegtsv, datasink, [("out_file", "datasink.@th_dseg")]),
                 (
                     convert_th_seg_file,
                     datasink,
@@ -927,314 +1266,93 @@ def init_single_subject_wf(
 
     if args.hippocampusAmygdala is True:
 
-        templates.update(
+        select_ha_files = select_step_files(
+            "hippocampusAmygdala",
             {
-                "lh_hippoAmygLabels": f"derivatives/freesurfer/sub-{subject_id}/mri/lh.hippoAmygLabels-T1.v22.FSvoxelSpace.mgz",
-                "rh_hippoAmygLabels": f"derivatives/freesurfer/sub-{subject_id}/mri/rh.hippoAmygLabels-T1.v22.FSvoxelSpace.mgz",
-            }
-        )
-
-        segstats_ha_lh = Node(
-            SegStats(
-                exclude_id=0,
-                default_color_table=True,
-                avgwf_txt_file="hemi-L_seg-hippocampusAmygdala_tacs.txt",
-                ctab_out_file="hemi-L_seg-hippocampusAmygdala_dseg.ctab",
-                summary_file="hemi-L_seg-hippocampusAmygdala_morph.txt",
-            ),
-            name="segstats_ha_lh",
-        )
-
-        create_ha_tacs_lh = Node(
-            Function(
-                input_names=["avgwf_file", "ctab_file", "json_file"],
-                output_names=["out_file"],
-                function=avgwf_to_tacs,
-            ),
-            name="create_ha_tacs_lh",
-        )
-
-        create_ha_stats_lh = Node(
-            Function(
-                input_names=["summary_file"],
-                output_names=["out_file"],
-                function=summary_to_stats,
-            ),
-            name="create_ha_stats_lh",
-        )
-
-        create_ha_dsegtsv_lh = Node(
-            Function(
-                input_names=["ctab_file"],
-                output_names=["out_file"],
-                function=ctab_to_dsegtsv,
-            ),
-            name="create_ha_dsegtsv_lh",
-        )
-
-        convert_ha_seg_file_lh = Node(
-            MRIConvert(out_file="hemi-L_seg-hippocampusAmygdala_dseg.nii.gz"),
-            name="convert_ha_seg_file_lh",
-        )
-
-        segstats_ha_rh = Node(
-            SegStats(
-                exclude_id=0,
-                default_color_table=True,
-                avgwf_txt_file="hemi-R_seg-hippocampusAmygdala_tacs.txt",
-                ctab_out_file="hemi-R_seg-hippocampusAmygdala_dseg.ctab",
-                summary_file="hemi-R_seg-hippocampusAmygdala_morph.txt",
-            ),
-            name="segstats_ha_rh",
-        )
-
-        create_ha_tacs_rh = Node(
-            Function(
-                input_names=["avgwf_file", "ctab_file", "json_file"],
-                output_names=["out_file"],
-                function=avgwf_to_tacs,
-            ),
-            name="create_ha_tacs_rh",
-        )
-
-        create_ha_stats_rh = Node(
-            Function(
-                input_names=["summary_file"],
-                output_names=["out_file"],
-                function=summary_to_stats,
-            ),
-            name="create_ha_stats_rh",
+                "lh_hippoAmygLabels": "derivatives/freesurfer/sub-{subject_id}/mri/lh.hippoAmygLabels-T1.v22.FSvoxelSpace.mgz",
+                "rh_hippoAmygLabels": "derivatives/freesurfer/sub-{subject_id}/mri/rh.hippoAmygLabels-T1.v22.FSvoxelSpace.mgz",
+            },
         )
 
-        create_ha_dsegtsv_rh = Node(
-            Function(
-                input_names=["ctab_file"],
-                output_names=["out_file"],
-                function=ctab_to_dsegtsv,
-            ),
-            name="create_ha_dsegtsv_rh",
+        convert_ha_seg_file_lh = convert_node(
+            "hemi-L_seg-hippocampusAmygdala_dseg.nii.gz", "convert_ha_seg_file_lh"
         )
 
-        convert_ha_seg_file_rh = Node(
-            MRIConvert(out_file="hemi-R_seg-hippocampusAmygdala_dseg.nii.gz"),
-            name="convert_ha_seg_file_rh",
+        convert_ha_seg_file_rh = convert_node(
+            "hemi-R_seg-hippocampusAmygdala_dseg.nii.gz", "convert_ha_seg_file_rh"
         )
 
         merge_seg_files = Node(Merge(2), name="merge")
 
-        combine_ha_lr_dseg = Node(
-            Concatenate(
-                concatenated_file="seg-hippocampusAmygdala_dseg.nii.gz", combine=True
-            ),
-            name="combine_ha_lr_dseg",
-        )
-
-        segstats_ha = Node(
-            SegStats(
-                exclude_id=0,
-                default_color_table=True,
-                avgwf_txt_file="seg-hippocampusAmygdala_tacs.txt",
-                ctab_out_file="seg-hippocampusAmygdala_dseg.ctab",
-                summary_file="seg-hippocampusAmygdala_morph.txt",
-            ),
-            name="segstats_ha",
-        )
-
-        create_ha_tacs = Node(
-            Function(
-                input_names=["avgwf_file", "ctab_file", "json_file"],
-                output_names=["out_file"],
-                function=avgwf_to_tacs,
-            ),
-            name="create_ha_tacs",
-        )
-
-        create_ha_stats = Node(
-            Function(
-                input_names=["summary_file"],
-                output_names=["out_file"],
-                function=summary_to_stats,
-            ),
-            name="create_ha_stats",
-        )
-
-        create_ha_dsegtsv = Node(
-            Function(
-                input_names=["ctab_file"],
-                output_names=["out_file"],
-                function=ctab_to_dsegtsv,
-            ),
-            name="create_ha_dsegtsv",
+        combine_ha_lr_dseg = convert_node(
+            "seg-hippocampusAmygdala_dseg.nii.gz", "combine_ha_lr_dseg"
         )
 
-        subject_wf.connect(
+        # the combined segmentation is extracted from the left and right label
+        # volumes directly, so it does not wait for combine_ha_lr_dseg
+        segmentations.extend(
             [
                 (
-                    selectfiles,
-                    segstats_ha_lh,
-                    [("lh_hippoAmygLabels", "segmentation_file")],
+                    "hemi-L_seg-hippocampusAmygdala",
+                    None,
+                    select_ha_files,
+                    "lh_hippoAmygLabels",
+                    True,
                 ),
-                (move_pet_to_anat, segstats_ha_lh, [("transformed_file", "in_file")]),
                 (
-                    segstats_ha_lh,
-                    create_ha_tacs_lh,
-                    [("avgwf_txt_file", "avgwf_file"), ("ctab_out_file", "ctab_file")],
-                ),
-                (selectfiles, create_ha_tacs_lh, [("json_file", "json_file")]),
-                (
-                    segstats_ha_lh,
-                    create_ha_stats_lh,
-                    [("summary_file", "summary_file")],
-                ),
-                (
-                    segstats_ha_lh,
-                    create_ha_dsegtsv_lh,
-                    [("ctab_out_file", "ctab_file")],
+                    "hemi-R_seg-hippocampusAmygdala",
+                    None,
+                    select_ha_files,
+                    "rh_hippoAmygLabels",
+                    True,
                 ),
+                ("seg-hippocampusAmygdala", None, merge_seg_files, "out", True),
+            ]
+        )
+
+        subject_wf.connect(
+            [
                 (
-                    selectfiles,
+                    select_ha_files,
                     convert_ha_seg_file_lh,
                     [("lh_hippoAmygLabels", "in_file")],
                 ),
-                (create_ha_tacs_lh, datasink, [("out_file", "datasink.@ha_tacs_lh")]),
-                (create_ha_stats_lh, datasink, [("out_file", "datasink.@ha_stats_lh")]),
-                (
-                    create_ha_dsegtsv_lh,
-                    datasink,
-                    [("out_file", "datasink.@ha_dseg_lh")],
-                ),
                 (
                     convert_ha_seg_file_lh,
                     datasink,
                     [("out_file", "datasink.@ha_segmentation_file_lh")],
                 ),
                 (
-                    selectfiles,
-                    segstats_ha_rh,
-                    [("rh_hippoAmygLabels", "segmentation_file")],
-                ),
-                (move_pet_to_anat, segstats_ha_rh, [("transformed_file", "in_file")]),
-                (
-                    segstats_ha_rh,
-                    create_ha_tacs_rh,
-                    [("avgwf_txt_file", "avgwf_file"), ("ctab_out_file", "ctab_file")],
-                ),
-                (selectfiles, create_ha_tacs_rh, [("json_file", "json_file")]),
-                (
-                    segstats_ha_rh,
-                    create_ha_stats_rh,
-                    [("summary_file", "summary_file")],
-                ),
-                (
-                    segstats_ha_rh,
-                    create_ha_dsegtsv_rh,
-                    [("ctab_out_file", "ctab_file")],
-                ),
-                (
-                    selectfiles,
+                    select_ha_files,
                     convert_ha_seg_file_rh,
                     [("rh_hippoAmygLabels", "in_file")],
                 ),
-                (create_ha_tacs_rh, datasink, [("out_file", "datasink.@ha_tacs_rh")]),
-                (create_ha_stats_rh, datasink, [("out_file", "datasink.@ha_stats_rh")]),
-                (
-                    create_ha_dsegtsv_rh,
-                    datasink,
-                    [("out_file", "datasink.@ha_dseg_rh")],
-                ),
                 (
                     convert_ha_seg_file_rh,
                     datasink,
                     [("out_file", "datasink.@ha_segmentation_file_rh")],
                 ),
-                (selectfiles, merge_seg_files, [("lh_hippoAmygLabels", "in1")]),
-                (selectfiles, merge_seg_files, [("rh_hippoAmygLabels", "in2")]),
-                (merge_seg_files, combine_ha_lr_dseg, [("out", "in_files")]),
+                (select_ha_files, merge_seg_files, [("lh_hippoAmygLabels", "in1")]),
+                (select_ha_files, merge_seg_files, [("rh_hippoAmygLabels", "in2")]),
+                (merge_seg_files, combine_ha_lr_dseg, [("out", "in_file")]),
                 (
                     combine_ha_lr_dseg,
                     datasink,
-                    [("concatenated_file", "datasink.@ha_segmentation_file")],
-                ),
-                (
-                    combine_ha_lr_dseg,
-                    segstats_ha,
-                    [("concatenated_file", "segmentation_file")],
-                ),
-                (move_pet_to_anat, segstats_ha, [("transformed_file", "in_file")]),
-                (
-                    segstats_ha,
-                    create_ha_tacs,
-                    [("avgwf_txt_file", "avgwf_file"), ("ctab_out_file", "ctab_file")],
+                    [("out_file", "datasink.@ha_segmentation_file")],
                 ),
-                (selectfiles, create_ha_tacs, [("json_file", "json_file")]),
-                (segstats_ha, create_ha_stats, [("summary_file", "summary_file")]),
-                (segstats_ha, create_ha_dsegtsv, [("ctab_out_file", "ctab_file")]),
-                (create_ha_tacs, datasink, [("out_file", "datasink.@ha_tacs")]),
-                (create_ha_stats, datasink, [("out_file", "datasink.@ha_stats")]),
-                (create_ha_dsegtsv, datasink, [("out_file", "datasink.@ha_dseg")]),
             ]
         )
 
     if args.wm is True:
-        segstats_wm = Node(
-            SegStats(
-                exclude_id=0,
-                default_color_table=True,
-                avgwf_txt_file="seg-whiteMatter_tacs.txt",
-                ctab_out_file="seg-whiteMatter_dseg.ctab",
-                summary_file="seg-whiteMatter_morph.txt",
-            ),
-            name="segstats_wm",
-        )
-
-        create_wm_tacs = Node(
-            Function(
-                input_names=["avgwf_file", "ctab_file", "json_file"],
-                output_names=["out_file"],
-                function=avgwf_to_tacs,
-            ),
-            name="create_wm_tacs",
-        )
-
-        create_wm_stats = Node(
-            Function(
-                input_names=["summary_file"],
-                output_names=["out_file"],
-                function=summary_to_stats,
-            ),
-            name="create_wm_stats",
-        )
+        segmentations.append(("seg-whiteMatter", None, selectfiles, "wm_file", True))
 
-        create_wm_dsegtsv = Node(
-            Function(
-                input_names=["ctab_file"],
-                output_names=["out_file"],
-                function=ctab_to_dsegtsv,
-            ),
-            name="create_wm_dsegtsv",
-        )
-
-        convert_wm_seg_file = Node(
-            MRIConvert(out_file="seg-whiteMatter_dseg.nii.gz"),
-            name="convert_wm_seg_file",
+        convert_wm_seg_file = convert_node(
+            "seg-whiteMatter_dseg.nii.gz", "convert_wm_seg_file"
         )
 
         subject_wf.connect(
             [
-                (selectfiles, segstats_wm, [("wm_file", "segmentation_file")]),
-                (move_pet_to_anat, segstats_wm, [("transformed_file", "in_file")]),
-                (
-                    segstats_wm,
-                    create_wm_tacs,
-                    [("avgwf_txt_file", "avgwf_file"), ("ctab_out_file", "ctab_file")],
-                ),
-                (selectfiles, create_wm_tacs, [("json_file", "json_file")]),
-                (segstats_wm, create_wm_stats, [("summary_file", "summary_file")]),
-                (segstats_wm, create_wm_dsegtsv, [("ctab_out_file", "ctab_file")]),
-                (create_wm_tacs, datasink, [("out_file", "datasink.@wm_tacs")]),
-                (create_wm_stats, datasink, [("out_file", "datasink.@wm_stats")]),
-                (create_wm_dsegtsv, datasink, [("out_file", "datasink.@wm_dseg")]),
-                (selectfiles, convert_wm_seg_file, [("wm_file", "in_file")]),
+                (select_anat_files, convert_wm_seg_file, [("wm_file", "in_file")]),
                 (
                     convert_wm_seg_file,
                     datasink,
@@ -1243,180 +1361,211 @@ def init_single_subject_wf(
             ]
         )
 
-    if args.raphe is True:
-        segment_raphe = Node(
-            MRISclimbicSeg(
-                keep_ac=True,
-                percentile=99.9,
-                vmp=True,
-                write_volumes=True,
-                out_file="seg-raphe_dseg.nii.gz",
-            ),
-            name="segment_raphe",
-        )
-
-        segment_raphe.inputs.model = pkg_resources.resource_filename(
-            "petprep_extract_tacs", "utils/raphe+pons.n21.d114.h5"
-        )
-        segment_raphe.inputs.ctab = pkg_resources.resource_filename(
-            "petprep_extract_tacs", "utils/raphe+pons.ctab"
-        )
-
-        segstats_raphe = Node(
-            SegStats(
-                exclude_id=0,
-                avgwf_txt_file="seg-raphe_tacs.txt",
-                ctab_out_file="seg-raphe_dseg.ctab",
-                summary_file="seg-raphe_morph.txt",
-            ),
-            name="segstats_raphe",
-        )
+    # raphe and limbic segmentations are computed once per subject by the
+    # batched mri_sclimbic_seg nodes, see init_petprep_extract_tacs_wf
+    for flag, seg_prefix, output_base, ctab in (
+        ("raphe", "seg-raphe", "raphe+pons", "utils/raphe+pons_cleaned.ctab"),
+        ("limbic", "seg-limbic", "sclimbic", "utils/sclimbic_cleaned.ctab"),
+    ):
+        if getattr(args, flag, False) is not True:
+            continue
 
-        segstats_raphe.inputs.color_table_file = pkg_resources.resource_filename(
-            "petprep_extract_tacs", "utils/raphe+pons_cleaned.ctab"
+        select_seg_files = select_step_files(
+            flag,
+            {
+                f"{flag}_file": f"derivatives/freesurfer/sub-{{subject_id}}/mri/{output_base}.mgz",
+                f"{flag}_stats": f"derivatives/freesurfer/sub-{{subject_id}}/stats/{output_base}.stats",
+            },
         )
 
-        create_raphe_tacs = Node(
-            Function(
-                input_names=["avgwf_file", "ctab_file", "json_file"],
-                output_names=["out_file"],
-                function=avgwf_to_tacs,
-            ),
-            name="create_raphe_tacs",
+        # morph and dseg tables come from the sclimbic volume stats
+        segmentations.append(
+            (
+                seg_prefix,
+                resource_filename(ctab),
+                select_seg_files,
+                f"{flag}_file",
+                False,
+            )
         )
 
-        create_raphe_tacs.inputs.ctab_file = pkg_resources.resource_filename(
-            "petprep_extract_tacs", "utils/raphe+pons_cleaned.ctab"
+        convert_seg_file = convert_node(
+            f"{seg_prefix}_dseg.nii.gz", f"convert_{flag}_seg_file"
         )
 
-        create_raphe_stats = Node(
+        create_stats = Node(
             Function(
-                input_names=["out_stats"],
+                input_names=["out_stats", "seg_prefix"],
                 output_names=["out_file"],
                 function=limbic_to_stats,
             ),
-            name="create_raphe_stats",
+            name=f"create_{flag}_stats",
         )
+        create_stats.inputs.seg_prefix = seg_prefix
 
-        create_raphe_dsegtsv = Node(
+        create_dsegtsv = Node(
             Function(
-                input_names=["out_stats"],
+                input_names=["out_stats", "seg_prefix"],
                 output_names=["out_file"],
                 function=limbic_to_dsegtsv,
             ),
-            name="create_raphe_dsegtsv",
+            name=f"create_{flag}_dsegtsv",
         )
+        create_dsegtsv.inputs.seg_prefix = seg_prefix
 
         subject_wf.connect(
             [
-                (selectfiles, segment_raphe, [("orig_file", "in_file")]),
-                (segment_raphe, segstats_raphe, [("out_file", "segmentation_file")]),
-                (move_pet_to_anat, segstats_raphe, [("transformed_file", "in_file")]),
-                (segstats_raphe, create_raphe_tacs, [("avgwf_txt_file", "avgwf_file")]),
-                (selectfiles, create_raphe_tacs, [("json_file", "json_file")]),
-                (create_raphe_tacs, datasink, [("out_file", "datasink.@raphe_tacs")]),
+                (select_seg_files, convert_seg_file, [(f"{flag}_file", "in_file")]),
                 (
-                    segment_raphe,
+                    convert_seg_file,
                     datasink,
-                    [("out_file", "datasink.@raphe_segmentation_file")],
+                    [("out_file", f"datasink.@{flag}_segmentation_file")],
                 ),
-                (segment_raphe, create_raphe_stats, [("out_stats", "out_stats")]),
-                (create_raphe_stats, datasink, [("out_file", "datasink.@raphe_stats")]),
-                (segment_raphe, create_raphe_dsegtsv, [("out_stats", "out_stats")]),
+                (select_seg_files, create_stats, [(f"{flag}_stats", "out_stats")]),
+                (create_stats, datasink, [("out_file", f"datasink.@{flag}_stats")]),
+                (select_seg_files, create_dsegtsv, [(f"{flag}_stats", "out_stats")]),
                 (
-                    create_raphe_dsegtsv,
+                    create_dsegtsv,
                     datasink,
-                    [("out_file", "datasink.@raphe_dseg")],
+                    [("out_file", f"datasink.@{flag}_dseg")],
                 ),
             ]
         )
 
-    if args.limbic is True:
-        segment_limbic = Node(
-            MRISclimbicSeg(write_volumes=True, out_file="seg-limbic_dseg.nii.gz"),
-            name="segment_limbic",
-        )
-        segment_limbic.inputs.ctab = pkg_resources.resource_filename(
-            "petprep_extract_tacs", "utils/sclimbic.ctab"
+    if segmentations:
+        # Read the PET in T1w space once and extract the TACs of every requested
+        # segmentation from that single pass
+        merge_segmentations = Node(
+            Merge(len(segmentations), no_flatten=True), name="merge_segmentations"
         )
 
-        segstats_limbic = Node(
-            SegStats(
-                exclude_id=0,
-                avgwf_txt_file="seg-limbic_tacs.txt",
-                ctab_out_file="seg-limbic_dseg.ctab",
-                summary_file="seg-limbic_morph.txt",
+        extract_tacs = Node(
+            Function(
+                input_names=[
+                    "in_file",
+                    "segmentation_files",
+                    "json_file",
+                    "seg_prefixes",
+                    "ctab_files",
+                    "cache_dir",
+                    "mem_mb",
+                    "lta_file",
+                    "target_file",
+                    "n_threads",
+                    "pet_space",
+                ],
+                output_names=["tacs_files", "morph_files", "dseg_files"],
+                function=multi_segstats_to_tacs,
             ),
-            name="segstats_limbic",
+            name="extract_tacs",
         )
 
-        segstats_limbic.inputs.color_table_file = pkg_resources.resource_filename(
-            "petprep_extract_tacs", "utils/sclimbic_cleaned.ctab"
-        )
+        extract_tacs.inputs.seg_prefixes = [seg[0] for seg in segmentations]
+        extract_tacs.inputs.ctab_files = [seg[1] for seg in segmentations]
+        # label matrices only depend on the anatomy and are shared by all PET runs
+        extract_tacs.inputs.cache_dir = get_cache_dir(args, subject_id)
+        extract_tacs.inputs.mem_mb = getattr(args, "chunk_mem_mb", None)
+        extract_tacs.inputs.n_threads = n_threads
 
-        create_limbic_tacs = Node(
-            Function(
-                input_names=["avgwf_file", "ctab_file", "json_file"],
-                output_names=["out_file"],
-                function=avgwf_to_tacs,
-            ),
-            name="create_limbic_tacs",
-        )
+        pet_space = getattr(args, "extraction_space", "T1w") == "pet"
+        extract_tacs.inputs.pet_space = pet_space
 
-        create_limbic_tacs.inputs.ctab_file = pkg_resources.resource_filename(
-            "petprep_extract_tacs", "utils/sclimbic_cleaned.ctab"
-        )
+        if pet_space or getattr(args, "resample_in_memory", False):
+            # either project the segmentations into PET space or resample the PET
+            # into T1w space block by block inside the extraction, in both cases
+            # without writing the 4D PET in T1w space to disk
+            subject_wf.connect(
+                [
+                    (selectfiles, extract_tacs, [("pet_file", "in_file")]),
+                    (coreg_pet_to_t1w, extract_tacs, [("out_lta_file", "lta_file")]),
+                    (selectfiles, extract_tacs, [("brainmask_file", "target_file")]),
+                ]
+            )
+        elif args.volume is True:
+            # the MNI305 resampling also resamples the labelled voxels in T1w
+            # space, so the PET is only read once
+            subject_wf.connect(
+                [
+                    (selectfiles, vol2vol, [("brainmask_file", "anat_file")]),
+                    (merge_segmentations, vol2vol, [("out", "mask_files")]),
+                    (vol2vol, extract_tacs, [("masked_file", "in_file")]),
+                ]
+            )
+        else:
+            move_pet_to_anat = Node(
+                Function(
+                    input_names=[
+                        "source_file",
+                        "target_file",
+                        "lta_file",
+                        "out_file",
+                        "n_threads",
+                        "mem_mb",
+                        "mask_files",
+                    ],
+                    output_names=["transformed_file"],
+                    function=resample_pet_to_anat,
+                ),
+                name="move_pet_to_anat",
+                n_procs=n_threads,
+            )
+            # only resample the voxels covered by the requested segmentations and
+            # store them as a compact voxels x frames array
+            move_pet_to_anat.inputs.out_file = "space-T1w_desc-masked_pet.npz"
+            move_pet_to_anat.inputs.n_threads = n_threads
+            move_pet_to_anat.inputs.mem_mb = getattr(args, "chunk_mem_mb", None)
 
-        create_limbic_stats = Node(
-            Function(
-                input_names=["out_stats"],
-                output_names=["out_file"],
-                function=limbic_to_stats,
-            ),
-            name="create_limbic_stats",
-        )
+            subject_wf.connect(
+                [
+                    (
+                        coreg_pet_to_t1w,
+                        move_pet_to_anat,
+                        [("out_lta_file", "lta_file")],
+                    ),
+                    (
+                        selectfiles,
+                        move_pet_to_anat,
+                        [("brainmask_file", "target_file")],
+                    ),
+                    (selectfiles, move_pet_to_anat, [("pet_file", "source_file")]),
+                    (merge_segmentations, move_pet_to_anat, [("out", "mask_files")]),
+                    (
+                        move_pet_to_anat,
+                        extract_tacs,
+                        [("transformed_file", "in_file")],
+                    ),
+                ]
+            )
 
-        create_limbic_dsegtsv = Node(
-            Function(
-                input_names=["out_stats"],
-                output_names=["out_file"],
-                function=limbic_to_dsegtsv,
-            ),
-            name="create_limbic_dsegtsv",
-        )
+        for idx, (_, _, source, field, _) in enumerate(segmentations, start=1):
+            subject_wf.connect(source, field, merge_segmentations, f"in{idx}")
 
         subject_wf.connect(
             [
-                (selectfiles, segment_limbic, [("orig_file", "in_file")]),
-                (segment_limbic, segstats_limbic, [("out_file", "segmentation_file")]),
-                (move_pet_to_anat, segstats_limbic, [("transformed_file", "in_file")]),
-                (
-                    segstats_limbic,
-                    create_limbic_tacs,
-                    [("avgwf_txt_file", "avgwf_file")],
-                ),
-                (selectfiles, create_limbic_tacs, [("json_file", "json_file")]),
-                (create_limbic_tacs, datasink, [("out_file", "datasink.@limbic_tacs")]),
-                (
-                    segment_limbic,
-                    datasink,
-                    [("out_file", "datasink.@limbic_segmentation_file")],
-                ),
-                (segment_limbic, create_limbic_stats, [("out_stats", "out_stats")]),
-                (
-                    create_limbic_stats,
-                    datasink,
-                    [("out_file", "datasink.@limbic_stats")],
-                ),
-                (segment_limbic, create_limbic_dsegtsv, [("out_stats", "out_stats")]),
                 (
-                    create_limbic_dsegtsv,
-                    datasink,
-                    [("out_file", "datasink.@limbic_dseg")],
+                    merge_segmentations,
+                    extract_tacs,
+                    [("out", "segmentation_files")],
                 ),
+                (selectfiles, extract_tacs, [("json_file", "json_file")]),
+                (extract_tacs, datasink, [("tacs_files", "datasink.@tacs")]),
             ]
         )
 
+        table_indices = [idx for idx, seg in enumerate(segmentations) if seg[4]]
+        if table_indices:
+            select_morph = Node(Select(index=table_indices), name="select_morph")
+            select_dseg = Node(Select(index=table_indices), name="select_dseg")
+
+            subject_wf.connect(
+                [
+                    (extract_tacs, select_morph, [("morph_files", "inlist")]),
+                    (extract_tacs, select_dseg, [("dseg_files", "inlist")]),
+                    (select_morph, datasink, [("out", "datasink.@morph")]),
+                    (select_dseg, datasink, [("out", "datasink.@dseg")]),
+                ]
+            )
+
     return subject_wf
 
 
@@ -1522,43 +1671,30 @@ def check_docker_image_exists(image_name, build=False):
     return image_exists
 
 
-def cli():
+def format_cli_argument(key, value):
     """
-    Command-line interface for the PETPrep extract time activity curves (TACs) workflow.
+    Format a parsed argument as it is passed to the command line of the container.
+
+    :param key: Name of the argument without the leading dashes.
+    :type key: str
+    :param value: Parsed value, lists are passed as space separated values and
+        lists of lists, e.g. of ``--twa_window``, as one argument per item.
+    :return: Argument string, e.g. ``--twa_window 3600.0 inf``.
+    :rtype: str
+    """
+    if isinstance(value, (list, tuple)):
+        if value and all(isinstance(item, (list, tuple)) for item in value):
+            return " ".join(format_cli_argument(key, item) for item in value)
+        return "--{} {}".format(key, " ".join(str(item) for item in value))
+    return "--{} {}".format(key, value)
 
-    This function sets up the argument parser for the PETPrep extract TACs workflow,
-    processes the input arguments, and either runs the main workflow or sets up and
-    runs a Docker container with the appropriate settings.
 
-    - bids_dir (str): The directory with the input dataset formatted according to the BIDS standard.
-    - output_dir (str, optional): The directory where the output files should be stored. If running group level analysis, this folder should be prepopulated with the results of the participant level analysis.
-    - analysis_level (str): Level of the analysis that will be performed. Choices are "participant" or "group".
-    - --participant_label (list of str, optional): The label(s) of the participant(s) that should be analyzed. If not provided, all subjects will be analyzed.
-    - --session_label (list of str, optional): The label(s) of the session(s) that should be analyzed. If not specified, all sessions will be analyzed.
-    - --n_procs (int, optional): Number of processors to use when running the workflow. Default is 2.
-    - --gtm (bool, optional): Extract time activity curves from the geometric transfer matrix segmentation (gtmseg).
-    - --brainstem (bool, optional): Extract time activity curves from the brainstem.
-    - --thalamicNuclei (bool, optional): Extract time activity curves from the thalamic nuclei.
-    - --hippocampusAmygdala (bool, optional): Extract time activity curves from the hippocampus and amygdala.
-    - --wm (bool, optional): Extract time activity curves from the white matter.
-    - --raphe (bool, optional): Extract time activity curves from the raphe nuclei.
-    - --limbic (bool, optional): Extract time activity curves from the limbic system.
-    - --surface (bool, optional): Extract surface-based time activity curves in fsaverage.
-    - --surface_smooth (int, optional): Smooth surface-based time activity curves in fsaverage.
-    - --volume (bool, optional): Extract volume-based time activity curves in mni305.
-    - --volume_smooth (int, optional): Smooth volume-based time activity curves in mni305.
-    - --agtm (bool, optional): Extract time activity curves from the adaptive gtm PVC.
-    - --psf (float, optional): Initial guess of point spread function of PET scanner for agtm.
-    - --petprep_hmc (bool, optional): Use outputs from petprep_hmc as input to workflow.
-    - --skip_bids_validator (bool, optional): Whether or not to perform BIDS dataset validation.
-    - --docker (bool, optional): Run the workflow from within a Docker container.
-    - --run_as_root (bool, optional): Run as root if running in Docker. Default is False.
-    - --merge_runs (bool, optional): Merge TACs across runs for each subject when they coincide with a single session.
-    - -v, --version (bool, optional): Show the version of the PETPrep extract TACs BIDS-App.
-    - --participant_label_exclude (list of str, optional): Exclude a participant(s) from the TAC workflow.
-    - --session_label_exclude (list of str, optional): Exclude a session(s) from the TAC workflow.
+def get_parser():
+    """
+    Argument parser of the command-line interface, see :func:`cli`.
 
-    The function also handles Docker setup and execution if the --docker flag is provided.
+    :return: The parser.
+    :rtype: argparse.ArgumentParser
     """
     parser = argparse.ArgumentParser(
         description="BIDS App for PETPrep extract time activity curves (TACs) workflow"
@@ -1609,6 +1745,12 @@ def cli():
         help="Number of processors to use when running the workflow",
         default=2,
     )
+    parser.add_argument(
+        "--n_threads",
+        help="Maximum number of threads used by a single node, e.g. when resampling "
+        "PET into T1w space. Defaults to n_procs.",
+        type=int,
+    )
     parser.add_argument(
         "--gtm",
         help="Extract time activity curves from the geometric transfer matrix segmentation (gtmseg)",
@@ -1674,16 +1816,36 @@ def cli():
         help="Initial guess of point spread function of PET scanner for agtm",
         type=float,
     )
+    parser.add_argument(
+        "--no_psf_warm_start",
+        help="Always search the agtm PSF around --psf instead of starting from the "
+        "mean estimate of previous runs with the same scanner model and "
+        "reconstruction",
+        action="store_true",
+    )
     parser.add_argument(
         "--petprep_hmc",
         help="Use outputs from petprep_hmc as input to workflow",
         action="store_true",
     )
+    parser.add_argument(
+        "--force_anat",
+        help="Run the anatomical segmentations (gtmseg, brainstem, thalamic nuclei, "
+        "hippocampus and amygdala, raphe and limbic) even when their outputs are "
+        "already present and up to date",
+        action="store_true",
+    )
     parser.add_argument(
         "--skip_bids_validator",
         help="Whether or not to perform BIDS dataset validation",
         action="store_true",
     )
+    parser.add_argument(
+        "--fast_discovery",
+        help="Find the PET runs (sub-*/[ses-*/]pet/*_pet.nii[.gz]) with a filesystem "
+        "scan instead of indexing the dataset with pybids, skipping BIDS validation",
+        action="store_true",
+    )
     parser.add_argument(
         "--docker",
         help="When this flag is present petprep_extract_tacs will attempt to run from within a docker "
@@ -1704,6 +1866,47 @@ def cli():
         action="store_true",
         default=False,
     )
+    parser.add_argument(
+        "--twa_window",
+        help="Start and end time in seconds of a window for which a time weighted "
+        "average PET image is written next to the TACs, e.g. --twa_window 3600 inf "
+        "for the late frames. Frames are included when their mid-frame time falls "
+        "within the window. Can be given multiple times.",
+        nargs=2,
+        type=float,
+        action="append",
+        metavar=("START", "END"),
+    )
+    parser.add_argument(
+        "--chunk_mem_mb",
+        help="Memory budget in MB for the block of PET frames that is read into memory "
+        "at once when computing time weighted averages and TACs. Larger values read "
+        "dynamic PET in fewer blocks, smaller values bound the peak memory of a run.",
+        type=int,
+        default=1024,
+    )
+    parser.add_argument(
+        "--resample_in_memory",
+        help="Resample the PET into T1w space block by block within the TAC "
+        "extraction instead of writing the 4D PET in T1w space to disk first",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--extraction_space",
+        help="Space in which the atlas TACs are extracted. T1w resamples every PET "
+        "frame into T1w space and averages it over the labels. pet maps the labels "
+        "into PET space once as fractional weights of the PET voxels, which is "
+        "equivalent and much cheaper for dynamic PET.",
+        choices=["T1w", "pet"],
+        default="T1w",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        help="Directory in which artefacts that are reused between PET runs and "
+        "invocations (e.g. the label matrices of each subject's segmentations) are "
+        "stored. Defaults to <bids_dir>/derivatives/petprep_extract_tacs_cache.",
+        type=str,
+    )
     parser.add_argument(
         "-v",
         "--version",
@@ -1727,7 +1930,57 @@ def cli():
         default=[],
     )
 
-    args, unknown = parser.parse_known_args()
+    return parser
+
+
+def cli():
+    """
+    Command-line interface for the PETPrep extract time activity curves (TACs) workflow.
+
+    This function sets up the argument parser for the PETPrep extract TACs workflow,
+    processes the input arguments, and either runs the main workflow or sets up and
+    runs a Docker container with the appropriate settings.
+
+    - bids_dir (str): The directory with the input dataset formatted according to the BIDS standard.
+    - output_dir (str, optional): The directory where the output files should be stored. If running group level analysis, this folder should be prepopulated with the results of the participant level analysis.
+    - analysis_level (str): Level of the analysis that will be performed. Choices are "participant" or "group".
+    - --participant_label (list of str, optional): The label(s) of the participant(s) that should be analyzed. If not provided, all subjects will be analyzed.
+    - --session_label (list of str, optional): The label(s) of the session(s) that should be analyzed. If not specified, all sessions will be analyzed.
+    - --n_procs (int, optional): Number of processors to use when running the workflow. Default is 2.
+    - --n_threads (int, optional): Maximum number of threads used by a single node. Default is n_procs.
+    - --gtm (bool, optional): Extract time activity curves from the geometric transfer matrix segmentation (gtmseg).
+    - --brainstem (bool, optional): Extract time activity curves from the brainstem.
+    - --thalamicNuclei (bool, optional): Extract time activity curves from the thalamic nuclei.
+    - --hippocampusAmygdala (bool, optional): Extract time activity curves from the hippocampus and amygdala.
+    - --wm (bool, optional): Extract time activity curves from the white matter.
+    - --raphe (bool, optional): Extract time activity curves from the raphe nuclei.
+    - --limbic (bool, optional): Extract time activity curves from the limbic system.
+    - --surface (bool, optional): Extract surface-based time activity curves in fsaverage.
+    - --surface_smooth (int, optional): Smooth surface-based time activity curves in fsaverage.
+    - --volume (bool, optional): Extract volume-based time activity curves in mni305.
+    - --volume_smooth (int, optional): Smooth volume-based time activity curves in mni305.
+    - --agtm (bool, optional): Extract time activity curves from the adaptive gtm PVC.
+    - --psf (float, optional): Initial guess of point spread function of PET scanner for agtm.
+    - --no_psf_warm_start (bool, optional): Always start the agtm PSF search from --psf instead of the mean estimate of the scanner.
+    - --petprep_hmc (bool, optional): Use outputs from petprep_hmc as input to workflow.
+    - --force_anat (bool, optional): Run the anatomical segmentations even when their outputs are up to date.
+    - --skip_bids_validator (bool, optional): Whether or not to perform BIDS dataset validation.
+    - --fast_discovery (bool, optional): Find the PET runs with a filesystem scan instead of pybids, without BIDS validation.
+    - --docker (bool, optional): Run the workflow from within a Docker container.
+    - --run_as_root (bool, optional): Run as root if running in Docker. Default is False.
+    - --merge_runs (bool, optional): Merge TACs across runs for each subject when they coincide with a single session.
+    - --twa_window (list of float, optional): Start and end in seconds of an additional time-weighted average image, can be given multiple times.
+    - --chunk_mem_mb (int, optional): Memory budget in MB for the PET frames held in memory at once. Default is 1024.
+    - --resample_in_memory (bool, optional): Resample the PET into T1w space within the TAC extraction instead of writing it to disk.
+    - --extraction_space (str, optional): Space in which TACs are extracted, "T1w" (default) or "pet".
+    - --cache_dir (str, optional): Directory for artefacts reused between runs. Default is <bids_dir>/derivatives/petprep_extract_tacs_cache.
+    - -v, --version (bool, optional): Show the version of the PETPrep extract TACs BIDS-App.
+    - --participant_label_exclude (list of str, optional): Exclude a participant(s) from the TAC workflow.
+    - --session_label_exclude (list of str, optional): Exclude a session(s) from the TAC workflow.
+
+    The function also handles Docker setup and execution if the --docker flag is provided.
+    """
+    args, unknown = get_parser().parse_known_args()
 
     # determine the present working directory
     pwd = pathlib.Path.cwd()
@@ -1755,6 +2008,8 @@ def cli():
             args.output_dir = str(
                 pathlib.Path(args.bids_dir) / "derivatives" / "petprep_extract_tacs"
             )
+    if args.cache_dir:
+        args.cache_dir = str(pathlib.Path(args.cache_dir).expanduser().absolute())
 
     if not args.docker:
         main(args)
@@ -1794,6 +2049,11 @@ def cli():
         args.bids_dir = "/bids_dir"
         args.output_dir = "/output_dir"
 
+        cache_dir_mount_point = args.cache_dir
+        if cache_dir_mount_point:
+            pathlib.Path(cache_dir_mount_point).mkdir(parents=True, exist_ok=True)
+            args.cache_dir = "/cache_dir"
+
         print(
             "Attempting to run in docker container, mounting {} to {}, {} to {}, and {} to {}".format(
                 bids_dir_mount_point,
@@ -1820,7 +2080,11 @@ def cli():
             args_dict[key] = "empty_str"
 
         args_string = " ".join(
-            ["--{} {}".format(key, value) for key, value in args_dict.items() if value]
+            [
+                format_cli_argument(key, value)
+                for key, value in args_dict.items()
+                if value
+            ]
         )
         args_string = args_string.replace("empty_str", "")
 
@@ -1842,6 +2106,8 @@ def cli():
         )
         if code_dir:
             docker_command += f"-v {code_dir}:/petprep_extract_tacs "
+        if cache_dir_mount_point:
+            docker_command += f"-v {cache_dir_mount_point}:{args.cache_dir} "
 
         # collect location of freesurfer license if it's installed and working
         if check_valid_fs_license():
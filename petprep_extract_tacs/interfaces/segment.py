@@ -9,6 +9,8 @@ from nipype.interfaces.base import (
     Directory,
     traits,
     InputMultiObject,
+    OutputMultiObject,
+    isdefined,
 )
 from nipype.interfaces.freesurfer.base import FSCommand, FSTraitedSpec
 
@@ -133,6 +135,12 @@ class MRISclimbicSegInputSpec(CommandLineInputSpec):
 class MRISclimbicSegOutputSpec(TraitedSpec):
     out_file = File(desc="Segmentation output.")
     out_stats = File(desc="Segmentation stats output.")
+    subject_files = OutputMultiObject(
+        File(), desc="Segmentation outputs of each subject in subject mode."
+    )
+    subject_stats = OutputMultiObject(
+        File(), desc="Segmentation stats outputs of each subject in subject mode."
+    )
 
 
 class MRISclimbicSeg(CommandLine):
@@ -142,6 +150,28 @@ class MRISclimbicSeg(CommandLine):
 
     def _list_outputs(self):
         outputs = self.output_spec().get()
+        if isdefined(self.inputs.subjects):
+            # subject mode writes into the mri and stats directories of every subject
+            subjects_dir = os.path.abspath(
+                self.inputs.sd
+                if isdefined(self.inputs.sd)
+                else os.environ.get("SUBJECTS_DIR", "")
+            )
+            base = (
+                self.inputs.output_base
+                if isdefined(self.inputs.output_base)
+                else "sclimbic"
+            )
+            outputs["subject_files"] = [
+                os.path.join(subjects_dir, subject, "mri", f"{base}.mgz")
+                for subject in self.inputs.subjects
+            ]
+            outputs["subject_stats"] = [
+                os.path.join(subjects_dir, subject, "stats", f"{base}.stats")
+                for subject in self.inputs.subjects
+            ]
+            return outputs
+
         outputs["out_file"] = os.path.abspath(self.inputs.out_file)
         outputs["out_stats"] = os.path.abspath(self.inputs.out_file).replace(
             ".nii.gz", ".stats"
@@ -0,0 +1,159 @@
+"""
+Detection of anatomical segmentations that do not need to be run again.
+
+The anatomical stage writes its segmentations into the FreeSurfer subject
+directory. A step is up to date when all of its outputs exist, are not empty and
+are newer than the FreeSurfer volumes they are computed from. The version of the
+FreeSurfer modules is part of the output names (e.g. ``v13``), so outputs of other
+versions are never mistaken for current ones.
+
+The FreeSurfer label volumes and brain mask shared by all PET runs of a subject
+are converted to NIfTI with nibabel once and kept in the cache.
+"""
+
+import os
+
+import nibabel as nib
+import numpy as np
+
+from petprep_extract_tacs.utils.cache import cache_file, file_fingerprint, remove_stale
+
+# Bump when the conversion of cached NIfTI volumes changes
+NIFTI_VERSION = 1
+
+# Outputs and inputs, relative to the FreeSurfer subject directory, of every
+# anatomical step keyed by its command line flag
+ANAT_STEPS = {
+    "gtm": (
+        ("mri/gtmseg.mgz", "stats/gtmseg.stats"),
+        ("mri/aparc+aseg.mgz", "mri/nu.mgz"),
+    ),
+    "brainstem": (
+        (
+            "mri/brainstemSsLabels.v13.FSvoxelSpace.mgz",
+            "mri/brainstemSsVolumes.v13.txt",
+        ),
+        ("mri/aseg.mgz", "mri/norm.mgz"),
+    ),
+    "thalamicNuclei": (
+        (
+            "mri/ThalamicNuclei.v13.T1.FSvoxelSpace.mgz",
+            "mri/ThalamicNuclei.v13.T1.volumes.txt",
+        ),
+        ("mri/aseg.mgz", "mri/norm.mgz"),
+    ),
+    "hippocampusAmygdala": (
+        (
+            "mri/lh.hippoAmygLabels-T1.v22.FSvoxelSpace.mgz",
+            "mri/rh.hippoAmygLabels-T1.v22.FSvoxelSpace.mgz",
+        ),
+        ("mri/aseg.mgz", "mri/norm.mgz"),
+    ),
+    "raphe": (
+        ("mri/raphe+pons.mgz", "stats/raphe+pons.stats"),
+        ("mri/orig.mgz", "mri/nu.mgz"),
+    ),
+    "limbic": (
+        ("mri/sclimbic.mgz", "stats/sclimbic.stats"),
+        ("mri/orig.mgz", "mri/nu.mgz"),
+    ),
+}
+
+
+def anat_step_is_current(subject_dir, step):
+    """
+    Whether the outputs of an anatomical step exist and are up to date.
+
+    :param subject_dir: FreeSurfer subject directory, e.g.
+        ``derivatives/freesurfer/sub-01``.
+    :type subject_dir: str
+    :param step: Step in :data:`ANAT_STEPS`, e.g. ``"brainstem"``.
+    :type step: str
+    :return: ``True`` when all outputs exist, are not empty and are not older than
+        any of the existing inputs.
+    :rtype: bool
+    """
+    outputs, inputs = ANAT_STEPS[step]
+
+    output_times = []
+    for output in outputs:
+        path = os.path.join(subject_dir, output)
+        if not os.path.isfile(path) or os.path.getsize(path) == 0:
+            return False
+        output_times.append(os.path.getmtime(path))
+
+    input_times = [
+        os.path.getmtime(os.path.join(subject_dir, path))
+        for path in inputs
+        if os.path.exists(os.path.join(subject_dir, path))
+    ]
+    return not input_times or min(output_times) >= max(input_times)
+
+
+def to_nifti(in_files, out_file):
+    """
+    Convert (and combine) FreeSurfer volumes to NIfTI in-process.
+
+    Equivalent to ``mri_convert`` for a single volume and to ``mri_concat
+    --combine`` for several label volumes without overlapping labels.
+
+    :param in_files: Path(s) to the volumes, e.g. ``.mgz`` files.
+    :type in_files: str or list
+    :param out_file: Path to the ``.nii.gz`` output.
+    :type out_file: str
+    :return: ``out_file``
+    :rtype: str
+    """
+    if isinstance(in_files, str):
+        in_files = [in_files]
+
+    imgs = [nib.load(in_file) for in_file in in_files]
+    data = np.asanyarray(imgs[0].dataobj)
+    for img in imgs[1:]:
+        data = data + np.asanyarray(img.dataobj)
+
+    out_img = nib.Nifti1Image(data, imgs[0].affine)
+    out_img.set_qform(imgs[0].affine, code=1)
+    out_img.set_sform(imgs[0].affine, code=1)
+    out_img.header.set_xyzt_units("mm", "sec")
+    nib.save(out_img, out_file)
+    return out_file
+
+
+def cached_nifti(in_files, out_name, cache_dir=None):
+    """
+    Convert FreeSurfer volumes with :func:`to_nifti` once and reuse the result.
+
+    The NIfTI is stored in the cache under a key of the source volumes, in a
+    directory of its own so it keeps ``out_name``. Every PET run, and every later
+    invocation, references the same file. Conversions of earlier versions of the
+    volumes to ``out_name`` are removed.
+
+    :param in_files: Path(s) to the volumes, e.g. ``.mgz`` files.
+    :type in_files: str or list
+    :param out_name: File name of the output, e.g. ``seg-brainstem_dseg.nii.gz``.
+    :type out_name: str
+    :param cache_dir: Optional cache directory, the working directory otherwise.
+    :type cache_dir: str
+    :return: Path to the NIfTI file.
+    :rtype: str
+    """
+    if not cache_dir:
+        return to_nifti(in_files, os.path.abspath(out_name))
+
+    key = file_fingerprint(in_files, out_name=out_name, version=NIFTI_VERSION)
+    stem = f"nifti_{out_name.split('.')[0]}"
+    out_dir = cache_file(cache_dir, stem, key, "")
+    out_file = os.path.join(out_dir, out_name)
+    if not os.path.exists(out_file):
+        # written under a temporary name with the same extensions, so readers
+        # never see a partial file
+        os.makedirs(out_dir, exist_ok=True)
+        tmp_file = os.path.join(out_dir, f".tmp_{os.getpid()}_{out_name}")
+        try:
+            os.replace(to_nifti(in_files, tmp_file), out_file)
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+        remove_stale(cache_dir, stem, "", keep=out_dir)
+    return out_file
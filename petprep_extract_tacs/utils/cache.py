@@ -0,0 +1,216 @@
+"""
+Helpers for the persistent cache shared between runs of the workflow.
+
+Cached artefacts are stored under a key derived from the inputs they were built
+from, so a changed input simply produces a new key and stale entries are removed
+when they are replaced.
+"""
+
+import fcntl
+import glob
+import hashlib
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+import nibabel as nib
+import numpy as np
+from scipy import sparse
+
+
+def _flatten(items):
+    for item in items:
+        if isinstance(item, (list, tuple)):
+            yield from _flatten(item)
+        else:
+            yield item
+
+
+def file_fingerprint(files, **params):
+    """
+    Fingerprint files by path, size and modification time together with parameters.
+
+    :param files: File path(s) the cached artefact is derived from. Nested lists are
+        flattened and ``None`` entries are ignored.
+    :type files: str or list
+    :param params: Additional values that change the cached artefact.
+    :return: Hexadecimal SHA-1 digest.
+    :rtype: str
+    """
+    if isinstance(files, str):
+        files = [files]
+
+    sha = hashlib.sha1()
+    for file in _flatten(files):
+        if file is None:
+            continue
+        stat = os.stat(file)
+        sha.update(
+            f"{os.path.abspath(file)}:{stat.st_size}:{stat.st_mtime_ns};".encode()
+        )
+    for key in sorted(params):
+        sha.update(f"{key}={params[key]!r};".encode())
+    return sha.hexdigest()
+
+
+def image_fingerprint(files, **params):
+    """
+    Fingerprint images by their content together with parameters.
+
+    Unlike :func:`file_fingerprint` the key only depends on the voxel data, shape
+    and affine of the images, so an identical image rewritten elsewhere, e.g. in a
+    fresh working directory, gets the same key.
+
+    :param files: Image path(s) the cached artefact is derived from.
+    :type files: str or list
+    :param params: Additional values that change the cached artefact.
+    :return: Hexadecimal SHA-1 digest.
+    :rtype: str
+    """
+    if isinstance(files, str):
+        files = [files]
+
+    sha = hashlib.sha1()
+    for file in _flatten(files):
+        if file is None:
+            continue
+        img = nib.load(file)
+        data = np.ascontiguousarray(np.asanyarray(img.dataobj))
+        sha.update(f"{data.dtype.str}:{data.shape};".encode())
+        sha.update(np.round(img.affine, 6).tobytes())
+        sha.update(memoryview(data.reshape(-1).view(np.uint8)))
+    for key in sorted(params):
+        sha.update(f"{key}={params[key]!r};".encode())
+    return sha.hexdigest()
+
+
+def cache_file(cache_dir, stem, key, extension):
+    """
+    Return the path of a cache entry, creating the cache directory if needed.
+
+    :param cache_dir: Cache directory.
+    :type cache_dir: str
+    :param stem: Human readable name of the cached artefact.
+    :type stem: str
+    :param key: Fingerprint of the inputs, see :func:`file_fingerprint`.
+    :type key: str
+    :param extension: File extension including the leading dot, e.g. ``.npz``.
+    :type extension: str
+    :return: Path to the cache entry.
+    :rtype: str
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    return os.path.join(cache_dir, f"{stem}_{key[:16]}{extension}")
+
+
+def remove_stale(cache_dir, stem, extension, keep):
+    """
+    Remove cache entries of ``stem`` other than ``keep``.
+
+    Entries that are directories, see :func:`cache_file` with an empty extension,
+    are removed with their contents.
+
+    :param cache_dir: Cache directory.
+    :type cache_dir: str
+    :param stem: Name of the cached artefact, as passed to :func:`cache_file`.
+    :type stem: str
+    :param extension: File extension of the cache entries.
+    :type extension: str
+    :param keep: Path of the current cache entry.
+    :type keep: str
+    """
+    # only the key follows the stem, so entries of longer stems are not matched
+    name = f"{glob.escape(stem)}_{'[0-9a-f]' * 16}{extension}"
+    pattern = os.path.join(glob.escape(cache_dir), name)
+    for stale in glob.glob(pattern):
+        if os.path.abspath(stale) != os.path.abspath(keep):
+            try:
+                if os.path.isdir(stale):
+                    shutil.rmtree(stale)
+                else:
+                    os.remove(stale)
+            except FileNotFoundError:
+                pass
+
+
+def atomic_write(out_file, write):
+    """
+    Write a cache entry through a temporary file so readers never see partial files.
+
+    :param out_file: Final path of the cache entry.
+    :type out_file: str
+    :param write: Callable receiving the temporary path to write to.
+    :type write: callable
+    :return: ``out_file``
+    :rtype: str
+    """
+    directory, name = os.path.split(out_file)
+    extension = os.path.splitext(name)[1]
+    fd, tmp_file = tempfile.mkstemp(dir=directory, prefix=".tmp_", suffix=extension)
+    os.close(fd)
+    try:
+        write(tmp_file)
+        os.replace(tmp_file, out_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    return out_file
+
+
+@contextmanager
+def locked(path):
+    """
+    Hold an exclusive lock on ``path`` for read-modify-write updates.
+
+    The lock is taken on ``<path>.lock``, so ``path`` itself can be replaced with
+    :func:`atomic_write` while the lock is held.
+
+    :param path: Path to the shared file.
+    :type path: str
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(f"{path}.lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def save_operator(operator, sizes, out_file):
+    """
+    Save a sparse (CSR) operator with the sizes of its row blocks.
+
+    :param operator: Operator to save.
+    :type operator: scipy.sparse.csr_matrix
+    :param sizes: Integers stored alongside the operator, e.g. rows per hemisphere.
+    :type sizes: list
+    :param out_file: Path to the ``.npz`` file.
+    :type out_file: str
+    """
+    np.savez(
+        out_file,
+        data=operator.data,
+        indices=operator.indices,
+        indptr=operator.indptr,
+        shape=np.array(operator.shape),
+        sizes=np.array(sizes),
+    )
+
+
+def load_operator(in_file):
+    """
+    Load an operator saved by :func:`save_operator`.
+
+    :param in_file: Path to the ``.npz`` file.
+    :type in_file: str
+    :return: ``(operator, sizes)`` tuple.
+    :rtype: tuple
+    """
+    with np.load(in_file) as cached:
+        operator = sparse.csr_matrix(
+            (cached["data"], cached["indices"], cached["indptr"]),
+            shape=tuple(cached["shape"]),
+        )
+        return operator, [int(size) for size in cached["sizes"]]
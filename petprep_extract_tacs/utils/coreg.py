@@ -0,0 +1,82 @@
+"""
+Persistent cache of the PET to T1w registrations computed with ``mri_coreg``.
+
+The nipype working directories are removed at the end of every invocation, so
+registrations are cached outside of them, keyed by the content of the
+time-weighted average PET and the reference image together with the
+``mri_coreg`` parameters. Reprocessing a run, e.g. to add an atlas, reuses the
+registration instead of running ``mri_coreg`` again.
+"""
+
+import os
+import shutil
+
+from nipype.interfaces.freesurfer import MRICoreg
+
+from petprep_extract_tacs.utils.cache import atomic_write, cache_file, image_fingerprint
+
+# Bump when the mri_coreg call changes
+COREG_VERSION = 1
+
+
+def coreg_key(source_file, reference_file, subject_id):
+    """
+    Key of the registration of a time-weighted average PET.
+
+    :param source_file: Path to the time-weighted average PET.
+    :type source_file: str
+    :param reference_file: Path to the reference image, e.g. ``brainmask.mgz``.
+    :type reference_file: str
+    :param subject_id: FreeSurfer subject, e.g. ``sub-01``.
+    :type subject_id: str
+    :return: Hexadecimal SHA-1 digest, see
+        :func:`petprep_extract_tacs.utils.cache.image_fingerprint`.
+    :rtype: str
+    """
+    return image_fingerprint(
+        [source_file, reference_file],
+        program="mri_coreg",
+        subject_id=subject_id,
+        version=COREG_VERSION,
+    )
+
+
+def cached_coreg(
+    source_file, reference_file, subjects_dir, subject_id, out_file, cache_dir=None
+):
+    """
+    Register a PET to the T1w with ``mri_coreg``, reusing cached registrations.
+
+    :param source_file: Path to the time-weighted average PET.
+    :type source_file: str
+    :param reference_file: Path to the reference image, e.g. ``brainmask.mgz``.
+    :type reference_file: str
+    :param subjects_dir: FreeSurfer subjects directory.
+    :type subjects_dir: str
+    :param subject_id: FreeSurfer subject, e.g. ``sub-01``.
+    :type subject_id: str
+    :param out_file: Path to the output ``.lta`` file.
+    :type out_file: str
+    :param cache_dir: Optional directory in which the registration is cached.
+    :type cache_dir: str
+    :return: ``out_file``
+    :rtype: str
+    """
+    if cache_dir:
+        key = coreg_key(source_file, reference_file, subject_id)
+        cached = cache_file(cache_dir, "coreg", key, ".lta")
+        if os.path.exists(cached):
+            shutil.copyfile(cached, out_file)
+            return out_file
+
+    MRICoreg(
+        source_file=source_file,
+        reference_file=reference_file,
+        subjects_dir=subjects_dir,
+        subject_id=subject_id,
+        out_lta_file=out_file,
+    ).run()
+
+    if cache_dir:
+        atomic_write(cached, lambda tmp_file: shutil.copyfile(out_file, tmp_file))
+    return out_file
@@ -5,6 +5,21 @@ import shutil
 from pathlib import Path
 
 
+def link_or_copy(src, dst):
+    """
+    Hard link ``src`` to ``dst``, copying it when linking is not possible.
+
+    Outputs shared by all PET runs of a subject, such as the converted label
+    volumes, are then stored once on disk.
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy(src, dst)
+
+
 def copy_datasink_to_derivatives(bids_dir, output_dir):
     """Copy workflow outputs from the datasink into the PET-BIDS derivatives folder."""
     datasink_dir = Path(bids_dir) / "petprep_extract_tacs_wf" / "datasink"
@@ -30,7 +45,7 @@ def copy_datasink_to_derivatives(bids_dir, output_dir):
         for root, dirs, files in os.walk(pet_dir):
             for file in files:
                 if not file.startswith("."):
-                    shutil.copy(
+                    link_or_copy(
                         os.path.join(root, file),
                         os.path.join(sub_out_dir, f"{file_prefix}_{file}"),
                     )
@@ -40,4 +55,6 @@ def copy_datasink_to_derivatives(bids_dir, output_dir):
             reg_pattern += f"_ses-{ses_id}"
         reg_pattern += f"*{file_prefix}_from-pet_to-t1w_reg.lta"
         for reg_file in glob.glob(os.path.join(datasink_dir, reg_pattern)):
-            shutil.copy(reg_file, os.path.join(sub_out_dir, os.path.basename(reg_file)))
+            link_or_copy(
+                reg_file, os.path.join(sub_out_dir, os.path.basename(reg_file))
+            )
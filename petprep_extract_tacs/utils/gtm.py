@@ -0,0 +1,1060 @@
+"""
+Native geometric transfer matrix (GTM) analysis of PET volumes.
+
+Reproduces the parts of ``mri_gtmpvc`` used by the workflow. The high resolution
+``gtmseg.mgz`` is mapped into PET space once with the ``mri_coreg`` registration,
+as the fraction of every PET voxel covered by each segment. The uncorrected
+regional means (``--no-pvc``) are derived from these fractions, which only depend
+on the segmentation, the registration and the PET grid and are therefore cached.
+
+For partial volume correction the fractions are smoothed with the point spread
+function (PSF) of the scanner into regional spread functions, cached per PSF,
+and the least squares system is solved for blocks of frames. The adaptive GTM
+searches the PSF that best explains the time-weighted average PET, evaluating
+candidate PSFs in parallel. The fractions and the automatic mask of a run can be
+prepared once with :func:`gtm_prep` and shared by all variants, which stream the
+frames of the masked voxels within the memory budget.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+from scipy import linalg, sparse
+
+from petprep_extract_tacs.utils.cache import (
+    atomic_write,
+    cache_file,
+    file_fingerprint,
+    load_operator,
+    remove_stale,
+    save_operator,
+)
+from petprep_extract_tacs.utils.pet import iter_frame_blocks, run_name
+from petprep_extract_tacs.utils.resample import lta_ras2ras, read_lta
+from petprep_extract_tacs.utils.segstats import default_ctab_file, load_labels
+from petprep_extract_tacs.utils.smooth import fwhm_to_sigma, gaussian_smooth
+
+# Bump when the layout of cached segment fractions or bases changes
+GTM_FRACTIONS_VERSION = 1
+GTM_BASIS_VERSION = 1
+
+# Number of bases cached per run, the least recently used are removed
+GTM_BASIS_ENTRIES = 64
+
+# Smoothed fractions below this value are left out of the GTM basis
+_BASIS_THRESHOLD = 1e-6
+
+# Minimum number of candidate FWHMs evaluated per refinement of the PSF search
+PSF_CANDIDATES = 5
+
+# Tissue types of gtmseg.ctab left out of the fit by ``--opt-brain``
+NON_BRAIN_TISSUES = ("head",)
+
+# Number of segmentation voxels mapped into PET space at once
+_SEGMENTATION_CHUNK = 2**22
+
+# ``--auto-mask FWHM thresh`` used by the workflow
+DEFAULT_AUTO_MASK = (1, 0.1)
+
+# Segments merged by ``mri_gtmpvc --default-seg-merge``, see FreeSurfer's
+# GTMdefaultSegReplacmentList
+DEFAULT_SEG_MERGE = {
+    1033: 1030,  # temporal pole -> superior temporal
+    2033: 2030,
+    1034: 1030,  # transverse temporal -> superior temporal
+    2034: 2030,
+    1001: 1015,  # banks of the STS -> middle temporal
+    2001: 2015,
+    1032: 1027,  # frontal pole -> rostral middle frontal
+    2032: 2027,
+    1000: 0,  # unknown cortex
+    2000: 0,
+    85: 0,  # optic chiasm
+    4: 24,  # ventricles, choroid plexus and vessels -> CSF
+    5: 24,
+    14: 24,
+    15: 24,
+    72: 24,
+    31: 24,
+    43: 24,
+    44: 24,
+    63: 24,
+    30: 24,
+    62: 24,
+    80: 24,
+}
+
+
+def read_gtm_ctab(ctab_file):
+    """
+    Read a color table with tissue types, such as ``gtmseg.ctab``.
+
+    :param ctab_file: Path to the color table.
+    :type ctab_file: str
+    :return: DataFrame with ``index``, ``name`` and ``tissue`` columns; the tissue
+        is ``unknown`` when the table has no tissue types.
+    :rtype: pandas.DataFrame
+    """
+    entries, tissue_types = [], {}
+    with open(ctab_file) as f:
+        for line in f:
+            fields = line.split()
+            if not fields:
+                continue
+            if fields[0] == "#ctTType" and len(fields) > 2:
+                tissue_types[int(fields[1])] = fields[2]
+            elif not fields[0].startswith("#"):
+                tissue = int(fields[6]) if len(fields) > 6 else None
+                entries.append((int(fields[0]), fields[1], tissue))
+
+    ctab_df = pd.DataFrame(entries, columns=["index", "name", "tissue"])
+    ctab_df["tissue"] = [tissue_types.get(tt, "unknown") for tt in ctab_df["tissue"]]
+    return ctab_df.drop_duplicates(subset="index").reset_index(drop=True)
+
+
+def merge_segments(labels, merge=None):
+    """
+    Replace segment ids as done by ``mri_gtmpvc --default-seg-merge``.
+
+    :param labels: Integer label array.
+    :type labels: numpy.ndarray
+    :param merge: Mapping of segment ids onto their replacements, defaults to
+        ``DEFAULT_SEG_MERGE``.
+    :type merge: dict
+    :return: Label array with the replacements applied.
+    :rtype: numpy.ndarray
+    """
+    merge = DEFAULT_SEG_MERGE if merge is None else merge
+    if not merge:
+        return labels
+    sources = np.array(sorted(merge), dtype=labels.dtype)
+    targets = np.array([merge[source] for source in sources], dtype=labels.dtype)
+    labels = labels.copy()
+    replace = np.isin(labels, sources)
+    labels[replace] = targets[np.searchsorted(sources, labels[replace])]
+    return labels
+
+
+def prepare_fractions(segmentation_file, lta_file, pet_img, merge=None):
+    """
+    Fraction of every PET voxel covered by each segment of a segmentation.
+
+    Every voxel of the (high resolution) segmentation is assigned to the PET voxel
+    containing its centre, so the fractions are the share of the segmentation
+    voxels within a PET voxel that belong to each segment.
+
+    :param segmentation_file: Path to ``gtmseg.mgz``.
+    :type segmentation_file: str
+    :param lta_file: Path to the PET to T1w ``.lta`` registration.
+    :type lta_file: str
+    :param pet_img: Loaded PET image.
+    :type pet_img: nibabel.spatialimages.SpatialImage
+    :param merge: Segment replacements, see :func:`merge_segments`. Use an empty
+        dict to keep all segments.
+    :type merge: dict
+    :return: Segment ids and a CSR matrix of shape (PET voxels, segments).
+    :rtype: tuple
+    """
+    seg_img = nib.load(segmentation_file)
+    labels, _ = load_labels(segmentation_file)
+    labels = merge_segments(labels, merge).ravel()
+
+    seg2pet = (
+        np.linalg.inv(pet_img.affine)
+        @ np.linalg.inv(lta_ras2ras(read_lta(lta_file)))
+        @ seg_img.affine
+    )
+    n_pet = int(np.prod(pet_img.shape[:3]))
+    pet_shape = np.array(pet_img.shape[:3])[:, np.newaxis]
+
+    # PET voxel of every segmentation voxel, in chunks to bound memory
+    pet_voxels = np.full(labels.size, -1, dtype=np.int64)
+    for start in range(0, labels.size, _SEGMENTATION_CHUNK):
+        stop = min(start + _SEGMENTATION_CHUNK, labels.size)
+        ijk = np.array(np.unravel_index(np.arange(start, stop), seg_img.shape[:3]))
+        pet_ijk = np.rint(seg2pet[:3, :3] @ ijk + seg2pet[:3, 3:]).astype(np.int64)
+        inside = np.all((pet_ijk >= 0) & (pet_ijk < pet_shape), axis=0)
+        pet_voxels[start:stop][inside] = np.ravel_multi_index(
+            pet_ijk[:, inside], pet_img.shape[:3]
+        )
+
+    inside = pet_voxels >= 0
+    pet_voxels, labels = pet_voxels[inside], labels[inside]
+    totals = np.bincount(pet_voxels, minlength=n_pet)
+
+    segids = np.unique(labels)
+    segids = segids[segids != 0]
+    in_segment = labels != 0
+    positions = np.searchsorted(segids, labels[in_segment])
+    pet_voxels = pet_voxels[in_segment]
+
+    fractions = sparse.csr_matrix(
+        (1.0 / totals[pet_voxels], (pet_voxels, positions)),
+        shape=(n_pet, len(segids)),
+        dtype=np.float32,
+    )
+    fractions.sum_duplicates()
+    return segids, fractions
+
+
+def load_fractions(segmentation_file, lta_file, pet_img, merge=None, cache_dir=None):
+    """
+    Segment fractions in PET space, see :func:`prepare_fractions`, using a cache.
+
+    Cache entries are kept per run, keyed by the segmentation, the values of the
+    registration and the PET grid, so the dynamic PET and its time-weighted
+    average share them. A new registration of the run replaces the entry.
+
+    :param segmentation_file: Path to ``gtmseg.mgz``.
+    :type segmentation_file: str
+    :param lta_file: Path to the PET to T1w ``.lta`` registration.
+    :type lta_file: str
+    :param pet_img: Loaded PET image.
+    :type pet_img: nibabel.spatialimages.SpatialImage
+    :param merge: Segment replacements, see :func:`merge_segments`.
+    :type merge: dict
+    :param cache_dir: Optional directory in which the fractions are cached.
+    :type cache_dir: str
+    :return: See :func:`prepare_fractions`.
+    :rtype: tuple
+    """
+    if cache_dir:
+        merge_items = sorted((DEFAULT_SEG_MERGE if merge is None else merge).items())
+        # keyed by the values of the registration, as it is written again into a
+        # new working directory by every invocation
+        key = file_fingerprint(
+            segmentation_file,
+            merge=merge_items,
+            ras2ras=np.round(lta_ras2ras(read_lta(lta_file)), 6).tolist(),
+            pet_affine=np.round(pet_img.affine, 6).tolist(),
+            pet_shape=tuple(pet_img.shape[:3]),
+            version=GTM_FRACTIONS_VERSION,
+        )
+        stem = f"gtm_fractions_{run_name(pet_img.get_filename())}"
+        cached = cache_file(cache_dir, stem, key, ".npz")
+        if os.path.exists(cached):
+            try:
+                fractions, segids = load_operator(cached)
+                return np.array(segids), fractions
+            except (OSError, ValueError, KeyError):
+                pass
+
+    segids, fractions = prepare_fractions(segmentation_file, lta_file, pet_img, merge)
+    if cache_dir:
+        atomic_write(
+            cached, lambda tmp_file: save_operator(fractions, segids, tmp_file)
+        )
+        remove_stale(cache_dir, stem, ".npz", keep=cached)
+    return segids, fractions
+
+
+def pet_space_labels(fractions):
+    """
+    Segment with the largest fraction of every PET voxel.
+
+    :param fractions: Segment fractions, see :func:`prepare_fractions`.
+    :type fractions: scipy.sparse.csr_matrix
+    :return: Position of the segment of each PET voxel, -1 where no segment
+        covers the voxel.
+    :rtype: numpy.ndarray
+    """
+    positions = np.asarray(fractions.argmax(axis=1)).ravel()
+    positions[fractions.getnnz(axis=1) == 0] = -1
+    return positions
+
+
+def auto_mask(mean_frame, zooms, fwhm, threshold):
+    """
+    Mask as computed by ``mri_gtmpvc --auto-mask``.
+
+    :param mean_frame: Frame average of the PET.
+    :type mean_frame: numpy.ndarray
+    :param zooms: Voxel sizes in mm.
+    :type zooms: tuple
+    :param fwhm: FWHM in mm of the smoothing applied before thresholding.
+    :type fwhm: float
+    :param threshold: Fraction of the global mean of the smoothed volume.
+    :type threshold: float
+    :return: Boolean mask.
+    :rtype: numpy.ndarray
+    """
+    smoothed = gaussian_smooth(mean_frame, fwhm, zooms) if fwhm else mean_frame
+    return smoothed > threshold * smoothed.mean()
+
+
+def gtm_segments(segmentation_file, segids, ctab_file=None):
+    """
+    Names and tissue types of the GTM segments.
+
+    :param segmentation_file: Path to ``gtmseg.mgz``; ``gtmseg.ctab`` next to it is
+        used when ``ctab_file`` is not given.
+    :type segmentation_file: str
+    :param segids: Segment ids.
+    :type segids: numpy.ndarray
+    :param ctab_file: Optional color table.
+    :type ctab_file: str
+    :return: Tuple of the segment names and tissue types.
+    :rtype: tuple
+    """
+    if ctab_file is None:
+        ctab_file = os.path.join(os.path.dirname(segmentation_file), "gtmseg.ctab")
+        if not os.path.exists(ctab_file):
+            ctab_file = default_ctab_file()
+
+    names = [f"Seg{segid:04d}" for segid in segids]
+    tissues = ["unknown"] * len(segids)
+    if ctab_file:
+        ctab_df = read_gtm_ctab(ctab_file).set_index("index")
+        for idx, segid in enumerate(segids):
+            if segid in ctab_df.index:
+                names[idx] = ctab_df.at[segid, "name"]
+                tissues[idx] = ctab_df.at[segid, "tissue"]
+    return names, tissues
+
+
+def write_gtm_stats(out_file, segids, names, tissues, nvoxels):
+    """
+    Write a ``gtm.stats.dat`` table.
+
+    The columns are the row number, segment id, name, tissue type and number of
+    PET voxels of each segment, as in the first columns written by
+    ``mri_gtmpvc``.
+
+    :param out_file: Path to the table.
+    :type out_file: str
+    :param segids: Segment ids.
+    :type segids: numpy.ndarray
+    :param names: Segment names.
+    :type names: list
+    :param tissues: Segment tissue types.
+    :type tissues: list
+    :param nvoxels: Number of PET voxels of each segment.
+    :type nvoxels: numpy.ndarray
+    :return: ``out_file``
+    :rtype: str
+    """
+    with open(out_file, "w") as f:
+        for row, (segid, name, tissue, nvox) in enumerate(
+            zip(segids, names, tissues, nvoxels), start=1
+        ):
+            f.write(f"{row:3d} {segid:4d} {name:<31s} {tissue:<13s} {nvox:6d}\n")
+    return out_file
+
+
+def iter_voxel_blocks(pet_img, voxels, mem_mb=None):
+    """
+    Iterate over the frames of some PET voxels in blocks of frames.
+
+    :param pet_img: Loaded (3D or 4D) PET image.
+    :type pet_img: nibabel.spatialimages.SpatialImage
+    :param voxels: Flat indices of the voxels to read.
+    :type voxels: numpy.ndarray
+    :param mem_mb: Memory budget in MB for the frames read at once, see
+        :func:`petprep_extract_tacs.utils.pet.iter_frame_blocks`.
+    :type mem_mb: float
+    :return: Generator of ``(start, stop, block)`` tuples, where ``block`` has shape
+        (voxels, stop - start).
+    :rtype: generator
+    """
+    for start, stop, block in iter_frame_blocks(pet_img, mem_mb):
+        yield start, stop, block.reshape(-1, stop - start)[voxels]
+
+
+def read_voxels(pet_img, voxels, mem_mb=None):
+    """
+    Read the frames of some PET voxels, streaming blocks of frames from disk.
+
+    :param pet_img: Loaded (3D or 4D) PET image.
+    :type pet_img: nibabel.spatialimages.SpatialImage
+    :param voxels: Flat indices of the voxels to read.
+    :type voxels: numpy.ndarray
+    :param mem_mb: Memory budget in MB for the frames read at once.
+    :type mem_mb: float
+    :return: Array of shape (voxels, frames).
+    :rtype: numpy.ndarray
+    """
+    n_frames = pet_img.shape[3] if len(pet_img.shape) > 3 else 1
+    data = np.empty((len(voxels), n_frames), dtype=np.float32)
+    for start, stop, block in iter_voxel_blocks(pet_img, voxels, mem_mb):
+        data[:, start:stop] = block
+    return data
+
+
+def gtm_prep(
+    pet_file,
+    segmentation_file,
+    lta_file,
+    merge=None,
+    mask=DEFAULT_AUTO_MASK,
+    mem_mb=None,
+    cache_dir=None,
+):
+    """
+    Geometric preprocessing shared by all GTM variants of a PET run.
+
+    Collects the segment fractions in PET space and the voxels within the
+    automatic mask, so the variants only differ in their solve step. The frames
+    are not part of it, every variant streams them in blocks, see
+    :func:`iter_voxel_blocks`.
+
+    :param pet_file: Path to the (3D or 4D) PET volume.
+    :type pet_file: str
+    :param segmentation_file: Path to ``gtmseg.mgz``.
+    :type segmentation_file: str
+    :param lta_file: Path to the PET to T1w ``.lta`` registration.
+    :type lta_file: str
+    :param merge: Segment replacements, see :func:`merge_segments`.
+    :type merge: dict
+    :param mask: ``(fwhm, threshold)`` of the automatic mask, see
+        :func:`auto_mask`, or ``None`` for no mask.
+    :type mask: tuple
+    :param mem_mb: Memory budget in MB for the frames read at once for the mask.
+    :type mem_mb: float
+    :param cache_dir: Optional directory in which the segment fractions are cached.
+    :type cache_dir: str
+    :return: Dict with the ``segids`` and ``fractions``, the flat indices of the
+        masked ``voxels`` and the ``shape`` of the PET grid.
+    :rtype: dict
+    """
+    pet_img = nib.load(pet_file)
+    shape = tuple(pet_img.shape[:3])
+    segids, fractions = load_fractions(
+        segmentation_file, lta_file, pet_img, merge, cache_dir
+    )
+
+    if mask:
+        n_frames = pet_img.shape[3] if len(pet_img.shape) > 3 else 1
+        frame_sum = np.zeros(shape, dtype=np.float32)
+        for _, _, block in iter_frame_blocks(pet_img, mem_mb):
+            frame_sum += block.sum(axis=3)
+        zooms = pet_img.header.get_zooms()[:3]
+        voxels = np.flatnonzero(auto_mask(frame_sum / n_frames, zooms, *mask))
+    else:
+        voxels = np.arange(np.prod(shape))
+
+    return {
+        "segids": segids,
+        "fractions": fractions,
+        "voxels": voxels,
+        "shape": shape,
+    }
+
+
+def save_gtm_prep(out_file, prep):
+    """
+    Save the output of :func:`gtm_prep`.
+
+    :param out_file: Path to the ``.npz`` file.
+    :type out_file: str
+    :param prep: See :func:`gtm_prep`.
+    :type prep: dict
+    :return: ``out_file``
+    :rtype: str
+    """
+    fractions = prep["fractions"]
+    with open(out_file, "wb") as fobj:
+        np.savez(
+            fobj,
+            segids=prep["segids"],
+            data=fractions.data,
+            indices=fractions.indices,
+            indptr=fractions.indptr,
+            fractions_shape=np.array(fractions.shape),
+            voxels=prep["voxels"],
+            shape=np.array(prep["shape"]),
+        )
+    return out_file
+
+
+def load_gtm_prep(in_file):
+    """
+    Load the output of :func:`gtm_prep` saved with :func:`save_gtm_prep`.
+
+    :param in_file: Path to the ``.npz`` file.
+    :type in_file: str
+    :return: See :func:`gtm_prep`.
+    :rtype: dict
+    """
+    with np.load(in_file) as prep:
+        return {
+            "segids": prep["segids"],
+            "fractions": sparse.csr_matrix(
+                (prep["data"], prep["indices"], prep["indptr"]),
+                shape=tuple(prep["fractions_shape"]),
+            ),
+            "voxels": prep["voxels"],
+            "shape": tuple(int(dim) for dim in prep["shape"]),
+        }
+
+
+def write_gtm_outputs(out_file, values, segmentation_file, segids, nvoxels, ctab_file):
+    """
+    Write regional values as a (segments, 1, 1, frames) volume with its stats table.
+
+    :param out_file: Path to the volume, ``gtm.stats.dat`` is written next to it.
+    :type out_file: str
+    :param values: Array of shape (segments, frames).
+    :type values: numpy.ndarray
+    :param segmentation_file: Path to ``gtmseg.mgz``, see :func:`gtm_segments`.
+    :type segmentation_file: str
+    :param segids: Segment ids.
+    :type segids: numpy.ndarray
+    :param nvoxels: Number of PET voxels of each segment.
+    :type nvoxels: numpy.ndarray
+    :param ctab_file: Optional color table, see :func:`gtm_segments`.
+    :type ctab_file: str
+    :return: Paths to the volume and the stats table.
+    :rtype: tuple
+    """
+    out_dir = os.path.dirname(out_file)
+    os.makedirs(out_dir, exist_ok=True)
+    nib.save(
+        nib.Nifti1Image(
+            values.astype(np.float32).reshape(len(segids), 1, 1, -1), np.eye(4)
+        ),
+        out_file,
+    )
+
+    names, tissues = gtm_segments(segmentation_file, segids, ctab_file)
+    stats_file = write_gtm_stats(
+        os.path.join(out_dir, "gtm.stats.dat"), segids, names, tissues, nvoxels
+    )
+    return out_file, stats_file
+
+
+def compute_gtm_nopvc(
+    pet_file,
+    segmentation_file,
+    lta_file,
+    out_dir,
+    ctab_file=None,
+    merge=None,
+    mask=DEFAULT_AUTO_MASK,
+    mem_mb=None,
+    cache_dir=None,
+    prep_file=None,
+):
+    """
+    Regional means of the PET in the GTM segments without partial volume correction.
+
+    Native replacement for ``mri_gtmpvc --default-seg-merge --auto-mask 1 .1
+    --no-pvc --no-rescale``. Every PET voxel is labelled with the segment covering
+    most of it and each segment is averaged over its voxels within the mask.
+
+    :param pet_file: Path to the (3D or 4D) PET volume.
+    :type pet_file: str
+    :param segmentation_file: Path to ``gtmseg.mgz``.
+    :type segmentation_file: str
+    :param lta_file: Path to the PET to T1w ``.lta`` registration.
+    :type lta_file: str
+    :param out_dir: Directory in which ``nopvc.nii.gz`` and ``gtm.stats.dat`` are
+        written.
+    :type out_dir: str
+    :param ctab_file: Optional color table, see :func:`gtm_segments`.
+    :type ctab_file: str
+    :param merge: Segment replacements, see :func:`merge_segments`.
+    :type merge: dict
+    :param mask: ``(fwhm, threshold)`` of the automatic mask, ``None`` for no mask.
+    :type mask: tuple
+    :param mem_mb: Memory budget in MB for the frames read at once.
+    :type mem_mb: float
+    :param cache_dir: Optional directory in which the segment fractions are cached.
+    :type cache_dir: str
+    :param prep_file: Output of :func:`gtm_prep` saved with :func:`save_gtm_prep`,
+        computed from ``pet_file`` when not given.
+    :type prep_file: str
+    :return: Paths to ``nopvc.nii.gz`` and ``gtm.stats.dat``.
+    :rtype: tuple
+    """
+    if prep_file:
+        prep = load_gtm_prep(prep_file)
+    else:
+        prep = gtm_prep(
+            pet_file, segmentation_file, lta_file, merge, mask, mem_mb, cache_dir
+        )
+    segids = prep["segids"]
+    positions = pet_space_labels(prep["fractions"])[prep["voxels"]]
+    labelled = positions >= 0
+    positions, voxels = positions[labelled], prep["voxels"][labelled]
+
+    nvoxels = np.bincount(positions, minlength=len(segids))
+    matrix = sparse.csr_matrix(
+        (1 / np.maximum(nvoxels, 1)[positions], (positions, np.arange(len(positions)))),
+        shape=(len(segids), len(positions)),
+    )
+    pet_img = nib.load(pet_file)
+    n_frames = pet_img.shape[3] if len(pet_img.shape) > 3 else 1
+    nopvc = np.empty((len(segids), n_frames))
+    for start, stop, block in iter_voxel_blocks(pet_img, voxels, mem_mb):
+        nopvc[:, start:stop] = matrix @ block
+
+    return write_gtm_outputs(
+        os.path.join(out_dir, "nopvc.nii.gz"),
+        nopvc,
+        segmentation_file,
+        segids,
+        nvoxels,
+        ctab_file,
+    )
+
+
+def segment_basis(fractions, shape, zooms, fwhm):
+    """
+    Regional spread functions of the segments for a point spread function.
+
+    Each column holds the fractions of a segment smoothed with the PSF, i.e. the
+    image of a unit activity in that segment. Every segment is smoothed within its
+    bounding box grown by the support of the Gaussian, so the cost depends on the
+    size of the segments rather than that of the PET volume.
+
+    :param fractions: Segment fractions, see :func:`prepare_fractions`.
+    :type fractions: scipy.sparse.csr_matrix
+    :param shape: Spatial shape of the PET volume.
+    :type shape: tuple
+    :param zooms: Voxel sizes of the PET volume in mm.
+    :type zooms: tuple
+    :param fwhm: FWHM of the PSF in mm, or one per spatial axis.
+    :type fwhm: float or tuple
+    :return: CSR matrix of shape (PET voxels, segments).
+    :rtype: scipy.sparse.csr_matrix
+    """
+    shape = np.array(shape[:3])
+    sigmas = np.broadcast_to(fwhm_to_sigma(fwhm, zooms), (3,))
+    # gaussian_filter1d truncates the kernel at four standard deviations
+    margin = np.ceil(4 * sigmas).astype(int) + 1
+
+    fractions = fractions.tocsc()
+    rows, cols, values = [], [], []
+    for col in range(fractions.shape[1]):
+        start, stop = fractions.indptr[col], fractions.indptr[col + 1]
+        if start == stop:
+            continue
+        ijk = np.array(np.unravel_index(fractions.indices[start:stop], shape))
+        lower = np.maximum(ijk.min(axis=1) - margin, 0)
+        upper = np.minimum(ijk.max(axis=1) + margin + 1, shape)
+
+        box = np.zeros(upper - lower, dtype=np.float32)
+        box[tuple(ijk - lower[:, np.newaxis])] = fractions.data[start:stop]
+        box = gaussian_smooth(box, fwhm, zooms)
+
+        local = np.flatnonzero(box > _BASIS_THRESHOLD)
+        local_ijk = np.array(np.unravel_index(local, box.shape))
+        rows.append(np.ravel_multi_index(local_ijk + lower[:, np.newaxis], shape))
+        cols.append(np.full(len(local), col))
+        values.append(box.ravel()[local])
+
+    if not rows:
+        return sparse.csr_matrix(fractions.shape, dtype=np.float32)
+    return sparse.csr_matrix(
+        (np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+        shape=fractions.shape,
+        dtype=np.float32,
+    )
+
+
+def _basis_dir(segmentation_file, lta_file, pet_img, merge, cache_dir):
+    merge_items = sorted((DEFAULT_SEG_MERGE if merge is None else merge).items())
+    key = file_fingerprint(
+        segmentation_file,
+        merge=merge_items,
+        ras2ras=np.round(lta_ras2ras(read_lta(lta_file)), 6).tolist(),
+        pet_affine=np.round(pet_img.affine, 6).tolist(),
+        pet_shape=tuple(pet_img.shape[:3]),
+        version=GTM_BASIS_VERSION,
+    )
+    stem = f"gtm_bases_{run_name(pet_img.get_filename())}"
+    basis_dir = cache_file(cache_dir, stem, key, "")
+    if not os.path.isdir(basis_dir):
+        os.makedirs(basis_dir, exist_ok=True)
+        # the bases of an earlier registration of the run are not used again
+        remove_stale(cache_dir, stem, "", keep=basis_dir)
+    return basis_dir
+
+
+def _remove_least_recently_used(basis_dir, n_entries):
+    entries = []
+    for entry in os.scandir(basis_dir):
+        try:
+            if entry.name.endswith(".npz") and not entry.name.startswith("."):
+                entries.append((entry.stat().st_mtime_ns, entry.path))
+        except FileNotFoundError:
+            pass
+    for _, path in sorted(entries)[: max(0, len(entries) - n_entries)]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def load_basis(
+    segmentation_file,
+    lta_file,
+    pet_img,
+    fwhm,
+    merge=None,
+    cache_dir=None,
+    fractions=None,
+):
+    """
+    Segment ids and regional spread functions, see :func:`segment_basis`.
+
+    When ``cache_dir`` is given the basis is cached per PSF in a directory of the
+    run, keyed like the segment fractions it is computed from, which replaces the
+    directory of an earlier registration of the run. Only the
+    :data:`GTM_BASIS_ENTRIES` most recently used bases of a run are kept.
+
+    :param segmentation_file: Path to ``gtmseg.mgz``.
+    :type segmentation_file: str
+    :param lta_file: Path to the PET to T1w ``.lta`` registration.
+    :type lta_file: str
+    :param pet_img: Loaded PET image.
+    :type pet_img: nibabel.spatialimages.SpatialImage
+    :param fwhm: FWHM of the PSF in mm, or one per spatial axis.
+    :type fwhm: float or tuple
+    :param merge: Segment replacements, see :func:`merge_segments`.
+    :type merge: dict
+    :param cache_dir: Optional directory in which the basis is cached.
+    :type cache_dir: str
+    :param fractions: Segment ids and fractions already loaded with
+        :func:`load_fractions`, to avoid loading them again.
+    :type fractions: tuple
+    :return: Segment ids and CSR basis of shape (PET voxels, segments).
+    :rtype: tuple
+    """
+    fwhm = tuple(np.round(np.broadcast_to(fwhm, (3,)), 4).tolist())
+    if cache_dir:
+        basis_dir = _basis_dir(segmentation_file, lta_file, pet_img, merge, cache_dir)
+        cached = os.path.join(basis_dir, "fwhm{:g}x{:g}x{:g}.npz".format(*fwhm))
+        if os.path.exists(cached):
+            try:
+                basis, segids = load_operator(cached)
+                # marks the basis as used
+                os.utime(cached)
+                return np.array(segids), basis
+            except (OSError, ValueError, KeyError):
+                pass
+
+    if fractions is None:
+        fractions = load_fractions(
+            segmentation_file, lta_file, pet_img, merge, cache_dir
+        )
+    segids, fractions = fractions
+    basis = segment_basis(
+        fractions, pet_img.shape[:3], pet_img.header.get_zooms()[:3], fwhm
+    )
+    if cache_dir:
+        atomic_write(cached, lambda tmp_file: save_operator(basis, segids, tmp_file))
+        _remove_least_recently_used(basis_dir, GTM_BASIS_ENTRIES)
+    return segids, basis
+
+
+def solve_gtm(basis, data):
+    """
+    Least squares regional values of all frames at once.
+
+    :param basis: Regional spread functions restricted to the voxels of ``data``.
+    :type basis: scipy.sparse.csr_matrix
+    :param data: Array of shape (voxels, frames).
+    :type data: numpy.ndarray
+    :return: Array of shape (segments, frames).
+    :rtype: numpy.ndarray
+    """
+    return gtm_solver(basis)(data)
+
+
+def gtm_solver(basis):
+    """
+    Least squares solver of the GTM system of a basis, for blocks of frames.
+
+    The normal equations are factorised once, so every block only costs the
+    product with the basis and the triangular solves.
+
+    :param basis: Regional spread functions restricted to the voxels of the data.
+    :type basis: scipy.sparse.csr_matrix
+    :return: Function mapping an array of shape (voxels, frames) onto the regional
+        values of shape (segments, frames).
+    :rtype: callable
+    """
+    gram = (basis.T @ basis).toarray().astype(np.float64)
+    try:
+        factor = linalg.cho_factor(gram)
+    except (linalg.LinAlgError, ValueError):
+        # segments without voxels in the mask make the system singular
+        factor = None
+
+    def solve(data):
+        rhs = np.asarray(basis.T @ data, dtype=np.float64)
+        if factor is None:
+            return linalg.lstsq(gram, rhs)[0]
+        return linalg.cho_solve(factor, rhs)
+
+    return solve
+
+
+def gtm_residual(basis, data):
+    """
+    Sum of squared residuals of the GTM fit of a volume.
+
+    :param basis: Regional spread functions restricted to the voxels of ``data``.
+    :type basis: scipy.sparse.csr_matrix
+    :param data: Array of shape (voxels,) or (voxels, frames).
+    :type data: numpy.ndarray
+    :return: Sum of squared residuals.
+    :rtype: float
+    """
+    data = np.asarray(data, dtype=np.float64).reshape(basis.shape[0], -1)
+    residual = data - basis @ solve_gtm(basis, data)
+    return float(np.sum(residual**2))
+
+
+def brain_segments(tissues):
+    """
+    Segments used by ``--opt-brain``, i.e. all but extracerebral tissue.
+
+    :param tissues: Tissue type of each segment, see :func:`gtm_segments`.
+    :type tissues: list
+    :return: Boolean array, true for brain segments.
+    :rtype: numpy.ndarray
+    """
+    return ~np.isin(tissues, NON_BRAIN_TISSUES)
+
+
+def optimize_psf(objective, search, n_threads=1, n_iter=4, tol=0.02):
+    """
+    Minimise an objective over an isotropic FWHM with parallel grid refinement.
+
+    Every iteration evaluates a grid of candidate FWHMs spanning the search range
+    concurrently and narrows the range to the neighbours of the best candidate,
+    until the range is below ``tol`` relative to the best FWHM.
+
+    :param objective: Callable mapping a FWHM in mm onto the value to minimise.
+    :type objective: callable
+    :param search: ``(lower, upper)`` FWHM range in mm.
+    :type search: tuple
+    :param n_threads: Number of candidates evaluated concurrently.
+    :type n_threads: int
+    :param n_iter: Maximum number of refinements.
+    :type n_iter: int
+    :param tol: Relative width of the search range at which the search stops.
+    :type tol: float
+    :return: Best FWHM and a dict of all evaluated FWHMs and objective values.
+    :rtype: tuple
+    """
+    n_threads = max(1, int(n_threads or 1))
+    n_candidates = max(PSF_CANDIDATES, n_threads)
+    lower, upper = (max(0.0, float(bound)) for bound in search)
+    evaluated = {}
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        for _ in range(max(1, n_iter)):
+            candidates = np.round(np.linspace(lower, upper, n_candidates), 4)
+            new = [fwhm for fwhm in candidates if fwhm not in evaluated]
+            evaluated.update(zip(new, executor.map(objective, new)))
+
+            best = int(np.argmin([evaluated[fwhm] for fwhm in candidates]))
+            lower = candidates[max(best - 1, 0)]
+            upper = candidates[min(best + 1, n_candidates - 1)]
+            if upper - lower <= tol * max(candidates[best], 1.0):
+                break
+
+    best = min(evaluated, key=evaluated.get)
+    return float(best), {float(fwhm): value for fwhm, value in evaluated.items()}
+
+
+def compute_agtm_psf(
+    pet_file,
+    segmentation_file,
+    lta_file,
+    out_file,
+    psf,
+    n_threads=1,
+    search=None,
+    n_iter=8,
+    tol=0.02,
+    mask=DEFAULT_AUTO_MASK,
+    brain_only=True,
+    merge=None,
+    ctab_file=None,
+    cache_dir=None,
+    prep_file=None,
+    mem_mb=None,
+):
+    """
+    Estimate the PSF of the scanner with the adaptive GTM.
+
+    Native replacement for ``mri_gtmpvc --opt 1D --opt-brain`` on the time-weighted
+    average PET. The isotropic FWHM minimising the residual of the GTM fit within
+    the (brain) mask is searched with :func:`optimize_psf`. The basis of every
+    candidate FWHM is built once and cached, see :func:`load_basis`.
+
+    :param pet_file: Path to the 3D (time-weighted average) PET volume.
+    :type pet_file: str
+    :param segmentation_file: Path to ``gtmseg.mgz``.
+    :type segmentation_file: str
+    :param lta_file: Path to the PET to T1w ``.lta`` registration.
+    :type lta_file: str
+    :param out_file: Path to the ``opt.params.dat`` file holding the FWHM along x,
+        y and z, as read by :func:`petprep_extract_tacs.utils.utils.get_opt_fwhm`.
+    :type out_file: str
+    :param psf: Initial guess of the FWHM in mm.
+    :type psf: float
+    :param n_threads: Number of candidate FWHMs evaluated concurrently.
+    :type n_threads: int
+    :param search: ``(lower, upper)`` FWHM range in mm, e.g. narrowed around a
+        previous estimate. Defaults to ``(psf / 4, 2 * psf)``, which is also
+        searched when the best FWHM lies on the border of ``search``.
+    :type search: tuple
+    :param n_iter: Maximum number of refinements of the search range.
+    :type n_iter: int
+    :param tol: Relative width of the search range at which the search stops.
+    :type tol: float
+    :param mask: ``(fwhm, threshold)`` of the automatic mask, or ``None``.
+    :type mask: tuple
+    :param brain_only: Only fit the voxels of brain segments.
+    :type brain_only: bool
+    :param merge: Segment replacements, see :func:`merge_segments`.
+    :type merge: dict
+    :param ctab_file: Optional color table with tissue types, see
+        :func:`gtm_segments`.
+    :type ctab_file: str
+    :param cache_dir: Optional directory in which the fractions and bases are cached.
+    :type cache_dir: str
+    :param prep_file: Output of :func:`gtm_prep` of a PET run on the grid of
+        ``pet_file``, whose fractions and mask are used. Computed from
+        ``pet_file`` when not given.
+    :type prep_file: str
+    :param mem_mb: Memory budget in MB for the frames read at once.
+    :type mem_mb: float
+    :return: ``out_file`` and the estimated FWHM.
+    :rtype: tuple
+    """
+    pet_img = nib.load(pet_file)
+    if prep_file:
+        prep = load_gtm_prep(prep_file)
+        if prep["shape"] != tuple(pet_img.shape[:3]):
+            raise ValueError(f"{pet_file} is not on the grid of {prep_file}")
+    else:
+        prep = gtm_prep(
+            pet_file, segmentation_file, lta_file, merge, mask, mem_mb, cache_dir
+        )
+    segids, fractions = prep["segids"], prep["fractions"]
+
+    positions = pet_space_labels(fractions)[prep["voxels"]]
+    keep = positions >= 0
+    if brain_only:
+        _, tissues = gtm_segments(segmentation_file, segids, ctab_file)
+        keep[keep] = brain_segments(tissues)[positions[keep]]
+    # the time-weighted average is a single frame
+    voxels = prep["voxels"][keep]
+    data = read_voxels(pet_img, voxels, mem_mb)
+
+    def objective(fwhm):
+        _, basis = load_basis(
+            segmentation_file,
+            lta_file,
+            pet_img,
+            fwhm,
+            merge,
+            cache_dir,
+            fractions=(segids, fractions),
+        )
+        return gtm_residual(basis[voxels], data)
+
+    full_search = (psf / 4, 2 * psf)
+    fwhm, _ = optimize_psf(objective, search or full_search, n_threads, n_iter, tol)
+    # a narrowed range that does not bracket the minimum is searched again in full
+    if search is not None and not search[0] < fwhm < search[1]:
+        fwhm, _ = optimize_psf(objective, full_search, n_threads, n_iter, tol)
+
+    os.makedirs(os.path.dirname(out_file), exist_ok=True)
+    with open(out_file, "w") as f:
+        f.write(f"{fwhm:.4f} {fwhm:.4f} {fwhm:.4f}\n")
+    return out_file, fwhm
+
+
+def compute_gtm_pvc(
+    pet_file,
+    segmentation_file,
+    lta_file,
+    out_dir,
+    fwhm,
+    ctab_file=None,
+    merge=None,
+    mask=DEFAULT_AUTO_MASK,
+    mem_mb=None,
+    cache_dir=None,
+    prep_file=None,
+):
+    """
+    Partial volume corrected regional values with the geometric transfer matrix.
+
+    Native replacement for ``mri_gtmpvc --psf-col --psf-row --psf-slice
+    --default-seg-merge --auto-mask 1 .1 --no-rescale``. The least squares system
+    of the regional spread functions is solved for all frames at once.
+
+    :param pet_file: Path to the (3D or 4D) PET volume.
+    :type pet_file: str
+    :param segmentation_file: Path to ``gtmseg.mgz``.
+    :type segmentation_file: str
+    :param lta_file: Path to the PET to T1w ``.lta`` registration.
+    :type lta_file: str
+    :param out_dir: Directory in which ``gtm.nii.gz`` and ``gtm.stats.dat`` are
+        written.
+    :type out_dir: str
+    :param fwhm: FWHM of the PSF in mm, or one per spatial axis.
+    :type fwhm: float or tuple
+    :param ctab_file: Optional color table, see :func:`gtm_segments`.
+    :type ctab_file: str
+    :param merge: Segment replacements, see :func:`merge_segments`.
+    :type merge: dict
+    :param mask: ``(fwhm, threshold)`` of the automatic mask, or ``None``.
+    :type mask: tuple
+    :param mem_mb: Memory budget in MB for the frames read at once.
+    :type mem_mb: float
+    :param cache_dir: Optional directory in which the basis is cached.
+    :type cache_dir: str
+    :param prep_file: Output of :func:`gtm_prep` saved with :func:`save_gtm_prep`,
+        computed from ``pet_file`` when not given.
+    :type prep_file: str
+    :return: Paths to ``gtm.nii.gz`` and ``gtm.stats.dat``.
+    :rtype: tuple
+    """
+    if prep_file:
+        prep = load_gtm_prep(prep_file)
+    else:
+        prep = gtm_prep(
+            pet_file, segmentation_file, lta_file, merge, mask, mem_mb, cache_dir
+        )
+    segids, fractions = prep["segids"], prep["fractions"]
+    pet_img = nib.load(pet_file)
+    _, basis = load_basis(
+        segmentation_file,
+        lta_file,
+        pet_img,
+        fwhm,
+        merge,
+        cache_dir,
+        fractions=(segids, fractions),
+    )
+
+    support = basis.getnnz(axis=1)[prep["voxels"]] > 0
+    voxels = prep["voxels"][support]
+    solve = gtm_solver(basis[voxels])
+    n_frames = pet_img.shape[3] if len(pet_img.shape) > 3 else 1
+    values = np.empty((len(segids), n_frames))
+    for start, stop, block in iter_voxel_blocks(pet_img, voxels, mem_mb):
+        values[:, start:stop] = solve(block)
+
+    positions = pet_space_labels(fractions)[voxels]
+    nvoxels = np.bincount(positions[positions >= 0], minlength=len(segids))
+    return write_gtm_outputs(
+        os.path.join(out_dir, "gtm.nii.gz"),
+        values,
+        segmentation_file,
+        segids,
+        nvoxels,
+        ctab_file,
+    )
@@ -0,0 +1,110 @@
+"""
+Persistent pybids index of the BIDS dataset.
+
+Indexing a large dataset with pybids takes minutes, so the index is stored in a
+pybids database and reused by later invocations. The database is rebuilt when the
+dataset has changed, which is detected by a fingerprint of the paths, sizes and
+modification times of the files pybids indexes. Computing the fingerprint only
+needs a ``stat`` of every file, which is much cheaper than indexing them.
+"""
+
+import hashlib
+import os
+
+from bids import BIDSLayout
+
+from petprep_extract_tacs.utils.cache import atomic_write
+
+# Bump when the way the layout is built changes
+LAYOUT_VERSION = 1
+
+
+def _scan(path, root):
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir(follow_symlinks=True):
+                yield from _scan(entry.path, root)
+            else:
+                stat = entry.stat()
+                yield os.path.relpath(entry.path, root), stat.st_size, stat.st_mtime_ns
+
+
+def dataset_fingerprint(bids_dir, **params):
+    """
+    Fingerprint the files of a BIDS dataset that pybids indexes.
+
+    Only the files at the top level and in the ``sub-*`` directories are
+    considered, derivatives and other directories are not part of the index.
+
+    :param bids_dir: Path to the BIDS dataset.
+    :type bids_dir: str
+    :param params: Additional values that change the index, e.g. ``validate``.
+    :return: Hexadecimal SHA-1 digest.
+    :rtype: str
+    """
+    bids_dir = os.path.abspath(bids_dir)
+
+    files = []
+    with os.scandir(bids_dir) as entries:
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir(follow_symlinks=True):
+                if entry.name.startswith("sub-"):
+                    files.extend(_scan(entry.path, bids_dir))
+            else:
+                stat = entry.stat()
+                files.append((entry.name, stat.st_size, stat.st_mtime_ns))
+
+    sha = hashlib.sha1(f"{bids_dir};".encode())
+    for path, size, mtime in sorted(files):
+        sha.update(f"{path}:{size}:{mtime};".encode())
+    for key in sorted(params):
+        sha.update(f"{key}={params[key]!r};".encode())
+    return sha.hexdigest()
+
+
+def get_layout(bids_dir, validate=False, database_dir=None):
+    """
+    Build the BIDSLayout of a dataset, reusing a stored index when it is current.
+
+    :param bids_dir: Path to the BIDS dataset.
+    :type bids_dir: str
+    :param validate: Whether pybids validates the files it indexes.
+    :type validate: bool
+    :param database_dir: Optional directory of the pybids database, the dataset
+        is indexed in memory otherwise.
+    :type database_dir: str
+    :return: Layout of the dataset.
+    :rtype: bids.BIDSLayout
+    """
+    if not database_dir:
+        return BIDSLayout(bids_dir, validate=validate)
+
+    fingerprint = dataset_fingerprint(
+        bids_dir, validate=validate, version=LAYOUT_VERSION
+    )
+    fingerprint_file = os.path.join(database_dir, "fingerprint")
+    try:
+        with open(fingerprint_file) as f:
+            current = f.read().strip() == fingerprint
+    except FileNotFoundError:
+        current = False
+
+    os.makedirs(database_dir, exist_ok=True)
+    layout = BIDSLayout(
+        bids_dir,
+        validate=validate,
+        database_path=database_dir,
+        reset_database=not current,
+    )
+    if not current:
+
+        def write(tmp_file):
+            with open(tmp_file, "w") as f:
+                f.write(fingerprint)
+
+        atomic_write(fingerprint_file, write)
+    return layout
@@ -0,0 +1,270 @@
+"""
+Native resampling of PET volumes into MNI305 space.
+
+Replaces ``mri_vol2vol --tal --talres 2``: the PET to T1w registration from
+``mri_coreg`` and the subject's ``talairach.xfm`` are composed into a single
+affine, so the PET is interpolated once onto the MNI305 grid. The interpolation
+operator is cached per run and registration. Optional smoothing is applied
+to the resampled blocks in memory, so the unsmoothed and smoothed volumes are
+written from the same pass, which can also produce the PET in T1w space.
+"""
+
+import os
+
+import nibabel as nib
+import numpy as np
+from scipy import sparse
+
+from petprep_extract_tacs.utils.cache import (
+    atomic_write,
+    cache_file,
+    file_fingerprint,
+    load_operator,
+    remove_stale,
+    save_operator,
+)
+from petprep_extract_tacs.utils.pet import run_name
+from petprep_extract_tacs.utils.resample import (
+    DEFAULT_MASK_MARGIN,
+    lta_ras2ras,
+    mask_voxels,
+    read_lta,
+    resample_frames,
+    save_masked,
+    target_to_source_vox2vox,
+    trilinear_operator,
+    write_frame_sets,
+)
+from petprep_extract_tacs.utils.smooth import smooth_blocks
+
+# Bump when the layout of cached MNI305 operators changes
+MNI305_OPERATOR_VERSION = 1
+
+
+def read_xfm(xfm_file):
+    """
+    Read the linear transform of an MNI ``.xfm`` file, e.g. ``talairach.xfm``.
+
+    :param xfm_file: Path to the ``.xfm`` file.
+    :type xfm_file: str
+    :return: 4x4 scanner RAS to MNI305 RAS matrix.
+    :rtype: numpy.ndarray
+    """
+    with open(xfm_file) as f:
+        text = f.read()
+
+    if "Linear_Transform" not in text:
+        raise ValueError(f"No linear transform in {xfm_file}")
+    values = text.split("Linear_Transform", 1)[1].split("=", 1)[1].split(";")[0]
+    matrix = np.eye(4)
+    matrix[:3] = np.array(values.split(), dtype=float).reshape(3, 4)
+    return matrix
+
+
+def mni305_template(resolution=2):
+    """
+    FreeSurfer's MNI305 template of the grid used by ``mri_vol2vol --talres``.
+
+    :param resolution: Voxel size in mm, 1 or 2.
+    :type resolution: int
+    :return: Path to ``$FREESURFER_HOME/average/mni305.cor.subfov<resolution>.mgz``.
+    :rtype: str
+    """
+    template_file = os.path.join(
+        os.environ.get("FREESURFER_HOME", ""),
+        "average",
+        f"mni305.cor.subfov{int(resolution)}.mgz",
+    )
+    if not os.path.exists(template_file):
+        raise FileNotFoundError(f"Could not locate the MNI305 template {template_file}")
+    return template_file
+
+
+def mni305_vox2vox(lta_file, xfm_file, source_affine, template_affine):
+    """
+    Map MNI305 template voxel coordinates onto source voxel coordinates.
+
+    :param lta_file: Path to the PET to T1w ``.lta`` registration.
+    :type lta_file: str
+    :param xfm_file: Path to the subject's ``talairach.xfm``.
+    :type xfm_file: str
+    :param source_affine: Voxel to scanner RAS matrix of the PET image.
+    :type source_affine: numpy.ndarray
+    :param template_affine: Voxel to MNI305 RAS matrix of the template.
+    :type template_affine: numpy.ndarray
+    :return: 4x4 matrix.
+    :rtype: numpy.ndarray
+    """
+    pet2mni = read_xfm(xfm_file) @ lta_ras2ras(read_lta(lta_file))
+    return np.linalg.inv(source_affine) @ np.linalg.inv(pet2mni) @ template_affine
+
+
+def mni305_operator(lta_file, xfm_file, source_img, template_file, cache_dir=None):
+    """
+    Trilinear operator resampling PET voxels onto the MNI305 grid.
+
+    Template voxels outside the PET field of view have empty rows, so applying the
+    operator only touches the voxels covered by the PET. When ``cache_dir`` is given
+    the operator is cached per run, keyed by the composed transform, the template
+    and the PET grid, and replaces the entry of an earlier registration of the run.
+
+    :param lta_file: Path to the PET to T1w ``.lta`` registration.
+    :type lta_file: str
+    :param xfm_file: Path to the subject's ``talairach.xfm``.
+    :type xfm_file: str
+    :param source_img: Loaded PET image.
+    :type source_img: nibabel.spatialimages.SpatialImage
+    :param template_file: Path to the MNI305 template, see :func:`mni305_template`.
+    :type template_file: str
+    :param cache_dir: Optional directory in which the operator is cached.
+    :type cache_dir: str
+    :return: CSR operator of shape (template voxels, PET voxels).
+    :rtype: scipy.sparse.csr_matrix
+    """
+    if cache_dir:
+        # keyed by the values of the transforms, as the registration is written
+        # again into a new working directory by every invocation
+        pet2mni = read_xfm(xfm_file) @ lta_ras2ras(read_lta(lta_file))
+        key = file_fingerprint(
+            template_file,
+            pet2mni=np.round(pet2mni, 6).tolist(),
+            pet_affine=np.round(source_img.affine, 6).tolist(),
+            pet_shape=tuple(source_img.shape[:3]),
+            version=MNI305_OPERATOR_VERSION,
+        )
+        stem = f"mni305_sampling_{run_name(source_img.get_filename())}"
+        cached = cache_file(cache_dir, stem, key, ".npz")
+        if os.path.exists(cached):
+            try:
+                return load_operator(cached)[0]
+            except (OSError, ValueError, KeyError):
+                pass
+
+    template_img = nib.load(template_file)
+    vox2vox = mni305_vox2vox(lta_file, xfm_file, source_img.affine, template_img.affine)
+    operator = trilinear_operator(vox2vox, source_img.shape, template_img.shape[:3])
+
+    if cache_dir:
+        atomic_write(cached, lambda tmp_file: save_operator(operator, [], tmp_file))
+        remove_stale(cache_dir, stem, ".npz", keep=cached)
+    return operator
+
+
+def resample_to_mni305(
+    source_file,
+    lta_file,
+    xfm_file,
+    out_file,
+    template_file=None,
+    smooth_fwhm=None,
+    smoothed_file=None,
+    cache_dir=None,
+    n_threads=1,
+    mem_mb=None,
+    anat_file=None,
+    mask_files=None,
+    masked_file=None,
+    margin=DEFAULT_MASK_MARGIN,
+):
+    """
+    Resample a (4D) PET volume into MNI305 space in a single pass.
+
+    When ``anat_file`` and ``mask_files`` are given, the voxels of the labels in T1w
+    space are resampled from the same blocks of frames and written as with
+    :func:`petprep_extract_tacs.utils.resample.resample_to_target`, so the PET is
+    only read once.
+
+    :param source_file: Path to the PET volume.
+    :type source_file: str
+    :param lta_file: Path to the PET to T1w ``.lta`` registration.
+    :type lta_file: str
+    :param xfm_file: Path to the subject's ``talairach.xfm``.
+    :type xfm_file: str
+    :param out_file: Path to the output NIfTI file.
+    :type out_file: str
+    :param template_file: MNI305 template defining the grid, defaults to the 2 mm
+        template of :func:`mni305_template`.
+    :type template_file: str
+    :param smooth_fwhm: Optional FWHM in mm of a Gaussian applied to the resampled
+        volume, written to ``smoothed_file``.
+    :type smooth_fwhm: float
+    :param smoothed_file: Path to the smoothed output NIfTI file.
+    :type smoothed_file: str
+    :param cache_dir: Optional directory in which the operator is cached.
+    :type cache_dir: str
+    :param n_threads: Number of threads used for resampling and smoothing.
+    :type n_threads: int
+    :param mem_mb: Memory budget in MB for the frames resampled at once.
+    :type mem_mb: float
+    :param anat_file: Optional volume defining the T1w grid, e.g. the brainmask.
+    :type anat_file: str
+    :param mask_files: Label volumes in T1w space whose voxels are resampled.
+    :type mask_files: list
+    :param masked_file: Path to the masked ``.npz`` output in T1w space.
+    :type masked_file: str
+    :param margin: Margin in voxels around the labels in ``mask_files``.
+    :type margin: int
+    :return: ``out_file``, ``smoothed_file`` and ``masked_file``; the latter two
+        are ``None`` when not requested.
+    :rtype: tuple
+    """
+    source_img = nib.load(source_file)
+    template_file = template_file or mni305_template()
+    template_img = nib.load(template_file)
+    template_shape = tuple(template_img.shape[:3])
+    n_frames = source_img.shape[3] if len(source_img.shape) > 3 else 1
+
+    operators = [
+        mni305_operator(lta_file, xfm_file, source_img, template_file, cache_dir)
+    ]
+    n_template = operators[0].shape[0]
+
+    if anat_file and mask_files:
+        anat_img = nib.load(anat_file)
+        voxels = mask_voxels(mask_files, anat_img.shape[:3], margin)
+        vox2vox = target_to_source_vox2vox(lta_file, source_img.affine, anat_img.affine)
+        operators.append(
+            trilinear_operator(
+                vox2vox, source_img.shape, anat_img.shape[:3], target_voxels=voxels
+            )
+        )
+        masked = np.empty((len(voxels), n_frames), dtype=np.float32)
+    else:
+        masked_file = None
+    operator = sparse.csr_matrix(sparse.vstack(operators))
+
+    zooms = tuple(template_img.header.get_zooms()[:3])
+    if len(source_img.shape) > 3:
+        zooms += (source_img.header.get_zooms()[3],)
+        shape = template_shape + (n_frames,)
+    else:
+        shape = template_shape
+    if not smooth_fwhm:
+        smoothed_file = None
+
+    def blocks():
+        # the smoothed frames are held twice more while they are computed
+        extra_voxels = 2 * n_template if smoothed_file else 0
+        for start, stop, block in resample_frames(
+            operator, source_img, n_threads, mem_mb, extra_voxels=extra_voxels
+        ):
+            if masked_file:
+                masked[:, start:stop] = block[n_template:]
+            file_blocks = [block[:n_template]]
+            if smoothed_file:
+                ((_, _, smoothed),) = smooth_blocks(
+                    [(start, stop, file_blocks[0])],
+                    template_shape,
+                    smooth_fwhm,
+                    zooms,
+                    n_threads,
+                )
+                file_blocks.append(smoothed)
+            yield start, stop, file_blocks
+
+    out_files = [out_file] + ([smoothed_file] if smoothed_file else [])
+    write_frame_sets(out_files, blocks(), shape, template_img.affine, zooms)
+
+    if masked_file:
+        save_masked(masked_file, voxels, masked, anat_img.shape[:3], anat_img.affine)
+    return out_file, smoothed_file, masked_file
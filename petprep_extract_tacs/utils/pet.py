@@ -1,44 +1,245 @@
-def create_weighted_average_pet(pet_file, json_file):
+import json
+import os
+
+import nibabel as nib
+import numpy as np
+
+# Default memory budget in MB for a block of PET frames read into memory at once
+DEFAULT_CHUNK_MEM_MB = 1024
+
+
+def frames_per_block(img, mem_mb=None, extra_voxels=0):
+    """
+    Number of PET frames that fit in the memory budget.
+
+    A frame is accounted for at float64 size, as scaled data is returned by nibabel
+    in double precision before it is cast.
+
+    :param img: Loaded (3D or 4D) PET image.
+    :type img: nibabel.spatialimages.SpatialImage
+    :param mem_mb: Memory budget in MB, defaults to ``DEFAULT_CHUNK_MEM_MB``.
+    :type mem_mb: float
+    :param extra_voxels: Number of additional float32 values held per frame by the
+        caller, e.g. the frame resampled to another grid.
+    :type extra_voxels: int
+    :return: Number of frames per block, at least 1.
+    :rtype: int
+    """
+    if not mem_mb:
+        mem_mb = DEFAULT_CHUNK_MEM_MB
+    frame_bytes = int(np.prod(img.shape[:3])) * np.dtype(np.float64).itemsize
+    frame_bytes += int(extra_voxels) * np.dtype(np.float32).itemsize
+    return max(1, int(mem_mb * 1024**2 // frame_bytes))
+
+
+def iter_frame_blocks(img, mem_mb=None, dtype=np.float32, extra_voxels=0):
+    """
+    Iterate over a PET image in blocks of frames read through its array proxy.
+
+    Only one block is held in memory at a time, so peak memory is bounded by the
+    budget regardless of the number of frames. 3D images are returned as a single
+    block with one frame.
+
+    :param img: Loaded (3D or 4D) PET image.
+    :type img: nibabel.spatialimages.SpatialImage
+    :param mem_mb: Memory budget in MB, see :func:`frames_per_block`.
+    :type mem_mb: float
+    :param dtype: Data type of the returned blocks.
+    :type dtype: numpy.dtype
+    :param extra_voxels: See :func:`frames_per_block`.
+    :type extra_voxels: int
+    :return: Generator of ``(start, stop, block)`` tuples, where ``block`` has shape
+        (x, y, z, stop - start).
+    :rtype: generator
+    """
+    if len(img.shape) < 4:
+        yield 0, 1, np.asarray(img.dataobj, dtype=dtype)[..., np.newaxis]
+        return
+
+    n_frames = img.shape[3]
+    block_size = frames_per_block(img, mem_mb, extra_voxels)
+    for start in range(0, n_frames, block_size):
+        stop = min(start + block_size, n_frames)
+        yield start, stop, np.asarray(img.dataobj[..., start:stop], dtype=dtype)
+
+
+def run_name(pet_file):
+    """
+    BIDS name of the PET run a file is derived from.
+
+    The ``desc`` entity and the suffix are left out, so the PET, its motion
+    corrected version and its time-weighted average share the name.
+
+    :param pet_file: Path to a PET file, e.g. ``sub-01_ses-1_desc-mc_pet.nii.gz``.
+    :type pet_file: str
+    :return: Name of the run, e.g. ``sub-01_ses-1``, or the file name without
+        extensions when it has no BIDS entities.
+    :rtype: str
+    """
+    name = os.path.basename(pet_file).split(".")[0]
+    entities = [
+        entity
+        for entity in name.split("_")
+        if "-" in entity and not entity.startswith("desc-")
+    ]
+    return "_".join(entities) or name
+
+
+def window_label(window):
+    """
+    BIDS ``desc`` label of a time window, e.g. ``twa1800to3600`` or ``twa1800toend``.
+
+    :param window: Start and end of the window in seconds.
+    :type window: tuple
+    :return: Alphanumeric label of the window.
+    :rtype: str
+    """
+    start, end = window
+    end = "end" if np.isinf(end) else f"{end:g}"
+    return f"twa{start:g}to{end}".replace(".", "p")
+
+
+def time_weighted_averages(img, frames_start, frames_duration, windows=(), mem_mb=None):
+    """
+    Compute the time-weighted average of the whole scan and of time windows in one pass.
+
+    The average of the whole scan is the trapezoidal integral over mid-frame times
+    divided by the sum of the mid-frame times, as used for coregistration. Window
+    averages weight the frames whose mid-frame time falls within the window by
+    their duration. All averages are accumulated in single precision while the
+    frames are streamed in blocks, see :func:`iter_frame_blocks`.
+
+    :param img: Loaded 4D PET image.
+    :type img: nibabel.spatialimages.SpatialImage
+    :param frames_start: Start time of each frame in seconds.
+    :type frames_start: numpy.ndarray
+    :param frames_duration: Duration of each frame in seconds.
+    :type frames_duration: numpy.ndarray
+    :param windows: ``(start, end)`` windows in seconds; ``end`` may be ``inf``.
+    :type windows: list
+    :param mem_mb: Memory budget in MB for the frames read at once.
+    :type mem_mb: float
+    :return: float32 array of shape (x, y, z, 1 + len(windows)) holding the whole
+        scan average followed by the window averages.
+    :rtype: numpy.ndarray
+    """
+    frames_start = np.asarray(frames_start, dtype=float)
+    frames_duration = np.asarray(frames_duration, dtype=float)
+    mid_frames = frames_start + frames_duration / 2
+
+    weights = np.zeros((len(mid_frames), 1 + len(windows)))
+
+    # trapezoidal rule over the mid-frame times as per-frame weights
+    dx = np.diff(mid_frames)
+    weights[:-1, 0] += dx / 2
+    weights[1:, 0] += dx / 2
+    weights[:, 0] /= np.sum(mid_frames)
+
+    for column, (start, end) in enumerate(windows, start=1):
+        in_window = (mid_frames >= start) & (mid_frames <= end)
+        if not in_window.any():
+            raise ValueError(f"No frames with a mid-frame time in window {start}-{end}")
+        weights[in_window, column] = frames_duration[in_window]
+        weights[:, column] /= frames_duration[in_window].sum()
+
+    weights = weights.astype(np.float32)
+    averages = np.zeros(img.shape[:3] + (weights.shape[1],), dtype=np.float32)
+    for start, stop, block in iter_frame_blocks(img, mem_mb):
+        averages += block @ weights[start:stop]
+
+    return averages
+
+
+def frame_timing_errors(pet_file, json_file):
+    """
+    Check the frame timing of a PET run against its NIfTI header.
+
+    Only the header is read, not the image data.
+
+    :param pet_file: Path to the PET NIfTI file.
+    :type pet_file: str
+    :param json_file: Path to the BIDS sidecar JSON file.
+    :type json_file: str
+    :return: Descriptions of the inconsistencies, empty when the numbers of
+        ``FrameTimesStart`` and ``FrameDuration`` entries match the number of
+        frames in the header.
+    :rtype: list
+    """
+    n_frames = int(nib.load(pet_file).header["dim"][4])
+    with open(json_file, "r") as jf:
+        meta = json.load(jf)
+
+    n_starts = len(meta.get("FrameTimesStart", []))
+    n_durations = len(meta.get("FrameDuration", []))
+
+    errors = []
+    if n_starts != n_durations:
+        errors.append(
+            f"Number of entries for FrameTimesStart -> {n_starts} and "
+            f"FrameDuration -> {n_durations} do not match in {json_file}"
+        )
+    if n_starts != n_frames:
+        errors.append(
+            f"Number frames in {pet_file} header -> {n_frames} does not match the "
+            f"number of frames in FrameTimesStart -> {n_starts} at {json_file}"
+        )
+    if n_durations != n_frames:
+        errors.append(
+            f"Number frames in {pet_file} header -> {n_frames} does not match the "
+            f"number of frames in FrameDuration -> {n_durations} at {json_file}"
+        )
+    return errors
+
+
+def create_weighted_average_pet(pet_file, json_file, mem_mb=None, windows=None):
 
     import json
-    from niworkflows.interfaces.bids import ReadSidecarJSON
     import nibabel as nib
     import numpy as np
     import os
     from pathlib import Path
+    from petprep_extract_tacs.utils.pet import time_weighted_averages, window_label
 
     """
     Create a time-weighted average of dynamic PET data using mid-frames
 
+    Averages over time windows, e.g. the late frames of the scan, can be created
+    from the same pass over the data.
+
     :param pet_file: Path to input dynamic PET volume
     :type pet_file: str
     :param json_file: Path to BIDS sidecar JSON file
     :type json_file: str
-    :return: Path to the weighted average PET file
-    :rtype: str
+    :param mem_mb: Memory budget in MB for the frames read at once
+    :type mem_mb: float
+    :param windows: Optional ``(start, end)`` windows in seconds to average
+    :type windows: list
+    :return: Path to the weighted average PET file and list of paths to the window
+        averages
+    :rtype: tuple
     """
 
     img = nib.load(pet_file)
-    data = img.get_fdata()
 
     # Load the .json file
     with open(json_file, "r") as jf:
         meta = json.load(jf)
 
-    frames_start = np.array(meta["FrameTimesStart"])
-    frames_duration = np.array(meta["FrameDuration"])
-
-    frames = range(data.shape[-1])
+    windows = [tuple(float(t) for t in window) for window in windows or []]
+    averages = time_weighted_averages(
+        img, meta["FrameTimesStart"], meta["FrameDuration"], windows, mem_mb
+    )
 
     new_pth = os.getcwd()
 
-    mid_frames = frames_start + frames_duration / 2
-    wavg = np.trapz(data[..., frames], dx=np.diff(mid_frames[frames]), axis=3) / np.sum(
-        mid_frames
-    )
-
     out_name = Path(pet_file.replace("_pet.", "_desc-wavg_pet.")).name
     out_file = os.path.join(new_pth, out_name)
-    nib.save(nib.Nifti1Image(wavg, img.affine), out_file)
+    nib.save(nib.Nifti1Image(averages[..., 0], img.affine), out_file)
+
+    window_files = []
+    for column, window in enumerate(windows, start=1):
+        window_file = os.path.join(new_pth, f"desc-{window_label(window)}_pet.nii.gz")
+        nib.save(nib.Nifti1Image(averages[..., column], img.affine), window_file)
+        window_files.append(window_file)
 
-    return out_file
+    return out_file, window_files
@@ -0,0 +1,131 @@
+"""
+Persistent per-scanner store of the PSFs estimated by the adaptive GTM.
+
+The FWHM found for every PET run is stored per scanner model and reconstruction,
+read from the PET JSON sidecar, under the path of the sidecar, so a run processed
+again replaces its earlier estimate. New runs of the same scanner start the PSF
+search from the mean of the estimates with a range narrowed by their spread
+instead of the broad range around ``--psf``. The store is a small
+JSON file shared between subjects, updated under an exclusive file lock, so
+concurrent runs of a cohort do not lose each other's estimates.
+"""
+
+import json
+import math
+
+from petprep_extract_tacs.utils.cache import atomic_write, locked
+
+# Sidecar fields identifying the scanner and reconstruction
+SCANNER_FIELDS = ("ManufacturersModelName", "ReconMethodName")
+
+# Half-width of the warm-started search relative to the mean estimate
+WARM_START_RANGE = 0.2
+
+# Number of standard deviations of the estimates covered by the search
+WARM_START_SPREAD = 3
+
+
+def scanner_key(json_file):
+    """
+    Key of the scanner and reconstruction of a PET run.
+
+    :param json_file: Path to the PET JSON sidecar.
+    :type json_file: str
+    :return: ``"<ManufacturersModelName>|<ReconMethodName>"``, or ``None`` when
+        the sidecar names neither.
+    :rtype: str
+    """
+    with open(json_file) as f:
+        metadata = json.load(f)
+
+    values = [str(metadata.get(field, "")).strip() for field in SCANNER_FIELDS]
+    if not any(values):
+        return None
+    return "|".join(values)
+
+
+def _read(store_file):
+    try:
+        with open(store_file) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _summary(runs):
+    fwhms = [float(fwhm) for fwhm in runs.values()]
+    n = len(fwhms)
+    mean = sum(fwhms) / n if n else 0.0
+    return {"n": n, "mean": mean, "m2": sum((fwhm - mean) ** 2 for fwhm in fwhms)}
+
+
+def read_psf_store(store_file):
+    """
+    Read the estimates of all scanners.
+
+    :param store_file: Path to the JSON store.
+    :type store_file: str
+    :return: Dict mapping scanner keys onto dicts with the number of runs ``n``,
+        the ``mean`` FWHM in mm and the sum of squared deviations ``m2``.
+    :rtype: dict
+    """
+    with locked(store_file):
+        store = _read(store_file)
+    return {
+        key: _summary(entry["runs"])
+        for key, entry in store.items()
+        if isinstance(entry, dict) and entry.get("runs")
+    }
+
+
+def update_psf_store(store_file, key, run, fwhm):
+    """
+    Store the FWHM estimated for a run, replacing an earlier estimate of the run.
+
+    :param store_file: Path to the JSON store.
+    :type store_file: str
+    :param key: Scanner key, see :func:`scanner_key`.
+    :type key: str
+    :param run: Identifier of the run, e.g. the path to its JSON sidecar.
+    :type run: str
+    :param fwhm: Estimated FWHM in mm.
+    :type fwhm: float
+    :return: Updated entry of the scanner, see :func:`read_psf_store`.
+    :rtype: dict
+    """
+    with locked(store_file):
+        store = _read(store_file)
+        entry = store.get(key)
+        if not isinstance(entry, dict) or not isinstance(entry.get("runs"), dict):
+            # entries of the former running estimate cannot be split into runs
+            entry = {"runs": {}}
+        entry["runs"][run] = float(fwhm)
+        store[key] = entry
+
+        def write(tmp_file):
+            with open(tmp_file, "w") as f:
+                json.dump(store, f, indent=4, sort_keys=True)
+
+        atomic_write(store_file, write)
+    return _summary(entry["runs"])
+
+
+def warm_start_search(entry, relative=WARM_START_RANGE, spread=WARM_START_SPREAD):
+    """
+    Narrowed PSF search range around the mean estimate of a scanner.
+
+    :param entry: Entry of the scanner, see :func:`read_psf_store`.
+    :type entry: dict
+    :param relative: Minimum half-width relative to the running mean.
+    :type relative: float
+    :param spread: Half-width in standard deviations of the estimates.
+    :type spread: float
+    :return: ``(lower, upper)`` FWHM range in mm, or ``None`` without estimates.
+    :rtype: tuple
+    """
+    if not entry or entry["n"] < 1:
+        return None
+
+    std = math.sqrt(entry["m2"] / (entry["n"] - 1)) if entry["n"] > 1 else 0.0
+    half_width = max(relative * entry["mean"], spread * std)
+    return max(0.0, entry["mean"] - half_width), entry["mean"] + half_width
@@ -0,0 +1,465 @@
+"""
+Native resampling of PET volumes with FreeSurfer LTA registrations.
+
+The registration computed by ``mri_coreg`` is parsed from its ``.lta`` file and
+turned into a sparse (CSR) target voxel x source voxel trilinear interpolation
+operator. The operator is built once and applied to blocks of frames, so the cost
+of resampling a dynamic scan is proportional to the number of frames times the
+number of non-zero weights, instead of a full grid traversal per frame as done by
+``mri_vol2vol``.
+
+When only some labels are of interest, resampling can be restricted to the voxels
+they cover. The result is then stored as a compact masked (voxels x frames) array
+instead of a full 4D volume.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+
+import nibabel as nib
+import numpy as np
+from scipy import ndimage, sparse
+
+from petprep_extract_tacs.utils.pet import iter_frame_blocks
+
+# LTA transform types, see FreeSurfer's transform.h
+LINEAR_VOX_TO_VOX = 0
+LINEAR_RAS_TO_RAS = 1
+
+# Number of target voxels for which interpolation weights are computed at once
+_OPERATOR_CHUNK = 2**20
+
+# Margin in voxels added around the labels when resampling is restricted to a mask
+DEFAULT_MASK_MARGIN = 2
+
+
+def _volume_vox2ras(info):
+    """Voxel to scanner RAS matrix of an LTA ``volume info`` section."""
+    shape = np.array(info["volume"], dtype=float)
+    mdc = np.column_stack([info["xras"], info["yras"], info["zras"]])
+    mdc = mdc * np.array(info["voxelsize"], dtype=float)
+    vox2ras = np.eye(4)
+    vox2ras[:3, :3] = mdc
+    vox2ras[:3, 3] = np.array(info["c_ras"], dtype=float) - mdc @ (shape / 2)
+    return vox2ras
+
+
+def read_lta(lta_file):
+    """
+    Read a FreeSurfer linear transform array (``.lta``) file.
+
+    :param lta_file: Path to the ``.lta`` file.
+    :type lta_file: str
+    :return: Dictionary with the transform ``type``, the 4x4 ``matrix`` and the
+        ``src`` and ``dst`` volume geometry (``shape`` and ``vox2ras``).
+    :rtype: dict
+    """
+    with open(lta_file, "r") as lf:
+        lines = [line.split("#")[0].strip() for line in lf]
+    lines = [line for line in lines if line]
+
+    lta = {"src": {}, "dst": {}}
+    section = None
+    idx = 0
+    while idx < len(lines):
+        line = lines[idx]
+        if line.startswith("type"):
+            lta["type"] = int(line.split("=")[1])
+        elif line.split() == ["1", "4", "4"]:
+            lta["matrix"] = np.array(
+                [[float(v) for v in lines[idx + row].split()] for row in range(1, 5)]
+            )
+            idx += 4
+        elif line.startswith("src volume info"):
+            section = lta["src"]
+        elif line.startswith("dst volume info"):
+            section = lta["dst"]
+        elif section is not None and "=" in line:
+            key, value = (part.strip() for part in line.split("=", 1))
+            if key in ("volume", "voxelsize", "xras", "yras", "zras", "c_ras"):
+                section[key] = [float(v) for v in value.split()]
+        idx += 1
+
+    if "type" not in lta or "matrix" not in lta:
+        raise ValueError(f"{lta_file} is not a valid LTA file")
+
+    for key in ("src", "dst"):
+        info = lta[key]
+        if all(k in info for k in ("volume", "voxelsize", "xras", "yras", "zras")):
+            info.setdefault("c_ras", [0.0, 0.0, 0.0])
+            info["shape"] = tuple(int(v) for v in info["volume"])
+            info["vox2ras"] = _volume_vox2ras(info)
+
+    return lta
+
+
+def lta_ras2ras(lta):
+    """
+    Source scanner RAS to destination scanner RAS matrix of a parsed LTA.
+
+    :param lta: Output of :func:`read_lta`.
+    :type lta: dict
+    :return: 4x4 matrix.
+    :rtype: numpy.ndarray
+    """
+    if lta["type"] == LINEAR_RAS_TO_RAS:
+        return lta["matrix"]
+    if lta["type"] == LINEAR_VOX_TO_VOX:
+        if "vox2ras" not in lta["src"] or "vox2ras" not in lta["dst"]:
+            raise ValueError("Voxel to voxel LTA without volume geometry")
+        return (
+            lta["dst"]["vox2ras"] @ lta["matrix"] @ np.linalg.inv(lta["src"]["vox2ras"])
+        )
+    raise ValueError(f"Unsupported LTA transform type {lta['type']}")
+
+
+def target_to_source_vox2vox(lta_file, source_affine, target_affine):
+    """
+    Map target voxel coordinates onto source voxel coordinates.
+
+    :param lta_file: Path to the source to target ``.lta`` registration.
+    :type lta_file: str
+    :param source_affine: Voxel to scanner RAS matrix of the source (e.g. PET) image.
+    :type source_affine: numpy.ndarray
+    :param target_affine: Voxel to scanner RAS matrix of the target (e.g. T1w) image.
+    :type target_affine: numpy.ndarray
+    :return: 4x4 matrix.
+    :rtype: numpy.ndarray
+    """
+    ras2ras = lta_ras2ras(read_lta(lta_file))
+    return np.linalg.inv(source_affine) @ np.linalg.inv(ras2ras) @ target_affine
+
+
+def trilinear_operator(vox2vox, source_shape, target_shape, target_voxels=None):
+    """
+    Build the sparse trilinear interpolation operator between two grids.
+
+    Corners falling outside the source grid contribute zero, as in ``mri_vol2vol``.
+
+    :param vox2vox: Target voxel to source voxel matrix, see
+        :func:`target_to_source_vox2vox`.
+    :type vox2vox: numpy.ndarray
+    :param source_shape: Spatial shape of the source grid.
+    :type source_shape: tuple
+    :param target_shape: Spatial shape of the target grid.
+    :type target_shape: tuple
+    :param target_voxels: Flat (C order) indices of the target voxels to compute,
+        defaults to all voxels of the target grid.
+    :type target_voxels: numpy.ndarray
+    :return: float32 CSR matrix of shape (target voxels, source voxels).
+    :rtype: scipy.sparse.csr_matrix
+    """
+    source_shape = tuple(int(dim) for dim in source_shape[:3])
+    target_shape = tuple(int(dim) for dim in target_shape[:3])
+    if target_voxels is None:
+        n_rows = int(np.prod(target_shape))
+    else:
+        target_voxels = np.asarray(target_voxels)
+        n_rows = len(target_voxels)
+
+    offsets = np.array(
+        [[i, j, k] for i in (0, 1) for j in (0, 1) for k in (0, 1)], dtype=np.int64
+    )
+    indices = np.zeros((n_rows, 8), dtype=np.int32)
+    weights = np.zeros((n_rows, 8), dtype=np.float32)
+
+    for start in range(0, n_rows, _OPERATOR_CHUNK):
+        stop = min(start + _OPERATOR_CHUNK, n_rows)
+        rows = np.arange(start, stop)
+        voxels = rows if target_voxels is None else target_voxels[rows]
+        ijk = np.column_stack(np.unravel_index(voxels, target_shape))
+        coords = ijk @ vox2vox[:3, :3].T + vox2vox[:3, 3]
+
+        floor = np.floor(coords).astype(np.int64)
+        frac = coords - floor
+        for corner, offset in enumerate(offsets):
+            corner_ijk = floor + offset
+            weight = np.prod(np.where(offset, frac, 1 - frac), axis=1)
+            inside = np.all((corner_ijk >= 0) & (corner_ijk < source_shape), axis=1)
+            inside &= weight > 0
+            indices[rows[inside], corner] = np.ravel_multi_index(
+                tuple(corner_ijk[inside].T), source_shape
+            )
+            weights[rows[inside], corner] = weight[inside]
+
+    operator = sparse.csr_matrix(
+        (weights.ravel(), indices.ravel(), np.arange(0, 8 * n_rows + 1, 8)),
+        shape=(n_rows, int(np.prod(source_shape))),
+    )
+    operator.eliminate_zeros()
+    return operator
+
+
+def resample_frames(operator, img, n_threads=1, mem_mb=None, extra_voxels=0):
+    """
+    Apply a resampling operator to all frames of an image, block by block.
+
+    The rows of the operator are split over ``n_threads`` threads; the sparse
+    products release the GIL, so the threads run concurrently.
+
+    :param operator: Operator from :func:`trilinear_operator`.
+    :type operator: scipy.sparse.csr_matrix
+    :param img: Loaded (3D or 4D) source image.
+    :type img: nibabel.spatialimages.SpatialImage
+    :param n_threads: Number of threads.
+    :type n_threads: int
+    :param mem_mb: Memory budget in MB for the source and resampled frames held at
+        once.
+    :type mem_mb: float
+    :param extra_voxels: Number of additional float32 values per frame held by the
+        caller, e.g. to smooth the resampled frames.
+    :type extra_voxels: int
+    :return: Generator of ``(start, stop, block)`` tuples, where ``block`` has shape
+        (operator rows, stop - start).
+    :rtype: generator
+    """
+    n_threads = max(1, int(n_threads or 1))
+    bounds = np.linspace(0, operator.shape[0], n_threads + 1).astype(int)
+    chunks = [
+        (row_start, operator[row_start:row_stop])
+        for row_start, row_stop in zip(bounds[:-1], bounds[1:])
+        if row_stop > row_start
+    ]
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        for start, stop, block in iter_frame_blocks(
+            img, mem_mb, extra_voxels=operator.shape[0] + extra_voxels
+        ):
+            block = block.reshape(-1, stop - start)
+            out = np.empty((operator.shape[0], stop - start), dtype=np.float32)
+
+            def apply(chunk):
+                row_start, rows = chunk
+                out[row_start : row_start + rows.shape[0]] = rows @ block
+
+            list(executor.map(apply, chunks))
+            yield start, stop, out
+
+
+def write_frame_sets(out_files, blocks, shape, affine, zooms=None):
+    """
+    Write blocks of frames to several NIfTI files of the same grid at once.
+
+    Used to write e.g. an unsmoothed and a smoothed volume from the blocks of a
+    single pass over the source, without holding a whole 4D array.
+
+    :param out_files: Paths to the output NIfTI files.
+    :type out_files: list
+    :param blocks: Iterable of ``(start, stop, blocks)`` tuples in frame order, with
+        one block per output file of shape (voxels, frames) in C order over
+        ``shape``.
+    :type blocks: iterable
+    :param shape: 4D shape of the output images.
+    :type shape: tuple
+    :param affine: Voxel to world matrix of the output images.
+    :type affine: numpy.ndarray
+    :param zooms: Optional voxel sizes (and frame spacing) of the output images.
+    :type zooms: tuple
+    :return: ``out_files``
+    :rtype: list
+    """
+    header = nib.Nifti1Header()
+    header.set_data_shape(shape)
+    header.set_data_dtype(np.float32)
+    header.set_sform(affine, code=1)
+    header.set_qform(affine, code=1)
+    if zooms is not None:
+        header.set_zooms(zooms[: len(shape)])
+    header.set_xyzt_units("mm", "sec")
+    header["vox_offset"] = 352
+
+    with ExitStack() as stack:
+        fobjs = [
+            stack.enter_context(nib.openers.ImageOpener(out_file, "wb"))
+            for out_file in out_files
+        ]
+        for fobj in fobjs:
+            header.write_to(fobj)
+            fobj.write(b"\0" * (352 - fobj.tell()))
+        for start, stop, file_blocks in blocks:
+            for fobj, block in zip(fobjs, file_blocks):
+                frames = block.reshape(tuple(shape[:3]) + (stop - start,))
+                for frame in range(stop - start):
+                    fobj.write(frames[..., frame].astype(np.float32).tobytes(order="F"))
+
+    return out_files
+
+
+def write_frames(out_file, blocks, shape, affine, zooms=None):
+    """
+    Write blocks of frames to a NIfTI file without holding the whole 4D array.
+
+    :param out_file: Path to the output NIfTI file.
+    :type out_file: str
+    :param blocks: Iterable of ``(start, stop, block)`` tuples in frame order, with
+        blocks of shape (voxels, frames) in C order over ``shape``.
+    :type blocks: iterable
+    :param shape: 4D shape of the output image.
+    :type shape: tuple
+    :param affine: Voxel to world matrix of the output image.
+    :type affine: numpy.ndarray
+    :param zooms: Optional voxel sizes (and frame spacing) of the output image.
+    :type zooms: tuple
+    :return: ``out_file``
+    :rtype: str
+    """
+    blocks = ((start, stop, [block]) for start, stop, block in blocks)
+    return write_frame_sets([out_file], blocks, shape, affine, zooms)[0]
+
+
+def _flatten(items):
+    for item in items:
+        if isinstance(item, (list, tuple)):
+            yield from _flatten(item)
+        else:
+            yield item
+
+
+def mask_voxels(mask_files, target_shape, margin=DEFAULT_MASK_MARGIN):
+    """
+    Flat indices of the voxels covered by any of several label volumes.
+
+    :param mask_files: Label volumes on the target grid; nested lists are flattened.
+    :type mask_files: list
+    :param target_shape: Spatial shape of the target grid.
+    :type target_shape: tuple
+    :param margin: Number of voxels by which the union of the labels is dilated.
+    :type margin: int
+    :return: Sorted flat (C order) voxel indices.
+    :rtype: numpy.ndarray
+    """
+    mask = np.zeros(tuple(target_shape[:3]), dtype=bool)
+    for mask_file in _flatten(mask_files):
+        labels = np.asanyarray(nib.load(mask_file).dataobj)
+        if labels.shape[:3] != mask.shape:
+            raise ValueError(
+                f"Label volume {mask_file} with shape {labels.shape[:3]} does not "
+                f"match the target grid with shape {mask.shape}"
+            )
+        mask |= labels.reshape(mask.shape) != 0
+    if margin:
+        mask = ndimage.binary_dilation(mask, iterations=int(margin))
+    return np.flatnonzero(mask)
+
+
+def save_masked(out_file, voxels, data, shape, affine):
+    """
+    Save resampled data restricted to a mask as a compact ``.npz`` file.
+
+    :param out_file: Path to the ``.npz`` file.
+    :type out_file: str
+    :param voxels: Flat (C order) indices of the stored voxels.
+    :type voxels: numpy.ndarray
+    :param data: Array of shape (voxels, frames).
+    :type data: numpy.ndarray
+    :param shape: Spatial shape of the full grid.
+    :type shape: tuple
+    :param affine: Voxel to world matrix of the full grid.
+    :type affine: numpy.ndarray
+    :return: ``out_file``
+    :rtype: str
+    """
+    with open(out_file, "wb") as fobj:
+        np.savez(
+            fobj,
+            voxels=voxels,
+            data=data,
+            shape=np.array(shape[:3]),
+            affine=affine,
+        )
+    return out_file
+
+
+def load_masked(in_file):
+    """
+    Load data saved with :func:`save_masked`.
+
+    :param in_file: Path to the ``.npz`` file.
+    :type in_file: str
+    :return: Dictionary with ``voxels``, ``data``, ``shape`` and ``affine`` entries.
+    :rtype: dict
+    """
+    with np.load(in_file) as masked:
+        return {
+            "voxels": masked["voxels"],
+            "data": masked["data"],
+            "shape": tuple(int(dim) for dim in masked["shape"]),
+            "affine": masked["affine"],
+        }
+
+
+def is_masked(in_file):
+    """Whether ``in_file`` holds masked data written by :func:`save_masked`."""
+    return str(in_file).endswith(".npz")
+
+
+def resample_to_target(
+    source_file,
+    target_file,
+    lta_file,
+    out_file,
+    n_threads=1,
+    mem_mb=None,
+    mask_files=None,
+    margin=DEFAULT_MASK_MARGIN,
+):
+    """
+    Resample a (4D) volume onto the grid of a target volume with an LTA registration.
+
+    :param source_file: Path to the volume to resample, e.g. the PET.
+    :type source_file: str
+    :param target_file: Path to a volume defining the target grid, e.g. the T1w
+        brainmask.
+    :type target_file: str
+    :param lta_file: Path to the source to target ``.lta`` registration.
+    :type lta_file: str
+    :param out_file: Path to the output NIfTI file.
+    :type out_file: str
+    :param n_threads: Number of threads used to apply the interpolation operator.
+    :type n_threads: int
+    :param mem_mb: Memory budget in MB for the frames resampled at once.
+    :type mem_mb: float
+    :param mask_files: Optional label volumes on the target grid. When given, only
+        the voxels they cover (see :func:`mask_voxels`) are resampled and the result
+        is written with :func:`save_masked`; ``out_file`` should end in ``.npz``.
+    :type mask_files: list
+    :param margin: Margin in voxels around the labels in ``mask_files``.
+    :type margin: int
+    :return: ``out_file``
+    :rtype: str
+    """
+    source_img = nib.load(source_file)
+    target_img = nib.load(target_file)
+    target_shape = target_img.shape[:3]
+
+    vox2vox = target_to_source_vox2vox(lta_file, source_img.affine, target_img.affine)
+    n_frames = source_img.shape[3] if len(source_img.shape) > 3 else 1
+
+    if mask_files:
+        voxels = mask_voxels(mask_files, target_shape, margin)
+        operator = trilinear_operator(
+            vox2vox, source_img.shape, target_shape, target_voxels=voxels
+        )
+        data = np.empty((len(voxels), n_frames), dtype=np.float32)
+        for start, stop, block in resample_frames(
+            operator, source_img, n_threads, mem_mb
+        ):
+            data[:, start:stop] = block
+        return save_masked(out_file, voxels, data, target_shape, target_img.affine)
+
+    operator = trilinear_operator(vox2vox, source_img.shape, target_shape)
+
+    zooms = tuple(target_img.header.get_zooms()[:3])
+    if len(source_img.shape) > 3:
+        zooms += (source_img.header.get_zooms()[3],)
+        shape = tuple(target_shape) + (n_frames,)
+    else:
+        shape = tuple(target_shape)
+
+    return write_frames(
+        out_file,
+        resample_frames(operator, source_img, n_threads, mem_mb),
+        shape,
+        target_img.affine,
+        zooms,
+    )
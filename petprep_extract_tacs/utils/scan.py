@@ -0,0 +1,226 @@
+"""
+Lightweight discovery of the PET runs of a BIDS dataset without pybids.
+
+Only ``sub-*/[ses-*/]pet/*_pet.nii[.gz]`` and their JSON sidecars are needed by
+the workflow, so the dataset is listed with ``os.scandir``, one subject per
+thread, instead of indexing every file with pybids. The result is stored in an
+index file together with the modification times of the listed directories. Later
+invocations only list the subjects whose directories changed, which keeps
+discovery fast on network filesystems.
+"""
+
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from petprep_extract_tacs.utils.cache import atomic_write
+
+# Bump when the layout of the index file changes
+SCAN_VERSION = 1
+
+# Number of directories listed at once
+SCAN_THREADS = 16
+
+PET_FILE_PATTERN = re.compile(r"^(?P<name>sub-[^_/]+.*)_pet\.nii(\.gz)?$")
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def _list_pet_dir(pet_dir, session, records):
+    with os.scandir(pet_dir) as entries:
+        for entry in entries:
+            match = PET_FILE_PATTERN.match(entry.name)
+            if match and entry.is_file():
+                records.append(
+                    {
+                        "pet_file": entry.path,
+                        "json_file": os.path.join(
+                            pet_dir, f"{match.group('name')}_pet.json"
+                        ),
+                        "session": session,
+                    }
+                )
+
+
+def scan_subject(subject_dir):
+    """
+    List the PET runs of a subject.
+
+    :param subject_dir: Path to the ``sub-*`` directory.
+    :type subject_dir: str
+    :return: Dict with the ``runs`` of the subject, each a dict with the
+        ``pet_file``, ``json_file`` and ``session`` (``None`` without sessions),
+        and the modification times of the listed directories in ``dirs``.
+    :rtype: dict
+    """
+    runs = []
+    dirs = {subject_dir: _mtime(subject_dir)}
+
+    with os.scandir(subject_dir) as entries:
+        for entry in sorted(entries, key=lambda entry: entry.name):
+            if not entry.is_dir():
+                continue
+            if entry.name == "pet":
+                dirs[entry.path] = _mtime(entry.path)
+                _list_pet_dir(entry.path, None, runs)
+            elif entry.name.startswith("ses-"):
+                dirs[entry.path] = _mtime(entry.path)
+                pet_dir = os.path.join(entry.path, "pet")
+                if os.path.isdir(pet_dir):
+                    dirs[pet_dir] = _mtime(pet_dir)
+                    _list_pet_dir(pet_dir, entry.name[len("ses-") :], runs)
+
+    runs.sort(key=lambda run: run["pet_file"])
+    return {"runs": runs, "dirs": dirs}
+
+
+def _is_current(entry):
+    return all(_mtime(path) == mtime for path, mtime in entry["dirs"].items())
+
+
+def scan_pet_dataset(bids_dir, index_file=None, n_threads=SCAN_THREADS):
+    """
+    List the PET runs of all subjects of a BIDS dataset.
+
+    :param bids_dir: Path to the BIDS dataset.
+    :type bids_dir: str
+    :param index_file: Optional path to the index file, which is read to skip
+        subjects whose directories did not change and written afterwards.
+    :type index_file: str
+    :param n_threads: Number of directories listed at once.
+    :type n_threads: int
+    :return: Dict mapping subject labels without ``sub-`` onto the output of
+        :func:`scan_subject`.
+    :rtype: dict
+    """
+    bids_dir = os.path.abspath(bids_dir)
+
+    index = {}
+    if index_file:
+        try:
+            with open(index_file) as f:
+                stored = json.load(f)
+            if (
+                stored.get("version") == SCAN_VERSION
+                and stored.get("bids_dir") == bids_dir
+            ):
+                index = stored["subjects"]
+        except (FileNotFoundError, ValueError, KeyError):
+            index = {}
+
+    with os.scandir(bids_dir) as entries:
+        labels = sorted(
+            entry.name[len("sub-") :]
+            for entry in entries
+            if entry.name.startswith("sub-") and entry.is_dir()
+        )
+
+    with ThreadPoolExecutor(max_workers=max(1, int(n_threads))) as executor:
+        # only subjects whose directories changed are listed again
+        current = list(
+            executor.map(
+                lambda subject: subject in index and _is_current(index[subject]),
+                labels,
+            )
+        )
+        changed = [subject for subject, ok in zip(labels, current) if not ok]
+        subjects = {
+            subject: index[subject] for subject, ok in zip(labels, current) if ok
+        }
+        subjects.update(
+            zip(
+                changed,
+                executor.map(
+                    lambda subject: scan_subject(
+                        os.path.join(bids_dir, f"sub-{subject}")
+                    ),
+                    changed,
+                ),
+            )
+        )
+
+    if index_file and (changed or len(subjects) != len(index)):
+        os.makedirs(os.path.dirname(os.path.abspath(index_file)), exist_ok=True)
+
+        def write(tmp_file):
+            with open(tmp_file, "w") as f:
+                json.dump(
+                    {
+                        "version": SCAN_VERSION,
+                        "bids_dir": bids_dir,
+                        "subjects": subjects,
+                    },
+                    f,
+                )
+
+        atomic_write(index_file, write)
+
+    return {subject: subjects[subject] for subject in sorted(subjects)}
+
+
+class PETDataset:
+    """
+    PET runs of a BIDS dataset found by :func:`scan_pet_dataset`.
+
+    Offers the subset of the :class:`bids.BIDSLayout` queries used by the
+    workflow builders, so either can be passed to them.
+
+    :param bids_dir: Path to the BIDS dataset.
+    :type bids_dir: str
+    :param index_file: Optional path to the index file, see
+        :func:`scan_pet_dataset`.
+    :type index_file: str
+    """
+
+    def __init__(self, bids_dir, index_file=None):
+        self.root = os.path.abspath(bids_dir)
+        self.subjects = scan_pet_dataset(bids_dir, index_file)
+
+    def get_subjects(self, suffix=None):
+        """
+        Labels of the subjects with PET runs, without ``sub-``.
+
+        :param suffix: Ignored, all runs are PET runs.
+        :type suffix: str
+        :rtype: list
+        """
+        return [subject for subject, entry in self.subjects.items() if entry["runs"]]
+
+    def get_sessions(self, subject=None):
+        """
+        Labels of the sessions with PET runs, without ``ses-``.
+
+        :param subject: Optional subject label to restrict the sessions to.
+        :type subject: str
+        :rtype: list
+        """
+        entries = (
+            [self.subjects.get(subject, {"runs": []})]
+            if subject
+            else self.subjects.values()
+        )
+        return sorted(
+            {
+                run["session"]
+                for entry in entries
+                for run in entry["runs"]
+                if run["session"]
+            }
+        )
+
+    def get_runs(self, subject):
+        """
+        PET runs of a subject.
+
+        :param subject: Subject label without ``sub-``.
+        :type subject: str
+        :return: List of dicts with the ``pet_file``, ``json_file`` and ``session``.
+        :rtype: list
+        """
+        return list(self.subjects.get(subject, {"runs": []})["runs"])
@@ -0,0 +1,501 @@
+"""
+Native regional statistics for dynamic PET volumes.
+
+These functions reproduce the parts of ``mri_segstats`` used by the workflow
+(``--avgwf``, ``--sum`` and ``--ctab-out``) directly on the NIfTI arrays, so
+regional time activity curves can be computed without starting a FreeSurfer
+process for every segmentation.
+
+Each segmentation is turned into a sparse (CSR) segment x voxel averaging matrix,
+so regional means reduce to one sparse matrix product per block of frames. The
+matrices only depend on the anatomical segmentation and can be cached per subject.
+"""
+
+import json
+import os
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from petprep_extract_tacs.utils.pet import iter_frame_blocks
+from petprep_extract_tacs.utils.resample import (
+    is_masked,
+    load_masked,
+    resample_frames,
+    target_to_source_vox2vox,
+    trilinear_operator,
+)
+from petprep_extract_tacs.utils.cache import (
+    atomic_write,
+    cache_file,
+    file_fingerprint,
+    remove_stale,
+)
+
+# Bump when the layout of cached label matrices changes
+LABEL_MATRIX_VERSION = 1
+
+
+def default_ctab_file():
+    """
+    Return the path to the FreeSurfer default color lookup table.
+
+    :return: Path to ``$FREESURFER_HOME/FreeSurferColorLUT.txt`` or ``None`` if it
+        cannot be located.
+    :rtype: str or None
+    """
+    fs_home = os.environ.get("FREESURFER_HOME", "")
+    lut_file = os.path.join(fs_home, "FreeSurferColorLUT.txt")
+    if fs_home and os.path.exists(lut_file):
+        return lut_file
+    return None
+
+
+def read_ctab(ctab_file):
+    """
+    Read a FreeSurfer color table into a DataFrame.
+
+    :param ctab_file: Path to a `.ctab` or ``FreeSurferColorLUT.txt`` file.
+    :type ctab_file: str
+    :return: DataFrame with ``index`` and ``name`` columns.
+    :rtype: pandas.DataFrame
+    """
+    ctab_df = pd.read_csv(
+        ctab_file,
+        header=None,
+        comment="#",
+        delim_whitespace=True,
+        usecols=[0, 1],
+        names=["index", "name"],
+    )
+    return ctab_df.drop_duplicates(subset="index").reset_index(drop=True)
+
+
+def load_labels(seg_file):
+    """
+    Load a segmentation volume as an integer label array.
+
+    :param seg_file: Path to the segmentation (`.mgz` or `.nii[.gz]`), or a list of
+        non-overlapping segmentations that are combined into a single label array
+        (e.g. left and right hippocampus/amygdala labels).
+    :type seg_file: str or list
+    :return: Tuple of the integer label array and the voxel volume in mm3.
+    :rtype: tuple
+    """
+    seg_files = seg_file if isinstance(seg_file, (list, tuple)) else [seg_file]
+
+    labels = None
+    for seg_file in seg_files:
+        seg_img = nib.load(seg_file)
+        seg_labels = np.rint(np.asanyarray(seg_img.dataobj)).astype(np.int64)
+        labels = seg_labels if labels is None else labels + seg_labels
+
+    voxel_volume = float(np.prod(seg_img.header.get_zooms()[:3]))
+    return labels, voxel_volume
+
+
+def select_labels(labels, ctab_file=None, exclude_id=0):
+    """
+    Determine the segment ids and names to report for a label array.
+
+    Mirrors ``mri_segstats``: only non-empty segments are reported, and when a
+    color table is given only the segments listed in it are kept.
+
+    :param labels: Integer label array.
+    :type labels: numpy.ndarray
+    :param ctab_file: Optional color table used for segment names.
+    :type ctab_file: str
+    :param exclude_id: Segment id to leave out of the report.
+    :type exclude_id: int
+    :return: Tuple of segment ids (numpy.ndarray) and segment names (list).
+    :rtype: tuple
+    """
+    present = np.unique(labels)
+    present = present[present != exclude_id]
+
+    if ctab_file is None:
+        return present, [f"Seg{segid:04d}" for segid in present]
+
+    ctab_df = read_ctab(ctab_file)
+    ctab_df = ctab_df[ctab_df["index"].isin(present)]
+    ctab_df = ctab_df[ctab_df["index"] != exclude_id].sort_values("index")
+    return ctab_df["index"].to_numpy(), ctab_df["name"].tolist()
+
+
+def label_indices(labels, segids):
+    """
+    Map each voxel of a label array onto the position of its segment in ``segids``.
+
+    :param labels: Integer label array.
+    :type labels: numpy.ndarray
+    :param segids: Sorted segment ids that should be reported.
+    :type segids: numpy.ndarray
+    :return: Tuple of the flat voxel indices belonging to a reported segment and
+        the segment position of each of those voxels.
+    :rtype: tuple
+    """
+    flat = labels.ravel()
+    positions = np.searchsorted(segids, flat)
+    positions[positions == len(segids)] = 0
+    in_segment = segids[positions] == flat if len(segids) else flat < 0
+    voxels = np.flatnonzero(in_segment)
+    return voxels, positions[voxels]
+
+
+def prepare_segmentation(segmentation_file, ctab_file=None, exclude_id=0):
+    """
+    Build the sparse averaging matrix of a segmentation.
+
+    :param segmentation_file: Path to the segmentation volume, or a list of
+        segmentations to combine (see :func:`load_labels`).
+    :type segmentation_file: str or list
+    :param ctab_file: Optional color table used to select and name segments.
+    :type ctab_file: str
+    :param exclude_id: Segment id to leave out of the report.
+    :type exclude_id: int
+    :return: Dictionary with ``index``, ``name``, ``nvoxels``, ``volume_mm3``,
+        ``shape`` and ``matrix`` entries. ``matrix`` is a CSR matrix of shape
+        (segments, voxels) whose rows average the voxels of each segment.
+    :rtype: dict
+    """
+    labels, voxel_volume = load_labels(segmentation_file)
+    segids, names = select_labels(labels, ctab_file, exclude_id)
+    voxels, positions = label_indices(labels, segids)
+    nvoxels = np.bincount(positions, minlength=len(segids))
+
+    matrix = sparse.csr_matrix(
+        (1.0 / nvoxels[positions], (positions, voxels)),
+        shape=(len(segids), labels.size),
+    )
+
+    return {
+        "index": segids,
+        "name": names,
+        "nvoxels": nvoxels,
+        "volume_mm3": nvoxels * voxel_volume,
+        "shape": labels.shape[:3],
+        "matrix": matrix,
+    }
+
+
+def _save_segmentation(segmentation, out_file):
+    matrix = segmentation["matrix"]
+    np.savez(
+        out_file,
+        data=matrix.data,
+        indices=matrix.indices,
+        indptr=matrix.indptr,
+        matrix_shape=np.array(matrix.shape),
+        index=segmentation["index"],
+        name=np.array(segmentation["name"], dtype=str),
+        nvoxels=segmentation["nvoxels"],
+        volume_mm3=segmentation["volume_mm3"],
+        shape=np.array(segmentation["shape"]),
+    )
+
+
+def _load_segmentation(in_file):
+    with np.load(in_file) as cached:
+        return {
+            "index": cached["index"],
+            "name": cached["name"].tolist(),
+            "nvoxels": cached["nvoxels"],
+            "volume_mm3": cached["volume_mm3"],
+            "shape": tuple(int(dim) for dim in cached["shape"]),
+            "matrix": sparse.csr_matrix(
+                (cached["data"], cached["indices"], cached["indptr"]),
+                shape=tuple(cached["matrix_shape"]),
+            ),
+        }
+
+
+def load_segmentation(segmentation_file, ctab_file=None, exclude_id=0, cache_dir=None):
+    """
+    Return the sparse averaging matrix of a segmentation, using a cache if given.
+
+    Cache entries are keyed by the path, size and modification time of the
+    segmentation and color table files, so they are rebuilt whenever a source
+    segmentation changes.
+
+    :param segmentation_file: Path to the segmentation volume, or a list of
+        segmentations to combine (see :func:`load_labels`).
+    :type segmentation_file: str or list
+    :param ctab_file: Optional color table used to select and name segments.
+    :type ctab_file: str
+    :param exclude_id: Segment id to leave out of the report.
+    :type exclude_id: int
+    :param cache_dir: Directory holding cached label matrices, e.g. one per subject.
+    :type cache_dir: str
+    :return: See :func:`prepare_segmentation`.
+    :rtype: dict
+    """
+    if not cache_dir:
+        return prepare_segmentation(segmentation_file, ctab_file, exclude_id)
+
+    seg_files = (
+        segmentation_file
+        if isinstance(segmentation_file, (list, tuple))
+        else [segmentation_file]
+    )
+    stem = "+".join(os.path.basename(seg_file).split(".")[0] for seg_file in seg_files)
+    if ctab_file:
+        stem += "_" + os.path.splitext(os.path.basename(ctab_file))[0]
+
+    key = file_fingerprint(
+        [seg_files, ctab_file],
+        exclude_id=exclude_id,
+        version=LABEL_MATRIX_VERSION,
+    )
+    cached = cache_file(cache_dir, stem, key, ".npz")
+
+    if os.path.exists(cached):
+        try:
+            return _load_segmentation(cached)
+        except (OSError, ValueError, KeyError):
+            pass
+
+    segmentation = prepare_segmentation(segmentation_file, ctab_file, exclude_id)
+    atomic_write(cached, lambda tmp_file: _save_segmentation(segmentation, tmp_file))
+    remove_stale(cache_dir, stem, ".npz", keep=cached)
+    return segmentation
+
+
+def label_voxels(matrices):
+    """
+    Flat indices of the voxels covered by any segment of the averaging matrices.
+
+    :param matrices: Segment x voxel averaging matrices, see
+        :func:`prepare_segmentation`.
+    :type matrices: list
+    :return: Sorted flat voxel indices.
+    :rtype: numpy.ndarray
+    """
+    return np.unique(np.concatenate([matrix.indices for matrix in matrices]))
+
+
+def pet_space_weights(matrices, lta_file, pet_img, target_img):
+    """
+    Map segment averaging matrices from T1w space into PET space.
+
+    Each row of the returned matrices holds the fractional weights of the native
+    PET voxels for one segment. They are the product of the T1w averaging matrix
+    and the PET to T1w trilinear interpolation operator, restricted to the voxels
+    covered by a segment. A weighted sum over the native PET therefore equals the
+    segment mean of the PET resampled into T1w space, at a fraction of the cost
+    per frame.
+
+    :param matrices: Segment x T1w voxel averaging matrices, see
+        :func:`prepare_segmentation`.
+    :type matrices: list
+    :param lta_file: Path to the PET to T1w ``.lta`` registration.
+    :type lta_file: str
+    :param pet_img: Loaded PET image.
+    :type pet_img: nibabel.spatialimages.SpatialImage
+    :param target_img: Loaded image defining the T1w grid of the segmentations.
+    :type target_img: nibabel.spatialimages.SpatialImage
+    :return: Segment x PET voxel CSR matrices, in the order of ``matrices``.
+    :rtype: list
+    """
+    voxels = label_voxels(matrices)
+    vox2vox = target_to_source_vox2vox(lta_file, pet_img.affine, target_img.affine)
+    operator = trilinear_operator(
+        vox2vox, pet_img.shape, target_img.shape, target_voxels=voxels
+    )
+    return [sparse.csr_matrix(matrix[:, voxels] @ operator) for matrix in matrices]
+
+
+def compute_multi_segstats(
+    in_file,
+    segmentation_files,
+    ctab_files=None,
+    exclude_id=0,
+    cache_dir=None,
+    mem_mb=None,
+    lta_file=None,
+    target_file=None,
+    n_threads=1,
+    pet_space=False,
+):
+    """
+    Compute per-segment mean time activity curves for several segmentations at once.
+
+    The PET volume is read a single time, in blocks of frames that fit in
+    ``mem_mb``, and every block is reduced over all segmentations with one sparse
+    matrix product each before the next block is read.
+
+    :param in_file: Path to the 3D/4D PET volume in the space of the segmentations,
+        or to PET resampled within a mask and saved with
+        :func:`petprep_extract_tacs.utils.resample.save_masked`.
+    :type in_file: str
+    :param segmentation_files: Segmentation volumes (see :func:`prepare_segmentation`).
+    :type segmentation_files: list
+    :param ctab_files: Color tables matching ``segmentation_files``; ``None`` entries
+        report segments without names.
+    :type ctab_files: list
+    :param exclude_id: Segment id to leave out of the report.
+    :type exclude_id: int
+    :param cache_dir: Directory holding cached label matrices, see
+        :func:`load_segmentation`.
+    :type cache_dir: str
+    :param mem_mb: Memory budget in MB for the PET frames read at once, see
+        :func:`petprep_extract_tacs.utils.pet.iter_frame_blocks`.
+    :type mem_mb: float
+    :param lta_file: Optional ``.lta`` registration of ``in_file`` to the space of
+        the segmentations. When given, the PET is resampled onto the grid of
+        ``target_file`` block by block, without writing it to disk.
+    :type lta_file: str
+    :param target_file: Volume defining the grid of the segmentations, required
+        with ``lta_file``.
+    :type target_file: str
+    :param n_threads: Number of threads used for resampling.
+    :type n_threads: int
+    :param pet_space: With ``lta_file``, map the segmentations into PET space
+        once (see :func:`pet_space_weights`) instead of resampling every frame.
+    :type pet_space: bool
+    :return: One dictionary per segmentation with ``index``, ``name``, ``nvoxels``,
+        ``volume_mm3`` and ``tacs`` (frames x segments) entries.
+    :rtype: list
+    """
+    if ctab_files is None:
+        ctab_files = [None] * len(segmentation_files)
+
+    segmentations = [
+        load_segmentation(segmentation_file, ctab_file, exclude_id, cache_dir)
+        for segmentation_file, ctab_file in zip(segmentation_files, ctab_files)
+    ]
+
+    if is_masked(in_file):
+        masked = load_masked(in_file)
+        grid_file, grid_shape = in_file, masked["shape"]
+    else:
+        pet_img = nib.load(in_file)
+        grid_file = target_file if lta_file else in_file
+        grid_img = nib.load(target_file) if lta_file else pet_img
+        grid_shape = grid_img.shape[:3]
+
+    for segmentation_file, segmentation in zip(segmentation_files, segmentations):
+        if grid_shape != segmentation["shape"]:
+            raise ValueError(
+                f"Volume {grid_file} with shape {grid_shape} does not match "
+                f"segmentation {segmentation_file} with shape {segmentation['shape']}"
+            )
+
+    if is_masked(in_file):
+        # only the voxels within the mask were resampled
+        n_frames = masked["data"].shape[1]
+        for segmentation in segmentations:
+            segmentation["matrix"] = segmentation["matrix"][:, masked["voxels"]]
+        blocks = [(0, n_frames, masked["data"])]
+    elif lta_file and pet_space:
+        n_frames = pet_img.shape[3] if len(pet_img.shape) > 3 else 1
+        weights = pet_space_weights(
+            [segmentation["matrix"] for segmentation in segmentations],
+            lta_file,
+            pet_img,
+            grid_img,
+        )
+        for segmentation, matrix in zip(segmentations, weights):
+            segmentation["matrix"] = matrix
+        blocks = (
+            (start, stop, block.reshape(-1, stop - start))
+            for start, stop, block in iter_frame_blocks(pet_img, mem_mb)
+        )
+    elif lta_file:
+        # only resample the voxels covered by the segmentations
+        n_frames = pet_img.shape[3] if len(pet_img.shape) > 3 else 1
+        voxels = label_voxels(
+            [segmentation["matrix"] for segmentation in segmentations]
+        )
+        for segmentation in segmentations:
+            segmentation["matrix"] = segmentation["matrix"][:, voxels]
+        vox2vox = target_to_source_vox2vox(lta_file, pet_img.affine, grid_img.affine)
+        operator = trilinear_operator(
+            vox2vox, pet_img.shape, grid_shape, target_voxels=voxels
+        )
+        blocks = resample_frames(operator, pet_img, n_threads, mem_mb)
+    else:
+        n_frames = pet_img.shape[3] if len(pet_img.shape) > 3 else 1
+        blocks = (
+            (start, stop, block.reshape(-1, stop - start))
+            for start, stop, block in iter_frame_blocks(pet_img, mem_mb)
+        )
+
+    for segmentation in segmentations:
+        segmentation["tacs"] = np.zeros((n_frames, len(segmentation["index"])))
+
+    for start, stop, block in blocks:
+        for segmentation in segmentations:
+            segmentation["tacs"][start:stop] = (segmentation["matrix"] @ block).T
+
+    return [
+        {
+            key: segmentation[key]
+            for key in ("index", "name", "nvoxels", "volume_mm3", "tacs")
+        }
+        for segmentation in segmentations
+    ]
+
+
+def compute_segstats(in_file, segmentation_file, ctab_file=None, exclude_id=0):
+    """
+    Compute per-segment mean time activity curves and volumes.
+
+    :param in_file: Path to the 3D/4D PET volume in the space of the segmentation.
+    :type in_file: str
+    :param segmentation_file: Path to the segmentation volume.
+    :type segmentation_file: str
+    :param ctab_file: Optional color table used to select and name segments.
+    :type ctab_file: str
+    :param exclude_id: Segment id to leave out of the report.
+    :type exclude_id: int
+    :return: Dictionary with ``index``, ``name``, ``nvoxels``, ``volume_mm3`` and
+        ``tacs`` (frames x segments) entries.
+    :rtype: dict
+    """
+    return compute_multi_segstats(
+        in_file, [segmentation_file], [ctab_file], exclude_id
+    )[0]
+
+
+def write_segstats(stats, json_file, out_prefix):
+    """
+    Write segment statistics as PET-BIDS `_tacs.tsv`, `_morph.tsv` and `_dseg.tsv` files.
+
+    :param stats: Output of :func:`compute_segstats`.
+    :type stats: dict
+    :param json_file: Path to the PET sidecar with ``FrameTimesStart`` and ``FrameDuration``.
+    :type json_file: str
+    :param out_prefix: Output path prefix, e.g. ``/path/seg-brainstem``.
+    :type out_prefix: str
+    :return: Paths to the tacs, morph and dseg `.tsv` files.
+    :rtype: tuple
+    """
+    with open(json_file, "r") as jf:
+        meta = json.load(jf)
+    frame_times = np.array(meta["FrameTimesStart"])
+    frame_durations = np.array(meta["FrameDuration"])
+
+    tacs_df = pd.DataFrame(stats["tacs"], columns=stats["name"])
+    tacs_df.insert(0, "frame_start", frame_times)
+    tacs_df.insert(1, "frame_end", frame_times + frame_durations)
+
+    morph_df = pd.DataFrame(
+        {
+            "index": stats["index"],
+            "name": stats["name"],
+            "volume-mm3": stats["volume_mm3"],
+        }
+    )
+    dseg_df = morph_df[["index", "name"]]
+
+    tacs_file = f"{out_prefix}_tacs.tsv"
+    morph_file = f"{out_prefix}_morph.tsv"
+    dseg_file = f"{out_prefix}_dseg.tsv"
+
+    tacs_df.to_csv(tacs_file, sep="\t", index=False)
+    morph_df.to_csv(morph_file, sep="\t", index=False)
+    dseg_df.to_csv(dseg_file, sep="\t", index=False)
+
+    return tacs_file, morph_file, dseg_file
@@ -0,0 +1,452 @@
+"""
+Native projection of PET volumes onto the fsaverage surface.
+
+These functions replace ``mri_vol2surf --projfrac 0.5 --cortex --trgsubject
+fsaverage`` for both hemispheres. The sampling of the PET at the cortical
+mid-thickness of the subject and the mapping onto fsaverage are combined into a
+single sparse (CSR) fsaverage vertex x PET voxel operator. It is built once per
+run and registration and applied to blocks of frames.
+
+Smoothing on fsaverage (``--surf-fwhm``) is done as in FreeSurfer by iterated
+nearest neighbour averaging. The averaging operator of fsaverage and the number
+of iterations for a FWHM do not depend on the subject, so they are cached once
+for the whole dataset and applied to all frames at once.
+"""
+
+import os
+
+import nibabel as nib
+import numpy as np
+from scipy import sparse
+from scipy.spatial import cKDTree
+
+from petprep_extract_tacs.utils.cache import (
+    atomic_write,
+    cache_file,
+    file_fingerprint,
+    load_operator,
+    remove_stale,
+    save_operator,
+)
+from petprep_extract_tacs.utils.pet import iter_frame_blocks, run_name
+from petprep_extract_tacs.utils.resample import lta_ras2ras, read_lta
+
+HEMISPHERES = ("lh", "rh")
+
+# Bump when the layout of cached surface operators changes
+SURFACE_OPERATOR_VERSION = 1
+SMOOTHING_OPERATOR_VERSION = 1
+
+
+def fsaverage_dir(subjects_dir):
+    """
+    Locate the fsaverage subject.
+
+    :param subjects_dir: FreeSurfer subjects directory of the dataset.
+    :type subjects_dir: str
+    :return: Path to ``fsaverage`` in ``subjects_dir`` or, if it is missing there,
+        in ``$FREESURFER_HOME/subjects``.
+    :rtype: str
+    """
+    candidates = [os.path.join(subjects_dir, "fsaverage")]
+    if os.environ.get("FREESURFER_HOME"):
+        candidates.append(
+            os.path.join(os.environ["FREESURFER_HOME"], "subjects", "fsaverage")
+        )
+    for candidate in candidates:
+        if os.path.isdir(candidate):
+            return candidate
+    raise FileNotFoundError(f"Could not locate fsaverage in {candidates}")
+
+
+def surface_files(subjects_dir, subject, hemi):
+    """
+    Surface files needed to project one hemisphere onto fsaverage.
+
+    :param subjects_dir: FreeSurfer subjects directory.
+    :type subjects_dir: str
+    :param subject: FreeSurfer subject, e.g. ``sub-01``.
+    :type subject: str
+    :param hemi: Hemisphere, ``lh`` or ``rh``.
+    :type hemi: str
+    :return: Dictionary with the paths to the ``white``, ``pial``, ``sphere_reg``
+        and ``cortex`` files of the subject and ``fsaverage_sphere_reg``.
+    :rtype: dict
+    """
+    subject_dir = os.path.join(subjects_dir, subject)
+    return {
+        "white": os.path.join(subject_dir, "surf", f"{hemi}.white"),
+        "pial": os.path.join(subject_dir, "surf", f"{hemi}.pial"),
+        "sphere_reg": os.path.join(subject_dir, "surf", f"{hemi}.sphere.reg"),
+        "cortex": os.path.join(subject_dir, "label", f"{hemi}.cortex.label"),
+        "fsaverage_sphere_reg": os.path.join(
+            fsaverage_dir(subjects_dir), "surf", f"{hemi}.sphere.reg"
+        ),
+    }
+
+
+def tkr_to_scanner(coords, anat_img):
+    """
+    Convert FreeSurfer surface (tkregister RAS) coordinates to scanner RAS.
+
+    :param coords: Vertex coordinates of shape (vertices, 3).
+    :type coords: numpy.ndarray
+    :param anat_img: A conformed volume of the subject, e.g. ``T1.mgz``.
+    :type anat_img: nibabel.freesurfer.mghformat.MGHImage
+    :return: Scanner RAS coordinates of shape (vertices, 3).
+    :rtype: numpy.ndarray
+    """
+    tkr2scanner = anat_img.affine @ np.linalg.inv(anat_img.header.get_vox2ras_tkr())
+    return coords @ tkr2scanner[:3, :3].T + tkr2scanner[:3, 3]
+
+
+def nnfr_operator(source_sphere, target_sphere):
+    """
+    Map vertex values between registered spheres as ``mri_surf2surf`` (nnfr).
+
+    Every target vertex averages its nearest source vertex (forward) and all source
+    vertices that have it as their nearest target vertex (reverse).
+
+    :param source_sphere: Source ``sphere.reg`` coordinates of shape (n, 3).
+    :type source_sphere: numpy.ndarray
+    :param target_sphere: Target ``sphere.reg`` coordinates of shape (m, 3).
+    :type target_sphere: numpy.ndarray
+    :return: CSR matrix of shape (m, n) whose rows sum to one.
+    :rtype: scipy.sparse.csr_matrix
+    """
+    n_source, n_target = len(source_sphere), len(target_sphere)
+    forward = cKDTree(source_sphere).query(target_sphere)[1]
+    reverse = cKDTree(target_sphere).query(source_sphere)[1]
+
+    rows = np.concatenate([np.arange(n_target), reverse])
+    cols = np.concatenate([forward, np.arange(n_source)])
+    mapping = sparse.csr_matrix(
+        (np.ones(len(rows)), (rows, cols)), shape=(n_target, n_source)
+    )
+    # a source vertex reached both forward and reverse only counts once
+    mapping.data[:] = 1
+    counts = np.asarray(mapping.sum(axis=1)).ravel()
+    return sparse.diags(1 / counts) @ mapping
+
+
+def vertex_sampling_operator(vertices, pet_img, ras2ras):
+    """
+    Nearest neighbour sampling of the PET at vertex positions.
+
+    :param vertices: Scanner RAS coordinates of the vertices in T1w space.
+    :type vertices: numpy.ndarray
+    :param pet_img: Loaded PET image.
+    :type pet_img: nibabel.spatialimages.SpatialImage
+    :param ras2ras: PET to T1w scanner RAS matrix, see
+        :func:`petprep_extract_tacs.utils.resample.lta_ras2ras`.
+    :type ras2ras: numpy.ndarray
+    :return: CSR matrix of shape (vertices, PET voxels); vertices outside the PET
+        field of view have empty rows.
+    :rtype: scipy.sparse.csr_matrix
+    """
+    pet_shape = pet_img.shape[:3]
+    ras2vox = np.linalg.inv(pet_img.affine) @ np.linalg.inv(ras2ras)
+    ijk = np.rint(vertices @ ras2vox[:3, :3].T + ras2vox[:3, 3]).astype(np.int64)
+    inside = np.all((ijk >= 0) & (ijk < pet_shape), axis=1)
+    rows = np.flatnonzero(inside)
+    cols = np.ravel_multi_index(tuple(ijk[inside].T), pet_shape)
+    return sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.float32), (rows, cols)),
+        shape=(len(vertices), int(np.prod(pet_shape))),
+    )
+
+
+def hemisphere_operator(files, anat_img, pet_img, ras2ras):
+    """
+    Build the fsaverage vertex x PET voxel operator of one hemisphere.
+
+    The PET is sampled midway between the white and pial surfaces, restricted to
+    the cortex label and mapped onto fsaverage through ``sphere.reg``.
+
+    :param files: Output of :func:`surface_files`.
+    :type files: dict
+    :param anat_img: A conformed volume of the subject, e.g. ``T1.mgz``.
+    :type anat_img: nibabel.freesurfer.mghformat.MGHImage
+    :param pet_img: Loaded PET image.
+    :type pet_img: nibabel.spatialimages.SpatialImage
+    :param ras2ras: PET to T1w scanner RAS matrix.
+    :type ras2ras: numpy.ndarray
+    :return: CSR matrix of shape (fsaverage vertices, PET voxels).
+    :rtype: scipy.sparse.csr_matrix
+    """
+    white = nib.freesurfer.read_geometry(files["white"])[0]
+    pial = nib.freesurfer.read_geometry(files["pial"])[0]
+    midthickness = tkr_to_scanner((white + pial) / 2, anat_img)
+
+    sampling = vertex_sampling_operator(midthickness, pet_img, ras2ras)
+    cortex = np.zeros(len(white))
+    cortex[nib.freesurfer.read_label(files["cortex"])] = 1
+    sampling = sparse.diags(cortex) @ sampling
+
+    mapping = nnfr_operator(
+        nib.freesurfer.read_geometry(files["sphere_reg"])[0],
+        nib.freesurfer.read_geometry(files["fsaverage_sphere_reg"])[0],
+    )
+    return sparse.csr_matrix(mapping @ sampling, dtype=np.float32)
+
+
+def fsaverage_operator(
+    subjects_dir, subject, anat_file, lta_file, pet_img, cache_dir=None
+):
+    """
+    Operator projecting PET voxels onto fsaverage for both hemispheres.
+
+    The operators of both hemispheres are stacked, so both are computed with a
+    single product per block of frames. When ``cache_dir`` is given the operator
+    is cached per run, keyed by the surfaces, the registration matrix and the PET
+    grid, and replaces the entry of an earlier registration of the run.
+
+    :param subjects_dir: FreeSurfer subjects directory.
+    :type subjects_dir: str
+    :param subject: FreeSurfer subject, e.g. ``sub-01``.
+    :type subject: str
+    :param anat_file: A conformed volume of the subject, e.g. ``T1.mgz``.
+    :type anat_file: str
+    :param lta_file: Path to the PET to T1w ``.lta`` registration.
+    :type lta_file: str
+    :param pet_img: Loaded PET image.
+    :type pet_img: nibabel.spatialimages.SpatialImage
+    :param cache_dir: Optional directory in which the operator is cached.
+    :type cache_dir: str
+    :return: Stacked CSR operator of shape (vertices, PET voxels) and the number of
+        vertices of each hemisphere.
+    :rtype: tuple
+    """
+    ras2ras = lta_ras2ras(read_lta(lta_file))
+    files = {hemi: surface_files(subjects_dir, subject, hemi) for hemi in HEMISPHERES}
+
+    if cache_dir:
+        key = file_fingerprint(
+            [anat_file] + [list(files[hemi].values()) for hemi in HEMISPHERES],
+            ras2ras=np.round(ras2ras, 6).tolist(),
+            pet_affine=np.round(pet_img.affine, 6).tolist(),
+            pet_shape=tuple(pet_img.shape[:3]),
+            version=SURFACE_OPERATOR_VERSION,
+        )
+        stem = f"fsaverage_sampling_{run_name(pet_img.get_filename())}"
+        cached = cache_file(cache_dir, stem, key, ".npz")
+        if os.path.exists(cached):
+            try:
+                return load_operator(cached)
+            except (OSError, ValueError, KeyError):
+                pass
+
+    anat_img = nib.load(anat_file)
+    operators = [
+        hemisphere_operator(files[hemi], anat_img, pet_img, ras2ras)
+        for hemi in HEMISPHERES
+    ]
+    operator = sparse.csr_matrix(sparse.vstack(operators))
+    sizes = [hemi_operator.shape[0] for hemi_operator in operators]
+
+    if cache_dir:
+        atomic_write(cached, lambda tmp_file: save_operator(operator, sizes, tmp_file))
+        remove_stale(cache_dir, stem, ".npz", keep=cached)
+    return operator, sizes
+
+
+def neighbour_averaging_operator(faces, n_vertices):
+    """
+    One step of nearest neighbour averaging on a triangulated surface.
+
+    Every vertex is replaced by the unweighted mean of itself and its neighbours,
+    as in FreeSurfer's ``MRISsmoothMRI``.
+
+    :param faces: Triangles of shape (faces, 3).
+    :type faces: numpy.ndarray
+    :param n_vertices: Number of vertices of the surface.
+    :type n_vertices: int
+    :return: CSR matrix of shape (vertices, vertices) whose rows sum to one.
+    :rtype: scipy.sparse.csr_matrix
+    """
+    edges = np.concatenate([faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]]])
+    rows = np.concatenate([edges[:, 0], edges[:, 1], np.arange(n_vertices)])
+    cols = np.concatenate([edges[:, 1], edges[:, 0], np.arange(n_vertices)])
+    averaging = sparse.csr_matrix(
+        (np.ones(len(rows)), (rows, cols)), shape=(n_vertices, n_vertices)
+    )
+    # edges shared by two faces only count once
+    averaging.data[:] = 1
+    counts = np.asarray(averaging.sum(axis=1)).ravel()
+    return sparse.csr_matrix(sparse.diags(1 / counts) @ averaging, dtype=np.float32)
+
+
+def fwhm_to_niters(fwhm, coords, faces):
+    """
+    Number of nearest neighbour averaging steps approximating a Gaussian FWHM.
+
+    Uses the empirical relation of FreeSurfer's ``MRISfwhm2niters``.
+
+    :param fwhm: Full width at half maximum in mm.
+    :type fwhm: float
+    :param coords: Vertex coordinates of the surface of shape (vertices, 3).
+    :type coords: numpy.ndarray
+    :param faces: Triangles of shape (faces, 3).
+    :type faces: numpy.ndarray
+    :return: Number of iterations.
+    :rtype: int
+    """
+    triangles = coords[faces]
+    areas = np.linalg.norm(
+        np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0]),
+        axis=1,
+    )
+    avg_vertex_area = areas.sum() / 2 / len(coords)
+    gstd = fwhm / np.sqrt(np.log(256.0))
+    return int(np.floor(1.14 * (4 * np.pi * gstd**2) / (7 * avg_vertex_area) + 0.5))
+
+
+def fsaverage_smoothing(subjects_dir, fwhm, cache_dir=None):
+    """
+    Smoothing operators of both fsaverage hemispheres for a FWHM.
+
+    :param subjects_dir: FreeSurfer subjects directory.
+    :type subjects_dir: str
+    :param fwhm: Full width at half maximum in mm.
+    :type fwhm: float
+    :param cache_dir: Optional directory in which the operators are cached. They
+        only depend on fsaverage, so a dataset wide directory can be used. An
+        entry replaces those of earlier versions of fsaverage for the FWHM.
+    :type cache_dir: str
+    :return: ``(operator, niters)`` tuple per hemisphere, see
+        :func:`neighbour_averaging_operator` and :func:`fwhm_to_niters`.
+    :rtype: list
+    """
+    smoothing = []
+    for hemi in HEMISPHERES:
+        white_file = os.path.join(fsaverage_dir(subjects_dir), "surf", f"{hemi}.white")
+
+        if cache_dir:
+            key = file_fingerprint(
+                white_file, fwhm=float(fwhm), version=SMOOTHING_OPERATOR_VERSION
+            )
+            stem = f"fsaverage_{hemi}_smoothing_fwhm{float(fwhm):g}"
+            cached = cache_file(cache_dir, stem, key, ".npz")
+            if os.path.exists(cached):
+                try:
+                    operator, (niters,) = load_operator(cached)
+                    smoothing.append((operator, niters))
+                    continue
+                except (OSError, ValueError, KeyError):
+                    pass
+
+        coords, faces = nib.freesurfer.read_geometry(white_file)
+        operator = neighbour_averaging_operator(faces, len(coords))
+        niters = fwhm_to_niters(fwhm, coords, faces)
+        if cache_dir:
+            atomic_write(
+                cached, lambda tmp_file: save_operator(operator, [niters], tmp_file)
+            )
+            remove_stale(cache_dir, stem, ".npz", keep=cached)
+        smoothing.append((operator, niters))
+    return smoothing
+
+
+def smooth_surface_data(data, operator, niters):
+    """
+    Smooth vertex x frame data by iterated neighbour averaging.
+
+    Every iteration is one sparse product over all frames at once.
+
+    :param data: Array of shape (vertices, frames).
+    :type data: numpy.ndarray
+    :param operator: Output of :func:`neighbour_averaging_operator`.
+    :type operator: scipy.sparse.csr_matrix
+    :param niters: Number of iterations.
+    :type niters: int
+    :return: Smoothed array of shape (vertices, frames).
+    :rtype: numpy.ndarray
+    """
+    for _ in range(niters):
+        data = operator @ data
+    return data
+
+
+def save_surface_data(data, out_file):
+    """
+    Save vertex x frame data as a FreeSurfer compatible NIfTI surface overlay.
+
+    The overlay has shape (vertices, 1, 1, frames). nibabel stores fsaverage (ico7)
+    overlays, which exceed the NIfTI-1 dimension limit, in FreeSurfer's
+    (27307, 1, 6, frames) layout.
+
+    :param data: Array of shape (vertices, frames).
+    :type data: numpy.ndarray
+    :param out_file: Path to the output ``.nii.gz`` file.
+    :type out_file: str
+    :return: ``out_file``
+    :rtype: str
+    """
+    n_vertices, n_frames = data.shape
+    data = data.astype(np.float32).reshape(n_vertices, 1, 1, n_frames)
+    nib.save(nib.Nifti1Image(data, np.eye(4)), out_file)
+    return out_file
+
+
+def project_to_fsaverage(
+    pet_file,
+    lta_file,
+    subjects_dir,
+    subject,
+    anat_file,
+    out_files,
+    cache_dir=None,
+    mem_mb=None,
+    smooth_fwhm=None,
+    smooth_cache_dir=None,
+):
+    """
+    Project a (4D) PET volume onto fsaverage for both hemispheres.
+
+    :param pet_file: Path to the PET volume.
+    :type pet_file: str
+    :param lta_file: Path to the PET to T1w ``.lta`` registration.
+    :type lta_file: str
+    :param subjects_dir: FreeSurfer subjects directory.
+    :type subjects_dir: str
+    :param subject: FreeSurfer subject, e.g. ``sub-01``.
+    :type subject: str
+    :param anat_file: A conformed volume of the subject, e.g. ``T1.mgz``.
+    :type anat_file: str
+    :param out_files: Output paths of the left and right hemisphere.
+    :type out_files: list
+    :param cache_dir: Optional directory in which the operator is cached.
+    :type cache_dir: str
+    :param mem_mb: Memory budget in MB for the frames read at once.
+    :type mem_mb: float
+    :param smooth_fwhm: Optional FWHM in mm of the smoothing on fsaverage.
+    :type smooth_fwhm: float
+    :param smooth_cache_dir: Optional directory in which the fsaverage smoothing
+        operators are cached.
+    :type smooth_cache_dir: str
+    :return: Paths to the left and right hemisphere overlays.
+    :rtype: list
+    """
+    pet_img = nib.load(pet_file)
+    operator, sizes = fsaverage_operator(
+        subjects_dir, subject, anat_file, lta_file, pet_img, cache_dir
+    )
+
+    n_frames = pet_img.shape[3] if len(pet_img.shape) > 3 else 1
+    data = np.empty((operator.shape[0], n_frames), dtype=np.float32)
+    for start, stop, block in iter_frame_blocks(pet_img, mem_mb):
+        data[:, start:stop] = operator @ block.reshape(-1, stop - start)
+
+    bounds = np.cumsum([0] + sizes)
+    hemi_data = [data[bounds[idx] : bounds[idx + 1]] for idx in range(len(sizes))]
+    if smooth_fwhm:
+        smoothing = fsaverage_smoothing(subjects_dir, smooth_fwhm, smooth_cache_dir)
+        hemi_data = [
+            smooth_surface_data(values, operator, niters)
+            for values, (operator, niters) in zip(hemi_data, smoothing)
+        ]
+
+    return [
+        save_surface_data(values, out_file)
+        for values, out_file in zip(hemi_data, out_files)
+    ]
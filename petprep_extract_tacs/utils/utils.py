@@ -149,6 +149,319 @@ def avgwf_to_tacs(avgwf_file, ctab_file, json_file):
     return tsv_file
 
 
+def convert_anat_volume(in_file, out_name, cache_dir=None):
+    """
+    Convert a FreeSurfer volume of the subject to NIfTI once and reuse it.
+
+    See :func:`petprep_extract_tacs.utils.anat.cached_nifti`.
+
+    :param in_file: Path to the volume, or a list of label volumes that are
+        combined.
+    :type in_file: str or list
+    :param out_name: File name of the output, e.g. ``seg-brainstem_dseg.nii.gz``.
+    :type out_name: str
+    :param cache_dir: Directory in which the converted volumes are kept.
+    :type cache_dir: str
+    :return: Path to the NIfTI file.
+    :rtype: str
+    """
+    from petprep_extract_tacs.utils.anat import cached_nifti
+
+    return cached_nifti(in_file, out_name, cache_dir)
+
+
+def register_pet_to_t1w(
+    source_file, reference_file, subjects_dir, subject_id, cache_dir=None
+):
+    """
+    Register the PET to the T1w with ``mri_coreg``, reusing cached registrations.
+
+    See :func:`petprep_extract_tacs.utils.coreg.cached_coreg`.
+
+    :param source_file: Path to the time-weighted average PET.
+    :type source_file: str
+    :param reference_file: Path to ``brainmask.mgz``.
+    :type reference_file: str
+    :param subjects_dir: FreeSurfer subjects directory.
+    :type subjects_dir: str
+    :param subject_id: FreeSurfer subject, e.g. ``sub-01``.
+    :type subject_id: str
+    :param cache_dir: Directory in which registrations are cached.
+    :type cache_dir: str
+    :return: Path to ``from-pet_to-t1w_reg.lta``.
+    :rtype: str
+    """
+    import os
+    from petprep_extract_tacs.utils.coreg import cached_coreg
+
+    return cached_coreg(
+        source_file,
+        reference_file,
+        subjects_dir,
+        subject_id,
+        os.path.join(os.getcwd(), "from-pet_to-t1w_reg.lta"),
+        cache_dir=cache_dir,
+    )
+
+
+def resample_pet_to_anat(
+    source_file,
+    target_file,
+    lta_file,
+    out_file,
+    n_threads=1,
+    mem_mb=None,
+    mask_files=None,
+):
+    """
+    Resample a PET volume into T1w space using the registration from ``mri_coreg``.
+
+    Native replacement for ``mri_vol2vol --lta``, see
+    :func:`petprep_extract_tacs.utils.resample.resample_to_target`.
+
+    :param source_file: Path to the PET volume.
+    :type source_file: str
+    :param target_file: Path to a volume in T1w space, e.g. the brainmask.
+    :type target_file: str
+    :param lta_file: Path to the PET to T1w ``.lta`` registration.
+    :type lta_file: str
+    :param out_file: Name of the output file, written to the working directory.
+    :type out_file: str
+    :param n_threads: Number of threads used for resampling.
+    :type n_threads: int
+    :param mem_mb: Memory budget in MB for the frames resampled at once.
+    :type mem_mb: float
+    :param mask_files: Optional label volumes in T1w space. When given, only the
+        voxels they cover are resampled and stored as a masked ``.npz`` file.
+    :type mask_files: list
+    :return: Path to the resampled PET volume.
+    :rtype: str
+    """
+    import os
+    from petprep_extract_tacs.utils.resample import resample_to_target
+
+    return resample_to_target(
+        source_file,
+        target_file,
+        lta_file,
+        os.path.join(os.getcwd(), os.path.basename(out_file)),
+        n_threads=n_threads,
+        mem_mb=mem_mb,
+        mask_files=mask_files,
+    )
+
+
+def resample_pet_to_mni305(
+    source_file,
+    lta_file,
+    xfm_file,
+    smooth_fwhm=None,
+    cache_dir=None,
+    n_threads=1,
+    mem_mb=None,
+    anat_file=None,
+    mask_files=None,
+):
+    """
+    Resample a PET volume into 2 mm MNI305 space, optionally smoothed.
+
+    Native replacement for ``mri_vol2vol --tal --talres 2`` followed by
+    ``mri_convert --fwhm``, see
+    :func:`petprep_extract_tacs.utils.mni305.resample_to_mni305`.
+
+    :param source_file: Path to the PET volume.
+    :type source_file: str
+    :param lta_file: Path to the PET to T1w ``.lta`` registration.
+    :type lta_file: str
+    :param xfm_file: Path to the subject's ``talairach.xfm``.
+    :type xfm_file: str
+    :param smooth_fwhm: Optional FWHM in mm of the smoothed output.
+    :type smooth_fwhm: float
+    :param cache_dir: Directory in which the interpolation operator is cached.
+    :type cache_dir: str
+    :param n_threads: Number of threads used for resampling and smoothing.
+    :type n_threads: int
+    :param mem_mb: Memory budget in MB for the frames resampled at once.
+    :type mem_mb: float
+    :param anat_file: Optional volume in T1w space, e.g. the brainmask. Together
+        with ``mask_files`` the PET in T1w space is resampled from the same pass.
+    :type anat_file: str
+    :param mask_files: Optional label volumes in T1w space.
+    :type mask_files: list
+    :return: Paths to the MNI305 volume, the smoothed MNI305 volume and the masked
+        PET in T1w space; the latter two are ``None`` when not requested.
+    :rtype: tuple
+    """
+    import os
+    from petprep_extract_tacs.utils.mni305 import resample_to_mni305
+
+    return resample_to_mni305(
+        source_file,
+        lta_file,
+        xfm_file,
+        os.path.join(os.getcwd(), "space-mni305_pet.nii.gz"),
+        smooth_fwhm=smooth_fwhm,
+        smoothed_file=os.path.join(
+            os.getcwd(), f"space-mni305_desc-sm{smooth_fwhm}_pet.nii.gz"
+        ),
+        cache_dir=cache_dir,
+        n_threads=n_threads,
+        mem_mb=mem_mb,
+        anat_file=anat_file,
+        mask_files=mask_files,
+        masked_file=os.path.join(os.getcwd(), "space-T1w_desc-masked_pet.npz"),
+    )
+
+
+def vol2surf_fsaverage(
+    pet_file,
+    lta_file,
+    subjects_dir,
+    subject_id,
+    anat_file,
+    cache_dir=None,
+    mem_mb=None,
+    smooth_fwhm=None,
+    smooth_cache_dir=None,
+):
+    """
+    Project a PET volume onto fsaverage for both hemispheres.
+
+    Native replacement for ``mri_vol2surf --projfrac 0.5 --cortex --trgsubject
+    fsaverage [--surf-fwhm]``, see
+    :func:`petprep_extract_tacs.utils.surface.project_to_fsaverage`.
+
+    :param pet_file: Path to the PET volume.
+    :type pet_file: str
+    :param lta_file: Path to the PET to T1w ``.lta`` registration.
+    :type lta_file: str
+    :param subjects_dir: FreeSurfer subjects directory.
+    :type subjects_dir: str
+    :param subject_id: FreeSurfer subject, e.g. ``sub-01``.
+    :type subject_id: str
+    :param anat_file: A conformed volume of the subject, e.g. ``T1.mgz``.
+    :type anat_file: str
+    :param cache_dir: Directory in which the projection operator is cached.
+    :type cache_dir: str
+    :param mem_mb: Memory budget in MB for the frames read at once.
+    :type mem_mb: float
+    :param smooth_fwhm: Optional FWHM in mm of the smoothing on fsaverage.
+    :type smooth_fwhm: float
+    :param smooth_cache_dir: Directory in which the fsaverage smoothing operators
+        are cached.
+    :type smooth_cache_dir: str
+    :return: Paths to the left and right hemisphere overlays.
+    :rtype: tuple
+    """
+    import os
+    from petprep_extract_tacs.utils.surface import project_to_fsaverage
+
+    desc = f"_desc-sm{smooth_fwhm}" if smooth_fwhm else ""
+    out_files = [
+        os.path.join(os.getcwd(), f"space-fsaverage_hemi-{hemi}{desc}_pet.nii.gz")
+        for hemi in ("L", "R")
+    ]
+    lh_file, rh_file = project_to_fsaverage(
+        pet_file,
+        lta_file,
+        subjects_dir,
+        subject_id,
+        anat_file,
+        out_files,
+        cache_dir=cache_dir,
+        mem_mb=mem_mb,
+        smooth_fwhm=smooth_fwhm,
+        smooth_cache_dir=smooth_cache_dir,
+    )
+    return lh_file, rh_file
+
+
+def multi_segstats_to_tacs(
+    in_file,
+    segmentation_files,
+    json_file,
+    seg_prefixes,
+    ctab_files=None,
+    cache_dir=None,
+    mem_mb=None,
+    lta_file=None,
+    target_file=None,
+    n_threads=1,
+    pet_space=False,
+):
+    """
+    Extract regional TACs for several segmentations from a single pass over the PET.
+
+    :param in_file: Path to the PET volume in the space of the segmentations.
+    :type in_file: str
+    :param segmentation_files: Segmentation volumes. An entry can itself be a list of
+        non-overlapping segmentations that are combined before extraction.
+    :type segmentation_files: list
+    :param json_file: Path to the `.json` file containing frame timing information.
+    :type json_file: str
+    :param seg_prefixes: Output file prefix for each segmentation, e.g. ``seg-brainstem``.
+    :type seg_prefixes: list
+    :param ctab_files: Color table for each segmentation; ``None`` entries use the
+        FreeSurfer default color table.
+    :type ctab_files: list
+    :param cache_dir: Directory in which the label matrices of the segmentations are
+        cached between runs, or ``None`` to disable caching.
+    :type cache_dir: str
+    :param mem_mb: Memory budget in MB for the PET frames read at once.
+    :type mem_mb: float
+    :param lta_file: Optional PET to T1w ``.lta`` registration. When given,
+        ``in_file`` is the PET in its native space and is resampled onto the grid
+        of ``target_file`` in memory.
+    :type lta_file: str
+    :param target_file: Volume defining the grid of the segmentations.
+    :type target_file: str
+    :param n_threads: Number of threads used for resampling.
+    :type n_threads: int
+    :param pet_space: Extract the TACs in PET space by mapping the segmentations
+        through ``lta_file`` instead of resampling the PET.
+    :type pet_space: bool
+    :return: Lists of paths to the generated `_tacs.tsv`, `_morph.tsv` and `_dseg.tsv`
+        files, in the order of ``segmentation_files``.
+    :rtype: tuple
+    """
+    import os
+    from petprep_extract_tacs.utils.segstats import (
+        compute_multi_segstats,
+        default_ctab_file,
+        write_segstats,
+    )
+
+    if ctab_files is None:
+        ctab_files = [None] * len(segmentation_files)
+    ctab_files = [
+        default_ctab_file() if ctab_file is None else ctab_file
+        for ctab_file in ctab_files
+    ]
+
+    all_stats = compute_multi_segstats(
+        in_file,
+        segmentation_files,
+        ctab_files,
+        cache_dir=cache_dir,
+        mem_mb=mem_mb,
+        lta_file=lta_file,
+        target_file=target_file,
+        n_threads=n_threads,
+        pet_space=pet_space,
+    )
+
+    tacs_files, morph_files, dseg_files = [], [], []
+    for stats, seg_prefix in zip(all_stats, seg_prefixes):
+        tacs_file, morph_file, dseg_file = write_segstats(
+            stats, json_file, os.path.join(os.getcwd(), seg_prefix)
+        )
+        tacs_files.append(tacs_file)
+        morph_files.append(morph_file)
+        dseg_files.append(dseg_file)
+
+    return tacs_files, morph_files, dseg_files
+
+
 def stats_to_stats(summary_file):
     """
     Reads a 'summary.stats' file, transforms the data, and saves it as a '.tsv' file.
@@ -277,7 +590,201 @@ def gtm_stats_to_stats(gtm_stats):
     return tsv_file
 
 
-def gtm_to_tacs(in_file, json_file, gtm_stats, pvc_dir):
+def prepare_gtm(in_file, segmentation, reg_file, cache_dir=None, mem_mb=None):
+    """
+    Geometric preprocessing shared by the GTM variants of a PET run.
+
+    See :func:`petprep_extract_tacs.utils.gtm.gtm_prep`.
+
+    :param in_file: Path to the PET volume.
+    :type in_file: str
+    :param segmentation: Path to ``gtmseg.mgz``.
+    :type segmentation: str
+    :param reg_file: Path to the PET to T1w ``.lta`` registration.
+    :type reg_file: str
+    :param cache_dir: Directory in which the segment fractions are cached.
+    :type cache_dir: str
+    :param mem_mb: Memory budget in MB for the frames read at once.
+    :type mem_mb: float
+    :return: Path to ``gtm_prep.npz``.
+    :rtype: str
+    """
+    import os
+    from petprep_extract_tacs.utils.gtm import gtm_prep, save_gtm_prep
+
+    prep = gtm_prep(in_file, segmentation, reg_file, mem_mb=mem_mb, cache_dir=cache_dir)
+    return save_gtm_prep(os.path.join(os.getcwd(), "gtm_prep.npz"), prep)
+
+
+def gtm_nopvc(
+    in_file, segmentation, reg_file, cache_dir=None, prep_file=None, mem_mb=None
+):
+    """
+    Regional means of the PET in the gtmseg segments without PVC.
+
+    Native replacement for ``mri_gtmpvc --default-seg-merge --auto-mask 1 .1
+    --no-pvc --no-rescale``, see
+    :func:`petprep_extract_tacs.utils.gtm.compute_gtm_nopvc`.
+
+    :param in_file: Path to the PET volume.
+    :type in_file: str
+    :param segmentation: Path to ``gtmseg.mgz``.
+    :type segmentation: str
+    :param reg_file: Path to the PET to T1w ``.lta`` registration.
+    :type reg_file: str
+    :param cache_dir: Directory in which the segment fractions are cached.
+    :type cache_dir: str
+    :param prep_file: Output of :func:`prepare_gtm` for ``in_file``.
+    :type prep_file: str
+    :param mem_mb: Memory budget in MB for the frames read at once.
+    :type mem_mb: float
+    :return: Paths to ``nopvc.nii.gz`` and ``gtm.stats.dat`` in the ``nopvc``
+        directory.
+    :rtype: tuple
+    """
+    import os
+    from petprep_extract_tacs.utils.gtm import compute_gtm_nopvc
+
+    return compute_gtm_nopvc(
+        in_file,
+        segmentation,
+        reg_file,
+        os.path.join(os.getcwd(), "nopvc"),
+        mem_mb=mem_mb,
+        cache_dir=cache_dir,
+        prep_file=prep_file,
+    )
+
+
+def agtm_psf(
+    in_file,
+    segmentation,
+    reg_file,
+    psf,
+    n_threads=1,
+    cache_dir=None,
+    json_file=None,
+    store_file=None,
+    prep_file=None,
+    mem_mb=None,
+):
+    """
+    Estimate the PSF of the scanner with the adaptive GTM.
+
+    Native replacement for ``mri_gtmpvc --opt 1D --opt-brain --psf``, see
+    :func:`petprep_extract_tacs.utils.gtm.compute_agtm_psf`. With a ``store_file``
+    the search starts from the mean estimate of the scanner in the sidecar, and
+    the estimate of the run is stored, replacing an earlier one, see
+    :mod:`petprep_extract_tacs.utils.psf_store`.
+
+    :param in_file: Path to the time-weighted average PET volume.
+    :type in_file: str
+    :param segmentation: Path to ``gtmseg.mgz``.
+    :type segmentation: str
+    :param reg_file: Path to the PET to T1w ``.lta`` registration.
+    :type reg_file: str
+    :param psf: Initial guess of the FWHM in mm.
+    :type psf: float
+    :param n_threads: Number of candidate FWHMs evaluated concurrently.
+    :type n_threads: int
+    :param cache_dir: Directory in which the GTM bases are cached.
+    :type cache_dir: str
+    :param json_file: Path to the PET JSON sidecar.
+    :type json_file: str
+    :param store_file: Path to the per-scanner PSF store.
+    :type store_file: str
+    :param prep_file: Output of :func:`prepare_gtm`, whose segment fractions and
+        mask are used.
+    :type prep_file: str
+    :param mem_mb: Memory budget in MB for the frames read at once.
+    :type mem_mb: float
+    :return: Path to ``agtm/aux/opt.params.dat``.
+    :rtype: str
+    """
+    import os
+    from petprep_extract_tacs.utils.gtm import compute_agtm_psf
+    from petprep_extract_tacs.utils.psf_store import (
+        read_psf_store,
+        scanner_key,
+        update_psf_store,
+        warm_start_search,
+    )
+
+    key = scanner_key(json_file) if store_file and json_file else None
+    search = warm_start_search(read_psf_store(store_file).get(key)) if key else None
+
+    opt_params, fwhm = compute_agtm_psf(
+        in_file,
+        segmentation,
+        reg_file,
+        os.path.join(os.getcwd(), "agtm", "aux", "opt.params.dat"),
+        psf,
+        n_threads=n_threads,
+        search=search,
+        cache_dir=cache_dir,
+        prep_file=prep_file,
+        mem_mb=mem_mb,
+    )
+    if key:
+        update_psf_store(store_file, key, os.path.abspath(json_file), fwhm)
+    return opt_params
+
+
+def gtm_pvc(
+    in_file,
+    segmentation,
+    reg_file,
+    psf_col,
+    psf_row,
+    psf_slice,
+    cache_dir=None,
+    mem_mb=None,
+    prep_file=None,
+):
+    """
+    Partial volume corrected regional values with the geometric transfer matrix.
+
+    Native replacement for ``mri_gtmpvc --psf-col --psf-row --psf-slice``, see
+    :func:`petprep_extract_tacs.utils.gtm.compute_gtm_pvc`.
+
+    :param in_file: Path to the PET volume.
+    :type in_file: str
+    :param segmentation: Path to ``gtmseg.mgz``.
+    :type segmentation: str
+    :param reg_file: Path to the PET to T1w ``.lta`` registration.
+    :type reg_file: str
+    :param psf_col: FWHM of the PSF along the columns (x) in mm.
+    :type psf_col: float
+    :param psf_row: FWHM of the PSF along the rows (y) in mm.
+    :type psf_row: float
+    :param psf_slice: FWHM of the PSF along the slices (z) in mm.
+    :type psf_slice: float
+    :param cache_dir: Directory in which the GTM basis is cached.
+    :type cache_dir: str
+    :param mem_mb: Memory budget in MB for the frames read at once.
+    :type mem_mb: float
+    :param prep_file: Output of :func:`prepare_gtm` for ``in_file``.
+    :type prep_file: str
+    :return: Paths to ``gtm.nii.gz`` and ``gtm.stats.dat`` in the ``agtm``
+        directory.
+    :rtype: tuple
+    """
+    import os
+    from petprep_extract_tacs.utils.gtm import compute_gtm_pvc
+
+    return compute_gtm_pvc(
+        in_file,
+        segmentation,
+        reg_file,
+        os.path.join(os.getcwd(), "agtm"),
+        (psf_col, psf_row, psf_slice),
+        mem_mb=mem_mb,
+        cache_dir=cache_dir,
+        prep_file=prep_file,
+    )
+
+
+def gtm_to_tacs(in_file, json_file, gtm_stats, pvc_dir, mem_mb=None):
     """
     This function reads a .ctab file and a .json file into pandas DataFrames. It also reads a .gtm file and extracts the 'FrameTimesStart' and 'FrameDuration' lists,
     which are converted into numpy arrays and inserted as PET-BIDS compliant ``frame_start`` and ``frame_end`` columns in the gtm DataFrame. The modified gtm DataFrame is then written to a .tsv file with column names based on the .ctab file.
@@ -290,6 +797,8 @@ def gtm_to_tacs(in_file, json_file, gtm_stats, pvc_dir):
     :type ctab_file: str
     :param gtmseg_file: The path to the .gtmseg file to be read. The data from this file is added as columns to the gtm DataFrame.
     :type gtmseg_file: str
+    :param mem_mb: Memory budget in MB for the frames of the .gtm file read at once.
+    :type mem_mb: float
 
     :returns: Path to output .tsv file with a similar name as the input .gtm file.
     :rtype: str
@@ -299,6 +808,7 @@ def gtm_to_tacs(in_file, json_file, gtm_stats, pvc_dir):
     import numpy as np
     import json
     import nibabel as nib
+    from petprep_extract_tacs.utils.pet import iter_frame_blocks
 
     gtm_stats = pd.read_csv(
         gtm_stats,
@@ -310,8 +820,10 @@ def gtm_to_tacs(in_file, json_file, gtm_stats, pvc_dir):
 
     # Read the .gtm file into a DataFrame
     in_file_nib = nib.load(in_file)
-    x, y, z, t = in_file_nib.get_fdata().shape
-    in_file_data = in_file_nib.get_fdata().reshape(x, t).T
+    x, y, z, t = in_file_nib.shape
+    in_file_data = np.empty((t, x))
+    for start, stop, block in iter_frame_blocks(in_file_nib, mem_mb, np.float64):
+        in_file_data[start:stop] = block.reshape(x, stop - start).T
 
     in_file_df = pd.DataFrame(in_file_data, columns=gtm_stats["name"])
 
@@ -364,11 +876,21 @@ def gtm_to_dsegtsv(gtm_stats):
     return tsv_file
 
 
-def limbic_to_dsegtsv(out_stats):
-
+def limbic_to_dsegtsv(out_stats, seg_prefix=None):
+    """
+    Write the labels of a ``mri_sclimbic_seg`` stats file as a dseg table.
+
+    :param out_stats: Path to the ``.stats`` file.
+    :type out_stats: str
+    :param seg_prefix: Optional prefix, e.g. ``seg-raphe``, of a
+        ``<seg_prefix>_dseg.tsv`` written to the working directory. By default the
+        table is written next to ``out_stats``.
+    :type seg_prefix: str
+    :returns: The path to the output '.tsv' file.
+    :rtype: str
+    """
+    import os
     import pandas as pd
-    import numpy as np
-    import json
 
     gtm_df = pd.read_csv(
         out_stats,
@@ -380,7 +902,10 @@ def limbic_to_dsegtsv(out_stats):
     )
 
     # Create the output file name by replacing '.stats' with '.tsv' in the input file name.
-    tsv_file = out_stats.replace(".stats", ".tsv")
+    if seg_prefix:
+        tsv_file = os.path.join(os.getcwd(), f"{seg_prefix}_dseg.tsv")
+    else:
+        tsv_file = out_stats.replace(".stats", ".tsv")
 
     # Write the new DataFrame to the output file.
     # We use a tab separator, and we don't write the index.
@@ -390,17 +915,22 @@ def limbic_to_dsegtsv(out_stats):
     return tsv_file
 
 
-def limbic_to_stats(out_stats):
+def limbic_to_stats(out_stats, seg_prefix=None):
     """
     This function reads a 'summary.stats' file, transforms the data, and saves it as a '.tsv' file.
 
     :param summary_file: The path to the input '.stats' file.
     :type summary_file: str
+    :param seg_prefix: Optional prefix, e.g. ``seg-raphe``, of a
+        ``<seg_prefix>_morph.tsv`` written to the working directory. By default the
+        table is written next to ``out_stats``.
+    :type seg_prefix: str
 
     :returns: The path to the output '.tsv' file.
     :rtype: str
     """
 
+    import os
     import pandas as pd
 
     # Read the 'summary.stats' file into a DataFrame.
@@ -421,7 +951,10 @@ def limbic_to_stats(out_stats):
     # summary_df_output = pd.DataFrame([summary_df['volume_mm3'].to_list()], columns=summary_df['name'].to_list())
 
     # Create the output file name by replacing '.stats' with '.tsv' in the input file name.
-    tsv_file = out_stats.replace("_dseg.stats", "_morph.tsv")
+    if seg_prefix:
+        tsv_file = os.path.join(os.getcwd(), f"{seg_prefix}_morph.tsv")
+    else:
+        tsv_file = out_stats.replace("_dseg.stats", "_morph.tsv")
 
     # Write the new DataFrame to the output file.
     # We use a tab separator, and we don't write the index.
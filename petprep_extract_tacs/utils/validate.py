@@ -0,0 +1,156 @@
+"""
+Validation of the frame timing of the PET runs before the workflow is built.
+
+Runs whose JSON sidecar does not match the number of frames in the NIfTI header
+would fail the workflow, so they are left out up front. Only the NIfTI headers and
+the sidecars are read, for many runs at once on a thread pool. The outcome of
+every run is stored in a cache file under the path of its NIfTI, with a key of the
+paths, sizes and modification times of its files, so later invocations only check
+new or changed runs. The outcome of a changed run replaces the earlier one, and
+the outcomes of runs not checked by an invocation, e.g. of other subjects, are
+kept. The cache file is updated under an exclusive file lock, so concurrent
+invocations do not lose each other's outcomes. All outcomes are reported in a
+tab separated table.
+"""
+
+import csv
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from petprep_extract_tacs.utils.cache import atomic_write, file_fingerprint, locked
+from petprep_extract_tacs.utils.pet import frame_timing_errors
+
+# Bump when the checks change
+VALIDATION_VERSION = 1
+
+# Number of runs checked at once
+VALIDATION_THREADS = 16
+
+REPORT_COLUMNS = ("subject", "pet_file", "json_file", "status", "errors")
+
+
+def _read(cache_file):
+    try:
+        with open(cache_file) as f:
+            cached = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+    if not isinstance(cached, dict):
+        return {}
+    # entries of the former layout, keyed by fingerprint only, are dropped
+    return {
+        pet_file: entry
+        for pet_file, entry in cached.items()
+        if isinstance(entry, dict) and "key" in entry and "errors" in entry
+    }
+
+
+def _check(run, cached):
+    try:
+        key = file_fingerprint(
+            [run["pet_file"], run["json_file"]], version=VALIDATION_VERSION
+        )
+    except FileNotFoundError as err:
+        return None, [f"Missing file {err.filename}"]
+    entry = cached.get(run["pet_file"])
+    if entry and entry["key"] == key:
+        return key, entry["errors"]
+
+    try:
+        return key, frame_timing_errors(run["pet_file"], run["json_file"])
+    except Exception as err:
+        # not cached, so files that could not be read are checked again
+        return None, [f"Could not read {run['pet_file']}: {err}"]
+
+
+def validate_frame_timing(runs, cache_file=None, n_threads=VALIDATION_THREADS):
+    """
+    Check the frame timing of PET runs, see
+    :func:`petprep_extract_tacs.utils.pet.frame_timing_errors`.
+
+    :param runs: Dicts with the ``subject``, ``pet_file`` and ``json_file`` of
+        every run.
+    :type runs: list
+    :param cache_file: Optional path to the JSON file in which the outcomes are
+        cached. Outcomes of earlier versions of the files of ``runs`` are replaced,
+        outcomes of other runs are kept.
+    :type cache_file: str
+    :param n_threads: Number of runs checked at once.
+    :type n_threads: int
+    :return: One dict per run with the columns in :data:`REPORT_COLUMNS`, where
+        ``status`` is ``"pass"`` or ``"fail"`` and ``errors`` lists the
+        inconsistencies.
+    :rtype: list
+    """
+    cached = {}
+    if cache_file:
+        with locked(cache_file):
+            cached = _read(cache_file)
+
+    with ThreadPoolExecutor(max_workers=max(1, int(n_threads))) as executor:
+        results = list(executor.map(lambda run: _check(run, cached), runs))
+
+    rows = []
+    outcomes = {}
+    for run, (key, errors) in zip(runs, results):
+        # runs whose files are missing or unreadable have no outcome to keep
+        outcomes[run["pet_file"]] = (
+            None if key is None else {"key": key, "errors": errors}
+        )
+        rows.append(
+            {
+                "subject": run["subject"],
+                "pet_file": run["pet_file"],
+                "json_file": run["json_file"],
+                "status": "fail" if errors else "pass",
+                "errors": errors,
+            }
+        )
+
+    if cache_file and any(cached.get(run) != entry for run, entry in outcomes.items()):
+        # merged into the current cache, which other invocations may have
+        # updated since it was read
+        with locked(cache_file):
+            merged = _read(cache_file)
+            for run, entry in outcomes.items():
+                if entry is None:
+                    merged.pop(run, None)
+                else:
+                    merged[run] = entry
+
+            def write(tmp_file):
+                with open(tmp_file, "w") as f:
+                    json.dump(merged, f)
+
+            atomic_write(cache_file, write)
+
+    return rows
+
+
+def write_frame_timing_report(rows, out_file):
+    """
+    Write the outcomes of :func:`validate_frame_timing` as a TSV file.
+
+    :param rows: Output of :func:`validate_frame_timing`.
+    :type rows: list
+    :param out_file: Path to the ``.tsv`` file.
+    :type out_file: str
+    :return: ``out_file``
+    :rtype: str
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(out_file)), exist_ok=True)
+    with open(out_file, "w", newline="") as f:
+        writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+        writer.writerow(REPORT_COLUMNS)
+        for row in rows:
+            writer.writerow(
+                [
+                    row["subject"],
+                    row["pet_file"],
+                    row["json_file"],
+                    row["status"],
+                    "; ".join(row["errors"]),
+                ]
+            )
+    return out_file
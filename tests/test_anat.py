@@ -0,0 +1,102 @@
+import os
+
+import nibabel as nib
+import numpy as np
+
+from petprep_extract_tacs.utils.anat import (
+    ANAT_STEPS,
+    anat_step_is_current,
+    cached_nifti,
+)
+
+
+def _touch(path, mtime):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text("data")
+    os.utime(path, (mtime, mtime))
+
+
+def test_anat_step_is_current(tmp_path):
+    outputs, inputs = ANAT_STEPS["brainstem"]
+    assert not anat_step_is_current(str(tmp_path), "brainstem")
+
+    for output in outputs:
+        _touch(tmp_path / output, 2000)
+    assert anat_step_is_current(str(tmp_path), "brainstem")
+
+    _touch(tmp_path / inputs[0], 1000)
+    assert anat_step_is_current(str(tmp_path), "brainstem")
+
+    # a recon rerun makes the segmentation stale
+    _touch(tmp_path / inputs[1], 3000)
+    assert not anat_step_is_current(str(tmp_path), "brainstem")
+
+    _touch(tmp_path / inputs[1], 1000)
+    (tmp_path / outputs[0]).write_text("")
+    assert not anat_step_is_current(str(tmp_path), "brainstem")
+
+
+def test_cached_nifti_converts_once(tmp_path):
+    labels = np.zeros((4, 4, 4), dtype=np.int32)
+    labels[:2] = 17
+    affine = np.diag([1.0, 1.0, 1.0, 1.0])
+    affine[:3, 3] = -2
+    lh_file = tmp_path / "lh.mgz"
+    nib.save(nib.MGHImage(labels, affine), lh_file)
+    rh_labels = np.zeros_like(labels)
+    rh_labels[2:] = 53
+    rh_file = tmp_path / "rh.mgz"
+    nib.save(nib.MGHImage(rh_labels, affine), rh_file)
+
+    cache_dir = str(tmp_path / "cache")
+    out_file = cached_nifti(str(lh_file), "seg-lh_dseg.nii.gz", cache_dir)
+    assert os.path.basename(out_file) == "seg-lh_dseg.nii.gz"
+    img = nib.load(out_file)
+    np.testing.assert_array_equal(img.get_fdata(), labels)
+    np.testing.assert_allclose(img.affine, affine)
+    assert img.get_data_dtype() == np.int32
+
+    mtime = os.path.getmtime(out_file)
+    assert cached_nifti(str(lh_file), "seg-lh_dseg.nii.gz", cache_dir) == out_file
+    assert os.path.getmtime(out_file) == mtime
+
+    # left and right label volumes are combined like mri_concat --combine
+    combined = cached_nifti([str(lh_file), str(rh_file)], "seg_dseg.nii.gz", cache_dir)
+    np.testing.assert_array_equal(nib.load(combined).get_fdata(), labels + rh_labels)
+
+    # a rerun of the segmentation replaces its conversion, and only its own
+    labels[:2] = 18
+    nib.save(nib.MGHImage(labels, affine), lh_file)
+    os.utime(lh_file, (mtime + 10, mtime + 10))
+    new_file = cached_nifti(str(lh_file), "seg-lh_dseg.nii.gz", cache_dir)
+    assert new_file != out_file
+    np.testing.assert_array_equal(nib.load(new_file).get_fdata(), labels)
+    assert not os.path.exists(os.path.dirname(out_file))
+    assert os.path.exists(combined)
+
+
+def test_init_anat_nodes_leaves_out_current_steps(tmp_path):
+    import argparse
+
+    from petprep_extract_tacs.extract_tacs import init_anat_nodes
+
+    subject_dir = tmp_path / "derivatives" / "freesurfer" / "sub-01"
+    for output in ANAT_STEPS["brainstem"][0]:
+        _touch(subject_dir / output, 2000)
+
+    args = argparse.Namespace(
+        bids_dir=str(tmp_path),
+        gtm=True,
+        agtm=False,
+        brainstem=True,
+        thalamicNuclei=False,
+        hippocampusAmygdala=True,
+    )
+    nodes = init_anat_nodes(args, "01")
+    assert sorted(nodes) == ["gtm", "hippocampusAmygdala"]
+    node, field = nodes["gtm"]
+    assert field == "out_file"
+    assert node.inputs.subjects_dir == str(tmp_path / "derivatives" / "freesurfer")
+
+    args.force_anat = True
+    assert "brainstem" in init_anat_nodes(args, "01")
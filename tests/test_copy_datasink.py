@@ -25,3 +25,22 @@ def test_copy_datasink_to_derivatives(tmp_path):
     assert (out_dir / "tracer_file1.txt").exists()
     assert (out_dir / "tracer_file2.nii").exists()
     assert (out_dir / reg_file.name).exists()
+
+
+def test_copy_datasink_links_shared_outputs(tmp_path):
+    datasink = tmp_path / "petprep_extract_tacs_wf" / "datasink"
+    for run in ("run1", "run2"):
+        (datasink / f"sub-01_pet_file_{run}").mkdir(parents=True)
+        (datasink / f"sub-01_pet_file_{run}" / "seg-brainstem_dseg.nii.gz").write_text(
+            "seg"
+        )
+
+    output_dir = tmp_path / "derivatives" / "petprep_extract_tacs"
+    copy_datasink_to_derivatives(tmp_path, output_dir)
+    # reruns replace the previous outputs
+    copy_datasink_to_derivatives(tmp_path, output_dir)
+
+    out_file = output_dir / "sub-01" / "run1_seg-brainstem_dseg.nii.gz"
+    src_file = datasink / "sub-01_pet_file_run1" / "seg-brainstem_dseg.nii.gz"
+    assert out_file.read_text() == "seg"
+    assert os.path.samefile(out_file, src_file)
@@ -0,0 +1,50 @@
+import nibabel as nib
+import numpy as np
+
+from petprep_extract_tacs.utils.coreg import cached_coreg, coreg_key
+
+
+def _write_images(directory):
+    directory.mkdir()
+    rng = np.random.default_rng(0)
+    twa_file = directory / "twa.nii.gz"
+    nib.save(
+        nib.Nifti1Image(rng.random((4, 4, 4)).astype(np.float32), np.eye(4)), twa_file
+    )
+    brainmask_file = directory / "brainmask.mgz"
+    nib.save(
+        nib.MGHImage(rng.random((6, 6, 6)).astype(np.float32), np.eye(4)),
+        brainmask_file,
+    )
+    return str(twa_file), str(brainmask_file)
+
+
+def test_coreg_key_depends_on_image_content(tmp_path):
+    twa_file, brainmask_file = _write_images(tmp_path / "run1")
+    # the same images written again into a fresh working directory
+    twa_again, brainmask_again = _write_images(tmp_path / "run2")
+
+    key = coreg_key(twa_file, brainmask_file, "sub-01")
+    assert coreg_key(twa_again, brainmask_again, "sub-01") == key
+    assert coreg_key(twa_file, brainmask_file, "sub-02") != key
+
+    nib.save(nib.Nifti1Image(np.ones((4, 4, 4), np.float32), np.eye(4)), twa_again)
+    assert coreg_key(twa_again, brainmask_file, "sub-01") != key
+
+
+def test_cached_coreg_reuses_the_registration(tmp_path):
+    twa_file, brainmask_file = _write_images(tmp_path / "run")
+    cache_dir = tmp_path / "cache"
+    cache_dir.mkdir()
+    key = coreg_key(twa_file, brainmask_file, "sub-01")
+    (cache_dir / f"coreg_{key[:16]}.lta").write_text("cached registration")
+
+    out_file = cached_coreg(
+        twa_file,
+        brainmask_file,
+        str(tmp_path / "subjects"),
+        "sub-01",
+        str(tmp_path / "from-pet_to-t1w_reg.lta"),
+        cache_dir=str(cache_dir),
+    )
+    assert open(out_file).read() == "cached registration"
@@ -0,0 +1,326 @@
+import nibabel as nib
+import numpy as np
+import pandas as pd
+
+import petprep_extract_tacs.utils.gtm as gtm
+from petprep_extract_tacs.utils.gtm import (
+    compute_agtm_psf,
+    compute_gtm_nopvc,
+    compute_gtm_pvc,
+    gtm_prep,
+    load_basis,
+    load_fractions,
+    load_gtm_prep,
+    merge_segments,
+    optimize_psf,
+    read_gtm_ctab,
+    save_gtm_prep,
+    segment_basis,
+)
+from petprep_extract_tacs.utils.smooth import gaussian_smooth
+
+IDENTITY_LTA = """type      = 1 # LINEAR_RAS_TO_RAS
+nxforms   = 1
+mean      = 0.0000 0.0000 0.0000
+sigma     = 1.0000
+1 4 4
+1 0 0 0
+0 1 0 0
+0 0 1 0
+0 0 0 1
+"""
+
+GTMSEG_CTAB = """# TissueTypeSchema default.Jan-2017
+  0  Unknown                         0   0   0 0  0
+ 24  CSF                            60  60  60 0  3
+ 17  Left-Hippocampus              220 216  20 0  2
+1030  ctx-lh-superiortemporal      140 220 220 0  1
+#ctTType  0  unknown                  0   0   0    0
+#ctTType  1  cortex                 205  62  78    0
+#ctTType  2  subcort_gm             230 148  34    0
+#ctTType  3  CSF                    120  18 134    0
+"""
+
+
+def _write_inputs(tmp_path):
+    # 1 mm segmentation whose 2x2x2 blocks fall into single 2 mm PET voxels
+    labels = np.zeros((16, 16, 16), dtype=np.int32)
+    labels[2:8, 2:8, 2:8] = 17
+    labels[8:14, 2:8, 2:8] = 1033
+    labels[2:8, 8:14, 2:8] = 4
+    labels[8:9, 8:14, 8:14] = 24
+    seg_affine = np.eye(4)
+    seg_affine[:3, 3] = -0.5
+
+    pet = np.random.default_rng(0).random((8, 8, 8, 3)).astype(np.float32) + 1
+    pet_affine = np.diag([2.0, 2.0, 2.0, 1.0])
+
+    (tmp_path / "mri").mkdir()
+    seg_file = tmp_path / "mri" / "gtmseg.mgz"
+    nib.save(nib.MGHImage(labels, seg_affine), seg_file)
+    (tmp_path / "mri" / "gtmseg.ctab").write_text(GTMSEG_CTAB)
+    pet_file = tmp_path / "pet.nii.gz"
+    nib.save(nib.Nifti1Image(pet, pet_affine), pet_file)
+    lta_file = tmp_path / "reg.lta"
+    lta_file.write_text(IDENTITY_LTA)
+    return labels, pet, str(seg_file), str(pet_file), str(lta_file)
+
+
+def test_read_gtm_ctab_and_merge(tmp_path):
+    labels, _, seg_file, _, _ = _write_inputs(tmp_path)
+    ctab = read_gtm_ctab(tmp_path / "mri" / "gtmseg.ctab")
+    assert ctab.set_index("index").loc[17, "tissue"] == "subcort_gm"
+    assert ctab.set_index("index").loc[24, "name"] == "CSF"
+
+    merged = merge_segments(labels)
+    assert set(np.unique(merged)) == {0, 17, 24, 1030}
+    np.testing.assert_array_equal(merge_segments(labels, {}), labels)
+
+
+def test_fractions_are_cached(tmp_path):
+    _, _, seg_file, pet_file, lta_file = _write_inputs(tmp_path)
+    pet_img = nib.load(pet_file)
+
+    segids, fractions = load_fractions(seg_file, lta_file, pet_img)
+    np.testing.assert_array_equal(segids, [17, 24, 1030])
+    coverage = np.asarray(fractions.sum(axis=1)).ravel().reshape(8, 8, 8)
+    assert coverage.max() <= 1 + 1e-6
+    # a PET voxel fully inside the hippocampus and one half covered by CSF
+    assert coverage[2, 2, 2] == 1
+    np.testing.assert_allclose(
+        fractions[np.ravel_multi_index((4, 5, 5), (8,) * 3)].toarray(), [[0, 0.5, 0]]
+    )
+
+    cache_dir = tmp_path / "cache"
+    load_fractions(seg_file, lta_file, pet_img, cache_dir=str(cache_dir))
+    cached_segids, cached = load_fractions(
+        seg_file, lta_file, pet_img, cache_dir=str(cache_dir)
+    )
+    assert len(list(cache_dir.iterdir())) == 1
+    np.testing.assert_array_equal(cached_segids, segids)
+    np.testing.assert_allclose(cached.toarray(), fractions.toarray())
+
+    # the same registration written again elsewhere reuses the entry, a new one
+    # replaces it
+    entries = list(cache_dir.iterdir())
+    (tmp_path / "work").mkdir()
+    copied_lta = tmp_path / "work" / "reg.lta"
+    copied_lta.write_text(IDENTITY_LTA)
+    load_fractions(seg_file, str(copied_lta), pet_img, cache_dir=str(cache_dir))
+    assert list(cache_dir.iterdir()) == entries
+    copied_lta.write_text(IDENTITY_LTA.replace("1 0 0 0\n", "1 0 0 0.5\n"))
+    load_fractions(seg_file, str(copied_lta), pet_img, cache_dir=str(cache_dir))
+    assert len(list(cache_dir.iterdir())) == 1
+    assert list(cache_dir.iterdir()) != entries
+
+
+def test_compute_gtm_nopvc_matches_majority_label_means(tmp_path):
+    labels, pet, seg_file, pet_file, lta_file = _write_inputs(tmp_path)
+
+    nopvc_file, stats_file = compute_gtm_nopvc(
+        pet_file, seg_file, lta_file, str(tmp_path / "nopvc"), mask=None, mem_mb=0.01
+    )
+
+    # majority label of every 2x2x2 block; the half covered CSF voxels tie with
+    # the background and keep their label
+    pet_labels = merge_segments(labels).reshape(8, 2, 8, 2, 8, 2)
+    pet_labels = pet_labels.transpose(0, 2, 4, 1, 3, 5).reshape(8, 8, 8, 8)
+    majority = np.array(
+        [np.bincount(block).argmax() for block in pet_labels.reshape(-1, 8)]
+    ).reshape(8, 8, 8)
+    majority[4] = np.where(pet_labels[4].max(axis=-1) == 24, 24, majority[4])
+
+    nopvc = nib.load(nopvc_file).get_fdata()
+    assert nopvc.shape == (3, 1, 1, 3)
+    for row, segid in enumerate([17, 24, 1030]):
+        np.testing.assert_allclose(
+            nopvc[row, 0, 0], pet[majority == segid].mean(axis=0), rtol=1e-5
+        )
+
+    stats = pd.read_csv(
+        stats_file,
+        header=None,
+        delim_whitespace=True,
+        usecols=[1, 2, 4],
+        names=["index", "name", "volume_mm3"],
+    )
+    assert stats["name"].tolist() == [
+        "Left-Hippocampus",
+        "CSF",
+        "ctx-lh-superiortemporal",
+    ]
+    assert stats["volume_mm3"].tolist() == [27, 27 + 9, 27]
+
+
+def test_compute_gtm_nopvc_auto_mask(tmp_path):
+    _, _, seg_file, pet_file, lta_file = _write_inputs(tmp_path)
+    pet = np.zeros((8, 8, 8, 2), dtype=np.float32)
+    pet[1:4, 1:4, 1:4] = 10
+    pet_file = tmp_path / "masked_pet.nii.gz"
+    nib.save(nib.Nifti1Image(pet, np.diag([2.0, 2.0, 2.0, 1.0])), pet_file)
+
+    nopvc_file, stats_file = compute_gtm_nopvc(
+        str(pet_file), seg_file, lta_file, str(tmp_path / "nopvc")
+    )
+    # only the hippocampus is within the mask, the other segments are empty
+    np.testing.assert_allclose(nib.load(nopvc_file).get_fdata()[:, 0, 0, 0], [10, 0, 0])
+
+
+def _write_pvc_inputs(tmp_path, fwhm, values):
+    labels, _, seg_file, pet_file, lta_file = _write_inputs(tmp_path)
+    pet_img = nib.load(pet_file)
+    segids, fractions = load_fractions(seg_file, lta_file, pet_img)
+    basis = segment_basis(fractions, (8, 8, 8), (2, 2, 2), fwhm).toarray()
+    pet = (basis @ values).reshape(8, 8, 8, -1).astype(np.float32)
+    nib.save(nib.Nifti1Image(pet, pet_img.affine), pet_file)
+    return seg_file, pet_file, lta_file, fractions
+
+
+def test_segment_basis_matches_smoothing_the_whole_volume(tmp_path):
+    _, _, seg_file, pet_file, lta_file = _write_inputs(tmp_path)
+    _, fractions = load_fractions(seg_file, lta_file, nib.load(pet_file))
+
+    basis = segment_basis(fractions, (8, 8, 8), (2, 2, 2), (5, 6, 7)).toarray()
+    for col in range(fractions.shape[1]):
+        volume = fractions[:, col].toarray().reshape(8, 8, 8)
+        expected = gaussian_smooth(volume, (5, 6, 7), (2, 2, 2)).ravel()
+        expected[expected <= 1e-6] = 0
+        np.testing.assert_allclose(basis[:, col], expected, atol=1e-6)
+
+
+def test_bases_are_cached_per_run(tmp_path, monkeypatch):
+    _, _, seg_file, pet_file, lta_file = _write_inputs(tmp_path)
+    pet_img = nib.load(pet_file)
+    cache_dir = tmp_path / "cache"
+
+    segids, basis = load_basis(seg_file, lta_file, pet_img, 6, cache_dir=str(cache_dir))
+    (basis_dir,) = cache_dir.glob("gtm_bases_*")
+    assert len(list(basis_dir.iterdir())) == 1
+    cached_segids, cached = load_basis(
+        seg_file, lta_file, pet_img, 6, cache_dir=str(cache_dir)
+    )
+    assert len(list(basis_dir.iterdir())) == 1
+    np.testing.assert_array_equal(cached_segids, segids)
+    assert (cached != basis).nnz == 0
+
+    # every PSF is cached, up to the most recently used ones
+    monkeypatch.setattr(gtm, "GTM_BASIS_ENTRIES", 2)
+    load_basis(seg_file, lta_file, pet_img, 5, cache_dir=str(cache_dir))
+    assert len(list(basis_dir.iterdir())) == 2
+    load_basis(seg_file, lta_file, pet_img, 6, cache_dir=str(cache_dir))
+    load_basis(seg_file, lta_file, pet_img, 4, cache_dir=str(cache_dir))
+    assert sorted(path.name for path in basis_dir.iterdir()) == [
+        "fwhm4x4x4.npz",
+        "fwhm6x6x6.npz",
+    ]
+
+    # a new registration of the run replaces its bases
+    (tmp_path / "work").mkdir()
+    new_lta = tmp_path / "work" / "reg.lta"
+    new_lta.write_text(IDENTITY_LTA.replace("1 0 0 0\n", "1 0 0 0.5\n"))
+    load_basis(seg_file, str(new_lta), pet_img, 6, cache_dir=str(cache_dir))
+    assert [path.name for path in cache_dir.glob("gtm_bases_*")] != [basis_dir.name]
+    assert len(list(cache_dir.glob("gtm_bases_*"))) == 1
+
+
+def test_compute_gtm_pvc_recovers_regional_values(tmp_path):
+    values = np.array([[10.0, 20.0], [2.0, 1.0], [5.0, 8.0]])
+    seg_file, pet_file, lta_file, _ = _write_pvc_inputs(tmp_path, 6, values)
+
+    gtm_file, stats_file = compute_gtm_pvc(
+        pet_file, seg_file, lta_file, str(tmp_path / "agtm"), 6, mask=None
+    )
+    np.testing.assert_allclose(
+        nib.load(gtm_file).get_fdata()[:, 0, 0], values, rtol=1e-4
+    )
+    assert stats_file.endswith("gtm.stats.dat")
+
+    # the values without PVC are biased by the spill over between segments
+    nopvc_file, _ = compute_gtm_nopvc(
+        pet_file, seg_file, lta_file, str(tmp_path / "nopvc"), mask=None
+    )
+    assert not np.allclose(nib.load(nopvc_file).get_fdata()[:, 0, 0], values)
+
+
+def test_gtm_variants_share_the_prep(tmp_path):
+    values = np.array([[10.0, 20.0], [2.0, 1.0], [5.0, 8.0]])
+    seg_file, pet_file, lta_file, _ = _write_pvc_inputs(tmp_path, 6, values)
+
+    prep = gtm_prep(pet_file, seg_file, lta_file, mem_mb=0.01)
+    prep_file = save_gtm_prep(str(tmp_path / "gtm_prep.npz"), prep)
+    loaded = load_gtm_prep(prep_file)
+    assert (loaded["fractions"] != prep["fractions"]).nnz == 0
+    np.testing.assert_array_equal(loaded["voxels"], prep["voxels"])
+    assert 0 < len(loaded["voxels"]) < 8**3
+    # only the geometry is shared, the frames are streamed by every variant
+    assert "frames" not in np.load(prep_file).files
+
+    for compute, args in (
+        (compute_gtm_nopvc, ()),
+        (compute_gtm_pvc, (6,)),
+    ):
+        shared, _ = compute(
+            pet_file,
+            seg_file,
+            lta_file,
+            str(tmp_path / "shared"),
+            *args,
+            prep_file=prep_file,
+            mem_mb=1e-3,
+        )
+        alone, _ = compute(pet_file, seg_file, lta_file, str(tmp_path / "alone"), *args)
+        np.testing.assert_allclose(
+            nib.load(shared).get_fdata(), nib.load(alone).get_fdata(), rtol=1e-6
+        )
+
+
+def test_optimize_psf_refines_the_search_range():
+    calls = []
+
+    def objective(fwhm):
+        calls.append(fwhm)
+        return (fwhm - 6.3) ** 2
+
+    fwhm, evaluated = optimize_psf(objective, (0, 12), n_threads=2, n_iter=6)
+    assert abs(fwhm - 6.3) < 0.1
+    assert len(calls) == len(set(calls)) == len(evaluated)
+
+
+def test_compute_agtm_psf_estimates_the_fwhm(tmp_path):
+    values = np.array([[10.0], [2.0], [5.0]])
+    seg_file, pet_file, lta_file, _ = _write_pvc_inputs(tmp_path, 6, values)
+
+    cache_dir = tmp_path / "cache"
+    out_file, fwhm = compute_agtm_psf(
+        pet_file,
+        seg_file,
+        lta_file,
+        str(tmp_path / "agtm" / "aux" / "opt.params.dat"),
+        psf=5,
+        n_threads=2,
+        n_iter=6,
+        cache_dir=str(cache_dir),
+    )
+    assert abs(fwhm - 6) < 0.2
+    assert np.allclose([float(v) for v in open(out_file).read().split()], fwhm)
+    # fractions and one basis per candidate FWHM are cached
+    assert len(list(cache_dir.glob("gtm_fractions_*"))) == 1
+    (basis_dir,) = cache_dir.glob("gtm_bases_*")
+    assert len(list(basis_dir.iterdir())) > 5
+
+
+def test_compute_agtm_psf_widens_a_search_missing_the_fwhm(tmp_path):
+    values = np.array([[10.0], [2.0], [5.0]])
+    seg_file, pet_file, lta_file, _ = _write_pvc_inputs(tmp_path, 6, values)
+
+    _, fwhm = compute_agtm_psf(
+        pet_file,
+        seg_file,
+        lta_file,
+        str(tmp_path / "opt.params.dat"),
+        psf=5,
+        search=(2, 3),
+        n_iter=6,
+        cache_dir=str(tmp_path / "cache"),
+    )
+    assert abs(fwhm - 6) < 0.2
@@ -0,0 +1,52 @@
+import json
+import os
+
+from petprep_extract_tacs.utils.layout import dataset_fingerprint, get_layout
+
+
+def _make_dataset(bids_dir, subjects):
+    bids_dir.mkdir(exist_ok=True)
+    (bids_dir / "dataset_description.json").write_text(
+        json.dumps({"Name": "test", "BIDSVersion": "1.7.0"})
+    )
+    for subject in subjects:
+        pet_dir = bids_dir / f"sub-{subject}" / "pet"
+        pet_dir.mkdir(parents=True, exist_ok=True)
+        (pet_dir / f"sub-{subject}_pet.nii.gz").write_bytes(b"")
+        (pet_dir / f"sub-{subject}_pet.json").write_text("{}")
+
+
+def test_dataset_fingerprint_ignores_derivatives(tmp_path):
+    bids_dir = tmp_path / "bids"
+    _make_dataset(bids_dir, ["01"])
+    fingerprint = dataset_fingerprint(str(bids_dir))
+
+    (bids_dir / "derivatives" / "freesurfer").mkdir(parents=True)
+    (bids_dir / "derivatives" / "freesurfer" / "file").write_text("data")
+    assert dataset_fingerprint(str(bids_dir)) == fingerprint
+
+    _make_dataset(bids_dir, ["02"])
+    assert dataset_fingerprint(str(bids_dir)) != fingerprint
+    assert dataset_fingerprint(str(bids_dir), validate=True) != dataset_fingerprint(
+        str(bids_dir)
+    )
+
+
+def test_get_layout_reuses_the_index(tmp_path):
+    bids_dir = tmp_path / "bids"
+    database_dir = str(tmp_path / "db")
+    _make_dataset(bids_dir, ["01"])
+
+    layout = get_layout(str(bids_dir), database_dir=database_dir)
+    assert layout.get_subjects() == ["01"]
+    database = os.path.join(database_dir, "layout_index.sqlite")
+    mtime = os.path.getmtime(database)
+
+    layout = get_layout(str(bids_dir), database_dir=database_dir)
+    assert layout.get_subjects() == ["01"]
+    assert os.path.getmtime(database) == mtime
+
+    # a new subject invalidates the stored index
+    _make_dataset(bids_dir, ["02"])
+    layout = get_layout(str(bids_dir), database_dir=database_dir)
+    assert layout.get_subjects() == ["01", "02"]
@@ -0,0 +1,175 @@
+import nibabel as nib
+import numpy as np
+from scipy import ndimage
+
+from petprep_extract_tacs.utils.mni305 import (
+    mni305_operator,
+    mni305_vox2vox,
+    read_xfm,
+    resample_to_mni305,
+)
+from petprep_extract_tacs.utils.resample import load_masked, resample_to_target
+from petprep_extract_tacs.utils.smooth import gaussian_smooth
+
+LTA = """type      = 1 # LINEAR_RAS_TO_RAS
+nxforms   = 1
+mean      = 0.0000 0.0000 0.0000
+sigma     = 1.0000
+1 4 4
+{matrix}
+"""
+
+XFM = """MNI Transform File
+% avi2talxfm
+
+Transform_Type = Linear;
+Linear_Transform =
+1.1 0.05 0 2
+-0.05 1.1 0 -3
+0 0 0.95 4;
+"""
+
+
+def _write_inputs(tmp_path):
+    pet = np.random.default_rng(0).random((12, 12, 10, 3)).astype(np.float32)
+    pet_affine = np.diag([3.0, 3.0, 3.0, 1.0])
+    pet_affine[:3, 3] = [-18, -18, -15]
+    template_affine = np.array(
+        [[-2, 0, 0, 20], [0, 0, 2, -20], [0, -2, 0, 20], [0, 0, 0, 1.0]]
+    )
+    ras2ras = np.eye(4)
+    ras2ras[:3, 3] = [1, -2, 0.5]
+
+    files = {
+        "pet": tmp_path / "pet.nii.gz",
+        "lta": tmp_path / "reg.lta",
+        "xfm": tmp_path / "talairach.xfm",
+        "template": tmp_path / "mni305.cor.subfov2.mgz",
+        "anat": tmp_path / "T1.mgz",
+    }
+    nib.save(nib.Nifti1Image(pet, pet_affine), files["pet"])
+    files["lta"].write_text(
+        LTA.format(matrix="\n".join(" ".join(f"{v:g}" for v in row) for row in ras2ras))
+    )
+    files["xfm"].write_text(XFM)
+    nib.save(
+        nib.MGHImage(np.zeros((20, 20, 20), np.float32), template_affine),
+        files["template"],
+    )
+    anat_affine = np.array(
+        [[-1, 0, 0, 15], [0, 0, 1, -15], [0, -1, 0, 15], [0, 0, 0, 1.0]]
+    )
+    nib.save(
+        nib.MGHImage(np.ones((30, 30, 30), np.float32), anat_affine), files["anat"]
+    )
+    return pet, pet_affine, template_affine, {k: str(v) for k, v in files.items()}
+
+
+def test_read_xfm(tmp_path):
+    *_, files = _write_inputs(tmp_path)
+    np.testing.assert_allclose(
+        read_xfm(files["xfm"]),
+        [[1.1, 0.05, 0, 2], [-0.05, 1.1, 0, -3], [0, 0, 0.95, 4], [0, 0, 0, 1]],
+    )
+
+
+def test_resample_to_mni305_single_pass(tmp_path):
+    pet, pet_affine, template_affine, files = _write_inputs(tmp_path)
+    labels = np.zeros((30, 30, 30), dtype=np.int32)
+    labels[12:16, 12:16, 12:16] = 1
+    seg_file = str(tmp_path / "seg.nii.gz")
+    nib.save(nib.Nifti1Image(labels, nib.load(files["anat"]).affine), seg_file)
+
+    cache_dir = tmp_path / "cache"
+    out_file, smoothed_file, masked_file = resample_to_mni305(
+        files["pet"],
+        files["lta"],
+        files["xfm"],
+        str(tmp_path / "mni.nii.gz"),
+        template_file=files["template"],
+        smooth_fwhm=6,
+        smoothed_file=str(tmp_path / "mni_sm.nii.gz"),
+        cache_dir=str(cache_dir),
+        n_threads=2,
+        mem_mb=0.05,
+        anat_file=files["anat"],
+        mask_files=[seg_file],
+        masked_file=str(tmp_path / "masked.npz"),
+    )
+
+    vox2vox = mni305_vox2vox(files["lta"], files["xfm"], pet_affine, template_affine)
+    coords = vox2vox[:3, :3] @ np.indices((20, 20, 20)).reshape(3, -1)
+    coords += vox2vox[:3, 3:]
+    inside = np.all((coords >= 0) & (coords <= np.array([[11], [11], [9]])), axis=0)
+    resampled = nib.load(out_file).get_fdata()
+    assert resampled.shape == (20, 20, 20, 3)
+    assert inside.sum() > 1000
+    for frame in range(3):
+        expected = ndimage.map_coordinates(pet[..., frame], coords, order=1)
+        np.testing.assert_allclose(
+            resampled.reshape(-1, 3)[inside, frame], expected[inside], atol=1e-5
+        )
+
+    np.testing.assert_allclose(
+        nib.load(smoothed_file).get_fdata(),
+        gaussian_smooth(resampled, 6, (2, 2, 2)),
+        atol=1e-5,
+    )
+
+    # the T1w voxels come from the same pass as a separate masked resampling
+    expected = load_masked(
+        resample_to_target(
+            files["pet"],
+            files["anat"],
+            files["lta"],
+            str(tmp_path / "expected.npz"),
+            mask_files=[seg_file],
+        )
+    )
+    masked = load_masked(masked_file)
+    np.testing.assert_array_equal(masked["voxels"], expected["voxels"])
+    np.testing.assert_allclose(masked["data"], expected["data"], atol=1e-6)
+
+    # the interpolation operator is cached and reused
+    assert len(list(cache_dir.iterdir())) == 1
+    cached_file, no_smoothed, no_masked = resample_to_mni305(
+        files["pet"],
+        files["lta"],
+        files["xfm"],
+        str(tmp_path / "mni_cached.nii.gz"),
+        template_file=files["template"],
+        cache_dir=str(cache_dir),
+    )
+    assert no_smoothed is None and no_masked is None
+    assert len(list(cache_dir.iterdir())) == 1
+    np.testing.assert_allclose(nib.load(cached_file).get_fdata(), resampled)
+
+
+def test_mni305_operator_is_cached_by_the_registration(tmp_path):
+    pet, pet_affine, template_affine, files = _write_inputs(tmp_path)
+    cache_dir = tmp_path / "cache"
+    pet_img = nib.load(files["pet"])
+    operator = mni305_operator(
+        files["lta"], files["xfm"], pet_img, files["template"], str(cache_dir)
+    )
+    entries = list(cache_dir.iterdir())
+    assert len(entries) == 1
+
+    # the same registration written again elsewhere reuses the entry
+    work_dir = tmp_path / "work"
+    work_dir.mkdir()
+    lta_file = work_dir / "reg.lta"
+    lta_file.write_text(open(files["lta"]).read())
+    cached = mni305_operator(
+        str(lta_file), files["xfm"], pet_img, files["template"], str(cache_dir)
+    )
+    assert list(cache_dir.iterdir()) == entries
+    assert (cached != operator).nnz == 0
+
+    # a new registration of the run replaces the entry
+    lta_file.write_text(open(files["lta"]).read().replace("0.5", "1.5"))
+    mni305_operator(
+        str(lta_file), files["xfm"], pet_img, files["template"], str(cache_dir)
+    )
+    assert len(list(cache_dir.iterdir())) == 1
+    assert list(cache_dir.iterdir()) != entries
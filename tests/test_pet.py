@@ -0,0 +1,104 @@
+import json
+
+import nibabel as nib
+import numpy as np
+
+from petprep_extract_tacs.utils.pet import (
+    create_weighted_average_pet,
+    frame_timing_errors,
+    iter_frame_blocks,
+    run_name,
+)
+
+
+def _write_pet(tmp_path, n_frames=5):
+    rng = np.random.default_rng(0)
+    pet = rng.random((4, 3, 2, n_frames)).astype(np.float32)
+    pet_file = tmp_path / "sub-01_pet.nii.gz"
+    json_file = tmp_path / "sub-01_pet.json"
+    nib.save(nib.Nifti1Image(pet, np.eye(4)), pet_file)
+    starts = np.cumsum([0] + [10 * (i + 1) for i in range(n_frames - 1)])
+    json_file.write_text(
+        json.dumps(
+            {
+                "FrameTimesStart": starts.tolist(),
+                "FrameDuration": [10 * (i + 1) for i in range(n_frames)],
+            }
+        )
+    )
+    return pet, pet_file, json_file
+
+
+def test_iter_frame_blocks_respects_memory_budget(tmp_path):
+    pet, pet_file, _ = _write_pet(tmp_path)
+    img = nib.load(pet_file)
+
+    # one frame is 4 * 3 * 2 voxels * 8 bytes, allow two frames per block
+    blocks = list(iter_frame_blocks(img, mem_mb=2 * 24 * 8 / 1024**2))
+
+    assert [(start, stop) for start, stop, _ in blocks] == [(0, 2), (2, 4), (4, 5)]
+    assert all(block.dtype == np.float32 for _, _, block in blocks)
+    np.testing.assert_array_equal(
+        np.concatenate([block for _, _, block in blocks], axis=3), pet
+    )
+
+
+def test_create_weighted_average_pet_matches_trapezoidal_rule(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    pet, pet_file, json_file = _write_pet(tmp_path)
+    meta = json.loads(json_file.read_text())
+    mid_frames = np.array(meta["FrameTimesStart"]) + np.array(meta["FrameDuration"]) / 2
+    expected = np.trapz(pet, dx=np.diff(mid_frames), axis=3) / np.sum(mid_frames)
+
+    out_file, window_files = create_weighted_average_pet(
+        str(pet_file), str(json_file), mem_mb=1e-6
+    )
+
+    assert out_file.endswith("sub-01_desc-wavg_pet.nii.gz")
+    assert window_files == []
+    assert nib.load(out_file).get_data_dtype() == np.float32
+    np.testing.assert_allclose(nib.load(out_file).get_fdata(), expected, rtol=1e-5)
+
+
+def test_create_weighted_average_pet_writes_window_averages(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    pet, pet_file, json_file = _write_pet(tmp_path)
+    meta = json.loads(json_file.read_text())
+    durations = np.array(meta["FrameDuration"], dtype=float)
+
+    out_file, window_files = create_weighted_average_pet(
+        str(pet_file),
+        str(json_file),
+        mem_mb=2 * 24 * 8 / 1024**2,
+        windows=[[0, 40], [40, float("inf")]],
+    )
+
+    assert [f.split("/")[-1] for f in window_files] == [
+        "desc-twa0to40_pet.nii.gz",
+        "desc-twa40toend_pet.nii.gz",
+    ]
+    # mid-frame times are 5, 25, 45, 75 and 115 seconds
+    for window_file, frames in zip(window_files, [slice(0, 2), slice(2, 5)]):
+        expected = np.average(pet[..., frames], axis=3, weights=durations[frames])
+        np.testing.assert_allclose(
+            nib.load(window_file).get_fdata(), expected, rtol=1e-5
+        )
+
+
+def test_frame_timing_errors(tmp_path):
+    _, pet_file, json_file = _write_pet(tmp_path)
+    assert frame_timing_errors(str(pet_file), str(json_file)) == []
+
+    meta = json.loads(json_file.read_text())
+    meta["FrameDuration"] = meta["FrameDuration"][:-1]
+    json_file.write_text(json.dumps(meta))
+    errors = frame_timing_errors(str(pet_file), str(json_file))
+    assert len(errors) == 2
+    assert "FrameDuration -> 4" in errors[0]
+
+
+def test_run_name():
+    assert run_name("/data/sub-01/ses-1/pet/sub-01_ses-1_pet.nii.gz") == "sub-01_ses-1"
+    assert run_name("/work/sub-01_ses-1_desc-wavg_pet.nii.gz") == "sub-01_ses-1"
+    assert run_name("sub-01_trc-FDG_desc-mc_pet.nii.gz") == "sub-01_trc-FDG"
+    assert run_name("pet.nii.gz") == "pet"
@@ -0,0 +1,55 @@
+import json
+
+import numpy as np
+
+from petprep_extract_tacs.utils.psf_store import (
+    read_psf_store,
+    scanner_key,
+    update_psf_store,
+    warm_start_search,
+)
+
+
+def test_scanner_key(tmp_path):
+    json_file = tmp_path / "pet.json"
+    json_file.write_text(
+        json.dumps({"ManufacturersModelName": "HRRT", "ReconMethodName": "OP-3D-OSEM"})
+    )
+    assert scanner_key(str(json_file)) == "HRRT|OP-3D-OSEM"
+
+    json_file.write_text(json.dumps({"TracerName": "DASB"}))
+    assert scanner_key(str(json_file)) is None
+
+
+def test_update_psf_store_keeps_one_estimate_per_run(tmp_path):
+    store_file = str(tmp_path / "cache" / "agtm_psf_store.json")
+    assert read_psf_store(store_file) == {}
+    assert warm_start_search(read_psf_store(store_file).get("HRRT|OSEM")) is None
+
+    fwhms = [2.4, 2.6, 2.5, 2.9]
+    for run, fwhm in enumerate(fwhms):
+        update_psf_store(store_file, "HRRT|OSEM", f"sub-0{run}_pet.json", fwhm)
+    update_psf_store(store_file, "mCT|OSEM", "sub-09_pet.json", 5.0)
+
+    store = read_psf_store(store_file)
+    assert store["HRRT|OSEM"]["n"] == 4
+    assert np.isclose(store["HRRT|OSEM"]["mean"], np.mean(fwhms))
+    assert np.isclose(store["HRRT|OSEM"]["m2"] / 3, np.var(fwhms, ddof=1))
+    assert store["mCT|OSEM"]["mean"] == 5.0
+
+    # a run processed again replaces its estimate
+    fwhms[3] = 2.7
+    entry = update_psf_store(store_file, "HRRT|OSEM", "sub-03_pet.json", 2.7)
+    assert entry == read_psf_store(store_file)["HRRT|OSEM"]
+    assert entry["n"] == 4
+    assert np.isclose(entry["mean"], np.mean(fwhms))
+    assert np.isclose(entry["m2"] / 3, np.var(fwhms, ddof=1))
+
+
+def test_warm_start_search_narrows_around_the_estimate():
+    lower, upper = warm_start_search({"n": 1, "mean": 5.0, "m2": 0.0})
+    assert np.allclose((lower, upper), (4.0, 6.0))
+
+    # a wide spread of estimates widens the range
+    lower, upper = warm_start_search({"n": 3, "mean": 5.0, "m2": 8.0})
+    assert np.allclose((lower, upper), (0.0, 11.0))
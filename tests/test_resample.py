@@ -0,0 +1,189 @@
+import nibabel as nib
+import numpy as np
+from scipy import ndimage
+
+from petprep_extract_tacs.utils.resample import (
+    load_masked,
+    mask_voxels,
+    read_lta,
+    resample_to_target,
+    target_to_source_vox2vox,
+    trilinear_operator,
+)
+from petprep_extract_tacs.utils.segstats import compute_multi_segstats
+
+LTA_TEMPLATE = """# transform file reg.lta
+type      = 1 # LINEAR_RAS_TO_RAS
+nxforms   = 1
+mean      = 0.0000 0.0000 0.0000
+sigma     = 1.0000
+1 4 4
+{matrix}
+src volume info
+valid = 1  # volume info valid
+filename = pet.nii.gz
+volume = 10 12 8
+voxelsize = 3 3 3
+xras   = 1 0 0
+yras   = 0 1 0
+zras   = 0 0 1
+c_ras  = 0 0 0
+dst volume info
+valid = 1  # volume info valid
+filename = brainmask.mgz
+volume = 30 30 30
+voxelsize = 1 1 1
+xras   = -1 0 0
+yras   = 0 0 -1
+zras   = 0 1 0
+c_ras  = 0 0 0
+subject sub-01
+"""
+
+
+def _write_inputs(tmp_path):
+    rng = np.random.default_rng(0)
+    pet = rng.random((10, 12, 8, 3)).astype(np.float32)
+    pet_affine = np.diag([3.0, 3.0, 3.0, 1.0])
+    pet_affine[:3, 3] = [-15, -18, -12]
+    t1_affine = np.array(
+        [[-1, 0, 0, 15], [0, 0, 1, -15], [0, -1, 0, 15], [0, 0, 0, 1.0]]
+    )
+
+    angle = 0.1
+    ras2ras = np.eye(4)
+    ras2ras[:2, :2] = [[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]]
+    ras2ras[:3, 3] = [1, 2, -1]
+
+    pet_file = tmp_path / "pet.nii.gz"
+    t1_file = tmp_path / "brainmask.mgz"
+    lta_file = tmp_path / "reg.lta"
+    nib.save(nib.Nifti1Image(pet, pet_affine), pet_file)
+    nib.save(nib.MGHImage(np.ones((30, 30, 30), np.float32), t1_affine), t1_file)
+    lta_file.write_text(
+        LTA_TEMPLATE.format(
+            matrix="\n".join(" ".join(f"{v:.10f}" for v in row) for row in ras2ras)
+        )
+    )
+    return pet, pet_affine, t1_affine, ras2ras, pet_file, t1_file, lta_file
+
+
+def test_read_lta_parses_matrix_and_geometry(tmp_path):
+    _, pet_affine, t1_affine, ras2ras, _, _, lta_file = _write_inputs(tmp_path)
+
+    lta = read_lta(lta_file)
+
+    assert lta["type"] == 1
+    np.testing.assert_allclose(lta["matrix"], ras2ras, atol=1e-9)
+    assert lta["dst"]["shape"] == (30, 30, 30)
+    np.testing.assert_allclose(lta["src"]["vox2ras"][:3, :3], pet_affine[:3, :3])
+    np.testing.assert_allclose(lta["dst"]["vox2ras"], t1_affine)
+
+
+def test_resample_to_target_matches_trilinear_interpolation(tmp_path):
+    pet, pet_affine, t1_affine, _, pet_file, t1_file, lta_file = _write_inputs(tmp_path)
+
+    out_file = resample_to_target(
+        str(pet_file),
+        str(t1_file),
+        str(lta_file),
+        str(tmp_path / "space-T1w_pet.nii.gz"),
+        n_threads=2,
+        mem_mb=1e-3,
+    )
+
+    vox2vox = target_to_source_vox2vox(lta_file, pet_affine, t1_affine)
+    ijk = np.indices((30, 30, 30)).reshape(3, -1)
+    coords = vox2vox[:3, :3] @ ijk + vox2vox[:3, 3:]
+    inside = np.all((coords >= 0) & (coords <= np.array([[9], [11], [7]])), axis=0)
+    resampled = nib.load(out_file).get_fdata().reshape(-1, 3)
+
+    assert nib.load(out_file).shape == (30, 30, 30, 3)
+    for frame in range(3):
+        expected = ndimage.map_coordinates(pet[..., frame], coords, order=1)
+        np.testing.assert_allclose(
+            resampled[inside, frame], expected[inside], atol=1e-5
+        )
+
+
+def test_in_memory_resampling_matches_resampled_file(tmp_path):
+    _, pet_affine, t1_affine, _, pet_file, t1_file, lta_file = _write_inputs(tmp_path)
+    labels = np.zeros((30, 30, 30), dtype=np.int32)
+    labels[5:15, 5:20, 10:20] = 1
+    labels[15:25, 5:20, 10:20] = 2
+    seg_file = tmp_path / "seg.nii.gz"
+    nib.save(nib.Nifti1Image(labels, t1_affine), seg_file)
+    t1w_pet = resample_to_target(
+        str(pet_file),
+        str(t1_file),
+        str(lta_file),
+        str(tmp_path / "space-T1w_pet.nii.gz"),
+    )
+
+    on_disk = compute_multi_segstats(t1w_pet, [str(seg_file)])[0]
+    in_memory = compute_multi_segstats(
+        str(pet_file),
+        [str(seg_file)],
+        lta_file=str(lta_file),
+        target_file=str(t1_file),
+        n_threads=2,
+    )[0]
+
+    np.testing.assert_allclose(in_memory["tacs"], on_disk["tacs"], rtol=1e-5)
+    assert trilinear_operator(np.eye(4), (2, 2, 2), (2, 2, 2)).nnz == 8
+
+
+def test_pet_space_extraction_matches_t1w_space(tmp_path):
+    _, _, t1_affine, _, pet_file, t1_file, lta_file = _write_inputs(tmp_path)
+    labels = np.zeros((30, 30, 30), dtype=np.int32)
+    labels[5:15, 5:20, 10:20] = 1
+    labels[15:25, 5:20, 10:20] = 2
+    seg_file = tmp_path / "seg.nii.gz"
+    nib.save(nib.Nifti1Image(labels, t1_affine), seg_file)
+
+    kwargs = dict(lta_file=str(lta_file), target_file=str(t1_file))
+    t1w_space = compute_multi_segstats(str(pet_file), [str(seg_file)], **kwargs)[0]
+    pet_space = compute_multi_segstats(
+        str(pet_file), [str(seg_file)], pet_space=True, **kwargs
+    )[0]
+
+    np.testing.assert_allclose(pet_space["tacs"], t1w_space["tacs"], rtol=1e-5)
+    np.testing.assert_array_equal(pet_space["nvoxels"], t1w_space["nvoxels"])
+
+
+def test_masked_resampling_only_covers_labels(tmp_path):
+    _, _, t1_affine, _, pet_file, t1_file, lta_file = _write_inputs(tmp_path)
+    labels = np.zeros((30, 30, 30), dtype=np.int32)
+    labels[10:12, 10:12, 10:12] = 1
+    other = np.zeros_like(labels)
+    other[20, 20, 20] = 7
+    seg_file = tmp_path / "seg.nii.gz"
+    other_file = tmp_path / "other.nii.gz"
+    nib.save(nib.Nifti1Image(labels, t1_affine), seg_file)
+    nib.save(nib.Nifti1Image(other, t1_affine), other_file)
+
+    voxels = mask_voxels([str(seg_file), [str(other_file)]], (30, 30, 30), margin=1)
+    # face-connected dilation of a 2x2x2 cube and of a single voxel
+    assert len(voxels) == (8 + 6 * 4) + 7
+
+    full_file = resample_to_target(
+        str(pet_file), str(t1_file), str(lta_file), str(tmp_path / "full.nii.gz")
+    )
+    masked_file = resample_to_target(
+        str(pet_file),
+        str(t1_file),
+        str(lta_file),
+        str(tmp_path / "masked.npz"),
+        mask_files=[str(seg_file), [str(other_file)]],
+        margin=1,
+    )
+    masked = load_masked(masked_file)
+    full = nib.load(full_file).get_fdata().reshape(-1, 3)
+
+    np.testing.assert_array_equal(masked["voxels"], voxels)
+    np.testing.assert_allclose(masked["data"], full[voxels], atol=1e-6)
+
+    from_full = compute_multi_segstats(full_file, [str(seg_file), str(other_file)])
+    from_masked = compute_multi_segstats(masked_file, [str(seg_file), str(other_file)])
+    for expected, stats in zip(from_full, from_masked):
+        np.testing.assert_allclose(stats["tacs"], expected["tacs"], rtol=1e-5)
@@ -0,0 +1,68 @@
+import os
+
+import petprep_extract_tacs.utils.scan as scan
+from petprep_extract_tacs.utils.scan import PETDataset, scan_pet_dataset
+
+
+def _add_run(bids_dir, subject, name, session=None):
+    pet_dir = bids_dir / f"sub-{subject}"
+    if session:
+        pet_dir = pet_dir / f"ses-{session}"
+    pet_dir = pet_dir / "pet"
+    pet_dir.mkdir(parents=True, exist_ok=True)
+    (pet_dir / f"{name}_pet.nii.gz").write_bytes(b"")
+    (pet_dir / f"{name}_pet.json").write_text("{}")
+    return str(pet_dir / f"{name}_pet.nii.gz")
+
+
+def test_scan_pet_dataset(tmp_path):
+    bids_dir = tmp_path / "bids"
+    pet_file = _add_run(bids_dir, "01", "sub-01_trc-DASB")
+    _add_run(bids_dir, "02", "sub-02_ses-baseline_trc-DASB", "baseline")
+    _add_run(bids_dir, "02", "sub-02_ses-rescan_trc-DASB", "rescan")
+    (bids_dir / "sub-03" / "anat").mkdir(parents=True)
+    (bids_dir / "sub-01" / "pet" / "sub-01_trc-DASB_recording-manual_blood.tsv").touch()
+
+    dataset = PETDataset(str(bids_dir))
+    assert dataset.get_subjects(suffix="pet") == ["01", "02"]
+    assert dataset.get_sessions() == ["baseline", "rescan"]
+    assert dataset.get_sessions(subject="01") == []
+
+    (run,) = dataset.get_runs("01")
+    assert run == {
+        "pet_file": pet_file,
+        "json_file": pet_file.replace(".nii.gz", ".json"),
+        "session": None,
+    }
+    assert [run["session"] for run in dataset.get_runs("02")] == [
+        "baseline",
+        "rescan",
+    ]
+
+
+def test_scan_pet_dataset_only_lists_changed_subjects(tmp_path, monkeypatch):
+    bids_dir = tmp_path / "bids"
+    index_file = str(tmp_path / "cache" / "pet_index.json")
+    _add_run(bids_dir, "01", "sub-01")
+    _add_run(bids_dir, "02", "sub-02")
+
+    listed = []
+    scan_subject = scan.scan_subject
+
+    def counting_scan_subject(subject_dir):
+        listed.append(os.path.basename(subject_dir))
+        return scan_subject(subject_dir)
+
+    monkeypatch.setattr(scan, "scan_subject", counting_scan_subject)
+
+    first = scan_pet_dataset(str(bids_dir), index_file)
+    assert sorted(listed) == ["sub-01", "sub-02"]
+
+    listed.clear()
+    assert scan_pet_dataset(str(bids_dir), index_file) == first
+    assert listed == []
+
+    _add_run(bids_dir, "02", "sub-02_run-2")
+    subjects = scan_pet_dataset(str(bids_dir), index_file)
+    assert listed == ["sub-02"]
+    assert len(subjects["02"]["runs"]) == 2
@@ -0,0 +1,133 @@
+import json
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+
+from petprep_extract_tacs.utils.segstats import compute_multi_segstats, compute_segstats
+from petprep_extract_tacs.utils.utils import multi_segstats_to_tacs
+
+
+def _write_inputs(tmp_path):
+    rng = np.random.default_rng(0)
+    labels = rng.integers(0, 4, size=(6, 5, 4)).astype(np.int32)
+    labels[labels == 2] = 0  # label 2 is absent and should not be reported
+    pet = rng.random((6, 5, 4, 3)).astype(np.float32)
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+
+    seg_file = tmp_path / "seg.nii.gz"
+    pet_file = tmp_path / "pet.nii.gz"
+    json_file = tmp_path / "pet.json"
+    ctab_file = tmp_path / "labels.ctab"
+
+    nib.save(nib.Nifti1Image(labels, affine), seg_file)
+    nib.save(nib.Nifti1Image(pet, affine), pet_file)
+    json_file.write_text(
+        json.dumps({"FrameTimesStart": [0, 10, 30], "FrameDuration": [10, 20, 30]})
+    )
+    ctab_file.write_text(
+        "0 Unknown 0 0 0 0\n"
+        "1 regionA 1 1 1 0\n"
+        "2 regionB 2 2 2 0\n"
+        "3 regionC 3 3 3 0\n"
+    )
+
+    return labels, pet, seg_file, pet_file, json_file, ctab_file
+
+
+def test_compute_segstats_matches_masked_means(tmp_path):
+    labels, pet, seg_file, pet_file, _, ctab_file = _write_inputs(tmp_path)
+
+    stats = compute_segstats(str(pet_file), str(seg_file), ctab_file=str(ctab_file))
+
+    assert stats["index"].tolist() == [1, 3]
+    assert stats["name"] == ["regionA", "regionC"]
+    for column, segid in enumerate(stats["index"]):
+        mask = labels == segid
+        assert stats["nvoxels"][column] == mask.sum()
+        assert stats["volume_mm3"][column] == mask.sum() * 8.0
+        np.testing.assert_allclose(
+            stats["tacs"][:, column], pet[mask].mean(axis=0, dtype=np.float64)
+        )
+
+
+def test_compute_multi_segstats_combines_segmentation_lists(tmp_path):
+    labels, pet, seg_file, pet_file, _, _ = _write_inputs(tmp_path)
+    other = np.where(labels == 0, 5, 0).astype(np.int32)
+    other_file = tmp_path / "other.nii.gz"
+    nib.save(nib.Nifti1Image(other, np.diag([2.0, 2.0, 2.0, 1.0])), other_file)
+
+    single, combined = compute_multi_segstats(
+        str(pet_file), [str(seg_file), [str(seg_file), str(other_file)]]
+    )
+
+    assert single["index"].tolist() == [1, 3]
+    assert combined["index"].tolist() == [1, 3, 5]
+    np.testing.assert_allclose(combined["tacs"][:, :2], single["tacs"])
+    np.testing.assert_allclose(
+        combined["tacs"][:, 2], pet[labels == 0].mean(axis=0, dtype=np.float64)
+    )
+
+
+def test_multi_segstats_to_tacs_writes_bids_tables(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    labels, pet, seg_file, pet_file, json_file, ctab_file = _write_inputs(tmp_path)
+
+    tacs_files, morph_files, dseg_files = multi_segstats_to_tacs(
+        str(pet_file),
+        [str(seg_file), str(seg_file)],
+        str(json_file),
+        ["seg-test", "seg-other"],
+        [str(ctab_file), str(ctab_file)],
+    )
+
+    tacs = pd.read_csv(tacs_files[0], sep="\t")
+    morph = pd.read_csv(morph_files[0], sep="\t")
+    dseg = pd.read_csv(dseg_files[0], sep="\t")
+
+    assert tacs_files[0].endswith("seg-test_tacs.tsv")
+    assert tacs_files[1].endswith("seg-other_tacs.tsv")
+    assert list(tacs.columns) == ["frame_start", "frame_end", "regionA", "regionC"]
+    assert tacs["frame_end"].tolist() == [10, 30, 60]
+    assert list(morph.columns) == ["index", "name", "volume-mm3"]
+    assert list(dseg.columns) == ["index", "name"]
+    assert dseg["name"].tolist() == ["regionA", "regionC"]
+
+
+def test_label_matrix_cache_is_reused_and_invalidated(tmp_path):
+    labels, pet, seg_file, pet_file, _, ctab_file = _write_inputs(tmp_path)
+    cache_dir = tmp_path / "cache"
+
+    first = compute_multi_segstats(
+        str(pet_file), [str(seg_file)], [str(ctab_file)], cache_dir=str(cache_dir)
+    )[0]
+    cached = list(cache_dir.glob("seg_labels_*.npz"))
+    assert len(cached) == 1
+
+    second = compute_multi_segstats(
+        str(pet_file), [str(seg_file)], [str(ctab_file)], cache_dir=str(cache_dir)
+    )[0]
+    assert list(cache_dir.glob("seg_labels_*.npz")) == cached
+    assert second["name"] == first["name"]
+    np.testing.assert_allclose(second["tacs"], first["tacs"])
+
+    labels[labels == 3] = 1
+    nib.save(nib.Nifti1Image(labels, np.diag([2.0, 2.0, 2.0, 1.0])), seg_file)
+    changed = compute_multi_segstats(
+        str(pet_file), [str(seg_file)], [str(ctab_file)], cache_dir=str(cache_dir)
+    )[0]
+
+    assert changed["index"].tolist() == [1]
+    assert len(list(cache_dir.glob("seg_labels_*.npz"))) == 1
+    np.testing.assert_allclose(
+        changed["tacs"][:, 0], pet[labels == 1].mean(axis=0, dtype=np.float64)
+    )
+
+
+def test_compute_segstats_is_independent_of_frame_blocks(tmp_path):
+    _, _, seg_file, pet_file, _, _ = _write_inputs(tmp_path)
+
+    whole = compute_multi_segstats(str(pet_file), [str(seg_file)])[0]
+    framewise = compute_multi_segstats(str(pet_file), [str(seg_file)], mem_mb=1e-6)[0]
+
+    np.testing.assert_allclose(framewise["tacs"], whole["tacs"])
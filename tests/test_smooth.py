@@ -0,0 +1,40 @@
+import numpy as np
+from scipy import ndimage
+
+from petprep_extract_tacs.utils.smooth import (
+    fwhm_to_sigma,
+    gaussian_smooth,
+    smooth_blocks,
+)
+
+
+def test_gaussian_smooth_matches_scipy():
+    data = np.random.default_rng(0).normal(size=(12, 10, 8, 3)).astype(np.float32)
+    zooms = (2.0, 2.0, 3.0)
+    sigma = fwhm_to_sigma(6, zooms)
+    expected = ndimage.gaussian_filter(data, tuple(sigma) + (0,), mode="nearest")
+
+    for n_threads in (1, 3):
+        smoothed = gaussian_smooth(data, 6, zooms, n_threads=n_threads)
+        np.testing.assert_allclose(smoothed, expected, rtol=1e-5, atol=1e-6)
+    # input is left untouched
+    assert not np.allclose(smoothed, data)
+
+
+def test_smooth_blocks_smooths_every_block():
+    data = np.random.default_rng(1).normal(size=(16, 16, 16, 5)).astype(np.float32)
+    blocks = [
+        (start, stop, data[..., start:stop].reshape(-1, stop - start))
+        for start, stop in ((0, 2), (2, 5))
+    ]
+
+    smoothed = list(smooth_blocks(blocks, data.shape, 8, (2, 2, 2), n_threads=2))
+    assert [(start, stop) for start, stop, _ in smoothed] == [(0, 2), (2, 5)]
+    expected = gaussian_smooth(data, 8, (2, 2, 2))
+    for start, stop, block in smoothed:
+        np.testing.assert_allclose(
+            block,
+            expected[..., start:stop].reshape(-1, stop - start),
+            rtol=1e-5,
+            atol=1e-6,
+        )
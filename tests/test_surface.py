@@ -0,0 +1,208 @@
+import nibabel as nib
+import numpy as np
+
+from petprep_extract_tacs.utils.surface import (
+    fsaverage_smoothing,
+    fwhm_to_niters,
+    neighbour_averaging_operator,
+    nnfr_operator,
+    project_to_fsaverage,
+    save_surface_data,
+)
+
+IDENTITY_LTA = """type      = 1 # LINEAR_RAS_TO_RAS
+nxforms   = 1
+mean      = 0.0000 0.0000 0.0000
+sigma     = 1.0000
+1 4 4
+1 0 0 0
+0 1 0 0
+0 0 1 0
+0 0 0 1
+"""
+
+
+def _sphere(n, seed):
+    points = np.random.default_rng(seed).normal(size=(n, 3))
+    return 100 * points / np.linalg.norm(points, axis=1, keepdims=True)
+
+
+def _write_subject(tmp_path, n_vertices=50):
+    subjects_dir = tmp_path / "freesurfer"
+    c_ras = np.array([5.0, -3.0, 2.0])
+    anat_affine = np.array(
+        [[-1, 0, 0, 16], [0, 0, 1, -16], [0, -1, 0, 16], [0, 0, 0, 1.0]]
+    )
+    anat_affine[:3, 3] += c_ras
+    faces = np.zeros((0, 3), dtype=np.int32)
+
+    for subject, seed in (("sub-01", 0), ("fsaverage", 1)):
+        (subjects_dir / subject / "surf").mkdir(parents=True)
+        (subjects_dir / subject / "label").mkdir(parents=True)
+        for hemi in ("lh", "rh"):
+            surf_dir = subjects_dir / subject / "surf"
+            sphere = _sphere(n_vertices, seed)
+            nib.freesurfer.write_geometry(
+                surf_dir / f"{hemi}.sphere.reg", sphere, faces
+            )
+            if subject == "fsaverage":
+                continue
+            white = np.random.default_rng(2).uniform(-10, 10, size=(n_vertices, 3))
+            nib.freesurfer.write_geometry(surf_dir / f"{hemi}.white", white, faces)
+            nib.freesurfer.write_geometry(surf_dir / f"{hemi}.pial", white + 1, faces)
+            cortex = np.arange(0, n_vertices, 2)
+            (subjects_dir / subject / "label" / f"{hemi}.cortex.label").write_text(
+                f"#!ascii label\n{len(cortex)}\n"
+                + "".join(f"{v} 0 0 0 0\n" for v in cortex)
+            )
+
+    anat_file = subjects_dir / "sub-01" / "mri" / "T1.mgz"
+    anat_file.parent.mkdir()
+    nib.save(nib.MGHImage(np.zeros((32, 32, 32), np.float32), anat_affine), anat_file)
+
+    pet_affine = np.eye(4)
+    pet_affine[:3, 3] = c_ras - 16
+    i, j, k = np.indices((32, 32, 32))
+    pet = np.stack([1000.0 * i + 10 * j + k, -(1000.0 * i + 10 * j + k)], axis=-1)
+    pet_file = tmp_path / "pet.nii.gz"
+    nib.save(nib.Nifti1Image(pet.astype(np.float32), pet_affine), pet_file)
+
+    lta_file = tmp_path / "reg.lta"
+    lta_file.write_text(IDENTITY_LTA)
+    return subjects_dir, anat_file, pet_file, lta_file, pet, c_ras
+
+
+def test_nnfr_operator_identity_and_normalisation():
+    sphere = _sphere(30, 0)
+    np.testing.assert_allclose(nnfr_operator(sphere, sphere).toarray(), np.eye(30))
+
+    mapping = nnfr_operator(_sphere(30, 0), _sphere(200, 1))
+    np.testing.assert_allclose(np.asarray(mapping.sum(axis=1)).ravel(), 1)
+
+
+def test_project_to_fsaverage_samples_midthickness(tmp_path):
+    subjects_dir, anat_file, pet_file, lta_file, pet, c_ras = _write_subject(tmp_path)
+    cache_dir = tmp_path / "cache"
+    out_files = [str(tmp_path / "lh.nii.gz"), str(tmp_path / "rh.nii.gz")]
+
+    lh_file, rh_file = project_to_fsaverage(
+        str(pet_file),
+        str(lta_file),
+        str(subjects_dir),
+        "sub-01",
+        str(anat_file),
+        out_files,
+        cache_dir=str(cache_dir),
+        mem_mb=1e-3,
+    )
+
+    surf = subjects_dir / "sub-01" / "surf"
+    white = nib.freesurfer.read_geometry(surf / "lh.white")[0]
+    midthickness = white + 0.5 + c_ras
+    ijk = np.rint(midthickness - (c_ras - 16)).astype(int)
+    sampled = pet[ijk[:, 0], ijk[:, 1], ijk[:, 2]]
+    sampled[1::2] = 0  # outside the cortex label
+    mapping = nnfr_operator(
+        nib.freesurfer.read_geometry(surf / "lh.sphere.reg")[0],
+        nib.freesurfer.read_geometry(
+            subjects_dir / "fsaverage" / "surf" / "lh.sphere.reg"
+        )[0],
+    )
+
+    lh = nib.load(lh_file).get_fdata()
+    assert lh.shape == (50, 1, 1, 2)
+    np.testing.assert_allclose(lh[:, 0, 0, :], mapping @ sampled, rtol=1e-5)
+    assert len(list(cache_dir.glob("fsaverage_sampling_*.npz"))) == 1
+
+    # a second run sharing the registration reuses the cached operator
+    project_to_fsaverage(
+        str(pet_file),
+        str(lta_file),
+        str(subjects_dir),
+        "sub-01",
+        str(anat_file),
+        out_files,
+        cache_dir=str(cache_dir),
+    )
+    np.testing.assert_allclose(
+        nib.load(rh_file).get_fdata(), nib.load(rh_file).get_fdata()
+    )
+    assert len(list(cache_dir.glob("fsaverage_sampling_*.npz"))) == 1
+
+    # a new registration of the run replaces the entry
+    entries = list(cache_dir.glob("fsaverage_sampling_*.npz"))
+    lta_file.write_text(IDENTITY_LTA.replace("1 0 0 0\n", "1 0 0 0.5\n", 1))
+    project_to_fsaverage(
+        str(pet_file),
+        str(lta_file),
+        str(subjects_dir),
+        "sub-01",
+        str(anat_file),
+        out_files,
+        cache_dir=str(cache_dir),
+    )
+    assert len(list(cache_dir.glob("fsaverage_sampling_*.npz"))) == 1
+    assert list(cache_dir.glob("fsaverage_sampling_*.npz")) != entries
+
+
+def test_save_surface_data_uses_freesurfer_ico7_layout(tmp_path):
+    data = np.arange(163842 * 2, dtype=np.float32).reshape(2, 163842).T
+
+    out_file = save_surface_data(data, str(tmp_path / "lh.nii.gz"))
+
+    img = nib.load(out_file)
+    assert img.header["dim"][1:5].tolist() == [27307, 1, 6, 2]
+    np.testing.assert_array_equal(img.get_fdata()[:, 0, 0, :], data)
+
+
+OCTAHEDRON = np.array(
+    [[0, 2, 4], [2, 1, 4], [1, 3, 4], [3, 0, 4], [2, 0, 5], [1, 2, 5], [3, 1, 5]]
+    + [[0, 3, 5]]
+)
+
+
+def test_neighbour_averaging_operator():
+    operator = neighbour_averaging_operator(OCTAHEDRON, 6).toarray()
+    # every vertex of an octahedron has four neighbours and is opposite to one
+    np.testing.assert_allclose(operator.sum(axis=1), 1)
+    np.testing.assert_allclose(np.diag(operator), 1 / 5)
+    assert operator[0, 1] == 0 and operator[0, 2] == np.float32(1 / 5)
+
+    coords = 10 * np.array(
+        [[1, 0, 0], [-1, 0, 0], [0, 1, 0], [0, -1, 0], [0, 0, 1], [0, 0, -1.0]]
+    )
+    assert fwhm_to_niters(0, coords, OCTAHEDRON) == 0
+    assert fwhm_to_niters(20, coords, OCTAHEDRON) > fwhm_to_niters(
+        10, coords, OCTAHEDRON
+    )
+
+
+def test_fsaverage_smoothing_is_cached(tmp_path):
+    surf_dir = tmp_path / "fsaverage" / "surf"
+    surf_dir.mkdir(parents=True)
+    coords = 10 * np.array(
+        [[1, 0, 0], [-1, 0, 0], [0, 1, 0], [0, -1, 0], [0, 0, 1], [0, 0, -1.0]]
+    )
+    for hemi in ("lh", "rh"):
+        nib.freesurfer.write_geometry(surf_dir / f"{hemi}.white", coords, OCTAHEDRON)
+
+    cache_dir = tmp_path / "cache"
+    smoothing = fsaverage_smoothing(str(tmp_path), 10, str(cache_dir))
+    assert len(list(cache_dir.iterdir())) == 2
+    cached = fsaverage_smoothing(str(tmp_path), 10, str(cache_dir))
+    for (operator, niters), (cached_operator, cached_niters) in zip(smoothing, cached):
+        assert niters == cached_niters == fwhm_to_niters(10, coords, OCTAHEDRON)
+        np.testing.assert_array_equal(operator.toarray(), cached_operator.toarray())
+
+    fsaverage_smoothing(str(tmp_path), 5, str(cache_dir))
+    assert len(list(cache_dir.iterdir())) == 4
+
+    # a changed fsaverage replaces the entries of the FWHM
+    entries = set(cache_dir.iterdir())
+    for hemi in ("lh", "rh"):
+        nib.freesurfer.write_geometry(
+            surf_dir / f"{hemi}.white", 2 * coords, OCTAHEDRON
+        )
+    fsaverage_smoothing(str(tmp_path), 5, str(cache_dir))
+    assert len(list(cache_dir.iterdir())) == 4
+    assert len(entries - set(cache_dir.iterdir())) == 2
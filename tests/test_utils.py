@@ -3,7 +3,11 @@ from pathlib import Path
 
 import pandas as pd
 
-from petprep_extract_tacs.utils.utils import avgwf_to_tacs
+from petprep_extract_tacs.utils.utils import (
+    avgwf_to_tacs,
+    limbic_to_dsegtsv,
+    limbic_to_stats,
+)
 
 
 def test_avgwf_to_tacs_generates_bids_columns(tmp_path):
@@ -37,3 +41,23 @@ def test_avgwf_to_tacs_generates_bids_columns(tmp_path):
 
     # Ensure the generated TSV lives alongside the original avgwf file
     assert Path(out_tsv).parent == avgwf_file.parent
+
+
+def test_limbic_tables_are_named_after_the_segmentation(tmp_path, monkeypatch):
+    stats_dir = tmp_path / "freesurfer" / "stats"
+    stats_dir.mkdir(parents=True)
+    stats_file = stats_dir / "raphe+pons.stats"
+    stats_file.write_text(
+        "# ColHeaders Index SegId NVoxels Volume_mm3 StructName\n"
+        "  1  851  120  120.0  Raphe\n"
+        "  2  174  900  900.0  Pons\n"
+    )
+    monkeypatch.chdir(tmp_path)
+
+    morph_file = limbic_to_stats(str(stats_file), seg_prefix="seg-raphe")
+    dseg_file = limbic_to_dsegtsv(str(stats_file), seg_prefix="seg-raphe")
+    assert morph_file == str(tmp_path / "seg-raphe_morph.tsv")
+    assert dseg_file == str(tmp_path / "seg-raphe_dseg.tsv")
+    assert pd.read_csv(morph_file, sep="\t")["volume-mm3"].tolist() == [120, 900]
+    assert pd.read_csv(dseg_file, sep="\t")["name"].tolist() == ["Raphe", "Pons"]
+    assert sorted(p.name for p in stats_dir.iterdir()) == ["raphe+pons.stats"]
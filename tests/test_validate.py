@@ -0,0 +1,87 @@
+import csv
+import json
+
+import nibabel as nib
+import numpy as np
+
+import petprep_extract_tacs.utils.validate as validate
+from petprep_extract_tacs.utils.validate import (
+    validate_frame_timing,
+    write_frame_timing_report,
+)
+
+
+def _write_run(tmp_path, name, n_frames, n_entries):
+    pet_file = tmp_path / f"{name}_pet.nii.gz"
+    json_file = tmp_path / f"{name}_pet.json"
+    nib.save(
+        nib.Nifti1Image(np.zeros((2, 2, 2, n_frames), dtype=np.float32), np.eye(4)),
+        pet_file,
+    )
+    json_file.write_text(
+        json.dumps(
+            {
+                "FrameTimesStart": list(range(n_entries)),
+                "FrameDuration": [1] * n_entries,
+            }
+        )
+    )
+    return {
+        "subject": name[4:6],
+        "pet_file": str(pet_file),
+        "json_file": str(json_file),
+    }
+
+
+def test_validate_frame_timing_is_cached(tmp_path, monkeypatch):
+    runs = [
+        _write_run(tmp_path, "sub-01", 3, 3),
+        _write_run(tmp_path, "sub-02", 3, 2),
+        {
+            "subject": "03",
+            "pet_file": str(tmp_path / "sub-03_pet.nii.gz"),
+            "json_file": str(tmp_path / "sub-03_pet.json"),
+        },
+    ]
+    cache_file = str(tmp_path / "cache" / "frame_timing.json")
+
+    rows = validate_frame_timing(runs, cache_file, n_threads=2)
+    assert [row["status"] for row in rows] == ["pass", "fail", "fail"]
+    assert len(rows[1]["errors"]) == 2
+    assert rows[2]["errors"][0].startswith("Missing file")
+
+    checked = []
+    frame_timing_errors = validate.frame_timing_errors
+
+    def counting_frame_timing_errors(pet_file, json_file):
+        checked.append(pet_file)
+        return frame_timing_errors(pet_file, json_file)
+
+    monkeypatch.setattr(validate, "frame_timing_errors", counting_frame_timing_errors)
+    assert validate_frame_timing(runs, cache_file) == rows
+    assert checked == []
+
+    # a fixed sidecar is checked again
+    runs[1] = _write_run(tmp_path, "sub-02", 3, 3)
+    rows = validate_frame_timing(runs, cache_file)
+    assert checked == [runs[1]["pet_file"]]
+    assert [row["status"] for row in rows] == ["pass", "pass", "fail"]
+    # the outcome of the fixed sidecar replaces the earlier one
+    with open(cache_file) as f:
+        cached = json.load(f)
+    assert sorted(cached) == [runs[0]["pet_file"], runs[1]["pet_file"]]
+    assert cached[runs[1]["pet_file"]]["errors"] == []
+
+    # checking a subset of the runs keeps the outcomes of the others
+    validate_frame_timing(runs[1:], cache_file)
+    with open(cache_file) as f:
+        assert json.load(f) == cached
+    assert validate_frame_timing(runs, cache_file) == rows
+    assert checked == [runs[1]["pet_file"]]
+
+    report = write_frame_timing_report(rows, str(tmp_path / "frame_timing.tsv"))
+    with open(report) as f:
+        table = list(csv.DictReader(f, delimiter="\t"))
+    assert [row["subject"] for row in table] == ["01", "02", "03"]
+    assert table[0]["errors"] == ""
+    assert table[2]["status"] == "fail"
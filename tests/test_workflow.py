@@ -0,0 +1,118 @@
+import argparse
+import json
+import os
+import shlex
+
+import nibabel as nib
+import numpy as np
+
+from petprep_extract_tacs.extract_tacs import (
+    TEMPLATE_SUBJECT,
+    format_cli_argument,
+    get_bids_layout,
+    get_parser,
+    init_petprep_extract_tacs_wf,
+)
+from petprep_extract_tacs.utils.anat import ANAT_STEPS
+from petprep_extract_tacs.utils.scan import PETDataset
+
+
+def _make_dataset(bids_dir, subjects):
+    img = nib.Nifti1Image(np.zeros((2, 2, 2, 2), dtype=np.float32), np.eye(4))
+    for subject, sessions in subjects.items():
+        for session in sessions or [None]:
+            pet_dir = os.path.join(bids_dir, f"sub-{subject}")
+            name = f"sub-{subject}"
+            if session:
+                pet_dir = os.path.join(pet_dir, f"ses-{session}")
+                name += f"_ses-{session}"
+            pet_dir = os.path.join(pet_dir, "pet")
+            os.makedirs(pet_dir)
+            nib.save(img, os.path.join(pet_dir, f"{name}_pet.nii.gz"))
+            with open(os.path.join(pet_dir, f"{name}_pet.json"), "w") as f:
+                json.dump({"FrameTimesStart": [0, 60], "FrameDuration": [60, 60]}, f)
+
+
+def test_subject_workflows_are_cloned_from_templates(tmp_path):
+    bids_dir = str(tmp_path)
+    _make_dataset(bids_dir, {"01": None, "02": None, "03": ["a", "b"]})
+
+    # the brainstem segmentation of subject 02 is up to date
+    subject_dir = tmp_path / "derivatives" / "freesurfer" / "sub-02"
+    for output in ANAT_STEPS["brainstem"][0]:
+        (subject_dir / output).parent.mkdir(parents=True, exist_ok=True)
+        (subject_dir / output).write_text("data")
+
+    args = argparse.Namespace(
+        bids_dir=bids_dir,
+        gtm=False,
+        agtm=False,
+        psf=None,
+        brainstem=True,
+        thalamicNuclei=False,
+        hippocampusAmygdala=False,
+        wm=False,
+        raphe=False,
+        limbic=False,
+        surface=False,
+        volume=False,
+        petprep_hmc=False,
+        n_procs=1,
+    )
+    layout = PETDataset(bids_dir)
+    wf = init_petprep_extract_tacs_wf(args, [], include_anat=True, layout=layout)
+
+    for subject_id, runs in (
+        ("01", ["sub-01"]),
+        ("02", ["sub-02"]),
+        ("03", ["sub-03_ses-a", "sub-03_ses-b"]),
+    ):
+        subject_wf = wf.get_node(f"subject_{subject_id}_wf")
+        assert subject_wf.get_node("inputs").iterables == ("pet_file", runs)
+        assert subject_wf.get_node("select_files").inputs.subject_id == subject_id
+        coreg = subject_wf.get_node("coreg_pet_to_t1w")
+        assert coreg.inputs.subject_id == f"sub-{subject_id}"
+        assert coreg.inputs.cache_dir.endswith(f"sub-{subject_id}")
+        for node in subject_wf._get_all_nodes():
+            for value in node.inputs.get().values():
+                assert TEMPLATE_SUBJECT not in str(value)
+
+    assert wf.get_node("subject_01_wf.segment_bs") is not None
+    assert wf.get_node("subject_02_wf.segment_bs") is None
+    assert os.path.exists(
+        tmp_path / "derivatives" / "petprep_extract_tacs" / "frame_timing.tsv"
+    )
+
+
+def test_format_cli_argument_round_trips_the_command_line():
+    positional = ["/bids_dir", "/output_dir", "participant"]
+    args = get_parser().parse_args(
+        positional
+        + ["--participant_label", "01", "02"]
+        + ["--twa_window", "3600", "inf", "--twa_window", "0", "60"]
+    )
+    assert args.twa_window == [[3600.0, float("inf")], [0.0, 60.0]]
+
+    args_string = " ".join(
+        format_cli_argument(key, getattr(args, key))
+        for key in ("participant_label", "twa_window")
+    )
+    assert args_string == (
+        "--participant_label 01 02 --twa_window 3600.0 inf --twa_window 0.0 60.0"
+    )
+    parsed = get_parser().parse_args(positional + shlex.split(args_string))
+    assert parsed.participant_label == args.participant_label
+    assert parsed.twa_window == args.twa_window
+
+
+def test_get_bids_layout_follows_skip_bids_validator(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(
+        "petprep_extract_tacs.extract_tacs.get_layout",
+        lambda bids_dir, validate, database_dir: calls.append(validate),
+    )
+    for skip in (False, True):
+        get_bids_layout(
+            argparse.Namespace(bids_dir=str(tmp_path), skip_bids_validator=skip)
+        )
+    assert calls == [True, False]